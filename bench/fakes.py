@@ -0,0 +1,289 @@
+"""
+Заглушки внешних сервисов для нагрузочного теста: Bot API, KIE и YooKassa.
+Все три — приложения aiohttp, живут в процессе генератора нагрузки (loadgen.py).
+"""
+import json
+import time
+import uuid
+import random
+import asyncio
+import logging
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from typing import Dict, Optional, Set
+
+import aiohttp
+from aiohttp import web
+
+# Методы Bot API, которые возвращают Message
+MESSAGE_METHODS = {
+    "sendMessage", "sendVideo", "sendInvoice", "sendPhoto", "sendDocument",
+    "editMessageText", "editMessageReplyMarkup", "editMessageCaption",
+}
+# Содержимое «файла» для getFile; i2v генератор нагрузки не гоняет, картинка не декодируется
+FILE_CONTENT = b"\xff\xd8bench\xff\xd9"
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+class FakeTelegram:
+    """
+    Bot API: /bot{token}/{method} и /file/bot{token}/{path}.
+    Каждый вызов с chat_id кладётся в очередь чата — генератор нагрузки
+    ждёт по ней ответ бота; answerPreCheckoutQuery — в очередь "pcq:{id}".
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.bot_user = {"id": 100000, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        self._inbox: Dict[str, asyncio.Queue] = defaultdict(asyncio.Queue)
+        self._message_id = 0
+
+    def inbox(self, key) -> asyncio.Queue:
+        return self._inbox[str(key)]
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.file)
+        return app
+
+    def _message(self, method: str, params: dict) -> dict:
+        if method.startswith("edit") and params.get("message_id"):
+            message_id = int(params["message_id"])
+        else:
+            self._message_id += 1
+            message_id = self._message_id
+        msg = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+            "from": self.bot_user,
+        }
+        if "text" in params:
+            msg["text"] = params["text"]
+        if method == "sendVideo":
+            file_id = f"video-{message_id}"
+            msg["video"] = {
+                "file_id": file_id, "file_unique_id": file_id,
+                "width": 1280, "height": 720, "duration": 10,
+                "mime_type": "video/mp4", "file_size": 1 << 20,
+            }
+        elif method == "sendInvoice":
+            prices = json.loads(params.get("prices") or "[]")
+            msg["invoice"] = {
+                "title": params.get("title", ""),
+                "description": params.get("description", ""),
+                "start_parameter": params.get("start_parameter", ""),
+                "currency": params.get("currency", "XTR"),
+                "total_amount": sum(int(p["amount"]) for p in prices),
+            }
+        return msg
+
+    def _result(self, method: str, params: dict):
+        if method == "getMe":
+            return self.bot_user
+        if method in MESSAGE_METHODS:
+            return self._message(method, params)
+        if method == "getChatMember":
+            user_id = int(params.get("user_id") or 0)
+            return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"}}
+        if method == "getFile":
+            return {"file_id": params.get("file_id"), "file_unique_id": params.get("file_id"),
+                    "file_size": len(FILE_CONTENT), "file_path": "photos/bench.jpg"}
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        # файлы (FSInputFile) приходят частью multipart — нам нужны только строковые поля
+        params = {k: v for k, v in (await request.post()).items() if isinstance(v, str)}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.calls[method] += 1
+        result = self._result(method, params)
+        if method == "answerPreCheckoutQuery":
+            key = f"pcq:{params.get('pre_checkout_query_id')}"
+        elif method != "getChatMember" and params.get("chat_id"):
+            key = params["chat_id"]
+        else:
+            key = None
+        if key is not None:
+            self.inbox(key).put_nowait((method, params, result))
+        return web.json_response({"ok": True, "result": result})
+
+    async def file(self, request: web.Request) -> web.Response:
+        return web.Response(body=FILE_CONTENT, content_type="image/jpeg")
+
+
+class FakeKie:
+    """
+    KIE: createTask / recordInfo. Задача «генерируется» latency ± jitter секунд;
+    throttle_rate — доля 429 на createTask (бот повторяет), error_rate — доля
+    окончательных отказов 422 (бот возвращает токены),
+    job_fail_rate — доля задач, завершающихся state=fail.
+    Если в задаче есть callBackUrl, по готовности туда уходит колбэк, как у KIE.
+    """
+
+    def __init__(self, latency: float = 20.0, jitter: float = 0.3, throttle_rate: float = 0.0,
+                 error_rate: float = 0.0, job_fail_rate: float = 0.0,
+                 video_url: str = "https://cdn.bench.invalid/video.mp4"):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.job_fail_rate = job_fail_rate
+        self.video_url = video_url
+        self.stats: Counter = Counter()
+        self.tasks: Dict[str, dict] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._callbacks: Set[asyncio.Task] = set()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/api/v1/jobs/createTask", self.create_task)
+        app.router.add_get("/api/v1/jobs/recordInfo", self.record_info)
+        app.on_cleanup.append(self._cleanup)
+        return app
+
+    async def _cleanup(self, app):
+        for t in self._callbacks:
+            t.cancel()
+        await asyncio.gather(*self._callbacks, return_exceptions=True)
+        if self._session:
+            await self._session.close()
+
+    def _record(self, task_id: str) -> Optional[dict]:
+        task = self.tasks.get(task_id)
+        if task is None:
+            return None
+        record = {"taskId": task_id, "model": task["model"], "createTime": int(task["created"] * 1000)}
+        if time.monotonic() < task["done_at"]:
+            record["state"] = "generating"
+            return record
+        record["completeTime"] = int((task["created"] + task["duration"]) * 1000)
+        if task["fail"]:
+            record.update(state="fail", failCode="500", failMsg="bench: generation failed")
+        else:
+            record.update(state="success", resultJson=json.dumps({"resultUrls": [self.video_url]}))
+        return record
+
+    async def create_task(self, request: web.Request) -> web.Response:
+        self.stats["createTask"] += 1
+        roll = random.random()
+        if roll < self.throttle_rate:
+            self.stats["throttled"] += 1
+            return web.json_response({"code": 429, "msg": "bench: rate limited"}, status=429)
+        if roll < self.throttle_rate + self.error_rate:
+            self.stats["errors"] += 1
+            return web.json_response({"code": 422, "msg": "bench: rejected"}, status=422)
+        body = await request.json()
+        task_id = uuid.uuid4().hex
+        duration = self.latency * random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.tasks[task_id] = {
+            "model": body.get("model"),
+            "created": time.time(),
+            "duration": duration,
+            "done_at": time.monotonic() + duration,
+            "fail": random.random() < self.job_fail_rate,
+        }
+        if body.get("callBackUrl"):
+            t = asyncio.create_task(self._callback(body["callBackUrl"], task_id, duration))
+            self._callbacks.add(t)
+            t.add_done_callback(self._callbacks.discard)
+        return web.json_response({"code": 200, "msg": "success", "data": {"taskId": task_id}})
+
+    async def record_info(self, request: web.Request) -> web.Response:
+        self.stats["recordInfo"] += 1
+        record = self._record(request.query.get("taskId", ""))
+        if record is None:
+            return web.json_response({"code": 404, "msg": "task not found"})
+        return web.json_response({"code": 200, "msg": "success", "data": record})
+
+    async def _callback(self, url: str, task_id: str, delay: float):
+        await asyncio.sleep(delay)
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        try:
+            async with self._session.post(url, json={"code": 200, "data": self._record(task_id)}) as r:
+                self.stats[f"callback_{r.status}"] += 1
+        except aiohttp.ClientError:
+            self.stats["callback_failed"] += 1
+            logging.warning(f"bench KIE: колбэк {task_id} не доставлен")
+
+
+class FakeYooKassa:
+    """
+    YooKassa API v3: POST /v3/payments, GET /v3/payments/{id}, GET /v3/payments?status=.
+    Платёж остаётся pending, пока генератор нагрузки не вызовет settle().
+    """
+
+    def __init__(self):
+        self.payments: Dict[str, dict] = {}
+        self.by_user: Dict[int, str] = {}
+        self.stats: Counter = Counter()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v3/payments", self.create)
+        app.router.add_get("/v3/payments", self.list)
+        app.router.add_get("/v3/payments/{payment_id}", self.get)
+        return app
+
+    def settle(self, payment_id: str, status: str = "succeeded") -> dict:
+        payment = self.payments[payment_id]
+        payment["status"] = status
+        payment["paid"] = status == "succeeded"
+        if payment["paid"]:
+            payment["captured_at"] = _now_iso()
+        return payment
+
+    async def create(self, request: web.Request) -> web.Response:
+        self.stats["create"] += 1
+        body = await request.json()
+        payment_id = str(uuid.uuid4())
+        payment = {
+            "id": payment_id,
+            "status": "pending",
+            "paid": False,
+            "amount": body["amount"],
+            "confirmation": {
+                "type": "redirect",
+                "return_url": (body.get("confirmation") or {}).get("return_url"),
+                "confirmation_url": f"https://yoomoney.bench.invalid/checkout?orderId={payment_id}",
+            },
+            "created_at": _now_iso(),
+            "description": body.get("description", ""),
+            "metadata": body.get("metadata") or {},
+            "recipient": {"account_id": "bench", "gateway_id": "bench"},
+            "refundable": False,
+            "test": True,
+        }
+        self.payments[payment_id] = payment
+        user_id = payment["metadata"].get("user_id")
+        if user_id is not None:
+            self.by_user[int(user_id)] = payment_id
+        return web.json_response(payment)
+
+    async def get(self, request: web.Request) -> web.Response:
+        self.stats["get"] += 1
+        payment = self.payments.get(request.match_info["payment_id"])
+        if payment is None:
+            return web.json_response({"type": "error", "code": "not_found"}, status=404)
+        return web.json_response(payment)
+
+    async def list(self, request: web.Request) -> web.Response:
+        self.stats["list"] += 1
+        status = request.query.get("status")
+        items = [p for p in self.payments.values() if status is None or p["status"] == status]
+        limit = int(request.query.get("limit", "100"))
+        return web.json_response({"type": "list", "items": items[:limit]})
+
+
+async def serve(app: web.Application, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,491 @@
+"""
+Генератор нагрузки: N пользователей проходят /start, пополнение Stars,
+пополнение через YooKassa и мастер создания видео (Text→Video, Sora 2 и Sora 2 Pro)
+против заглушек Bot API, KIE и YooKassa из fakes.py.
+
+Запуск с ботом в дочернем процессе (нужен PostgreSQL, лучше отдельная база):
+
+    python bench/loadgen.py --spawn-bot --database-url postgresql://bench@localhost/bench \\
+        --users 200 --concurrency 50 --kie-latency 20
+
+Без --spawn-bot бот должен быть уже запущен с RUN_MODE=webhook, PUBLIC_BASE_URL=--bot-url
+и TELEGRAM_API_BASE / KIE_API_BASE / YOOKASSA_API_BASE, указывающими на заглушки
+(адреса печатаются при старте).
+
+Отчёт: пропускная способность, задержки шагов глазами пользователя
+(от апдейта до ответа бота) и из /metrics бота — p50/p99 хэндлеров,
+ожидание соединения из пула БД и запаздывание цикла событий.
+"""
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import signal
+import random
+import asyncio
+import argparse
+import subprocess
+from collections import Counter, defaultdict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from fakes import FakeTelegram, FakeKie, FakeYooKassa, serve
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEBHOOK_PATH = "/telegram/webhook"
+YOOKASSA_NOTIFY_PATH = "/yookassa/notify"
+
+Expect = Callable[[str, dict], bool]
+
+
+def sent(method: str, params: dict) -> bool:
+    return method == "sendMessage"
+
+
+def edited(method: str, params: dict) -> bool:
+    return method in ("editMessageText", "editMessageReplyMarkup")
+
+
+def sent_text(fragment: str) -> Expect:
+    return lambda method, params: method == "sendMessage" and fragment in params.get("text", "")
+
+
+def any_call(method: str, params: dict) -> bool:
+    return True
+
+
+class StepFailed(Exception):
+    def __init__(self, step: str, reason: str):
+        super().__init__(f"{step}: {reason}")
+        self.step = step
+        self.reason = reason
+
+
+# ──────────────────────────── Метрики бота ────────────────────────────
+_LINE = re.compile(r'^([a-zA-Z_:][\w:]*)(?:\{(.*)\})?\s+(\S+)$')
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+Samples = Dict[Tuple[str, tuple], float]
+
+
+def parse_metrics(text: str) -> Samples:
+    samples: Samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        m = _LINE.match(line)
+        if m:
+            samples[(m[1], tuple(sorted(_LABEL.findall(m[2] or ""))))] = float(m[3])
+    return samples
+
+
+def histograms(samples: Samples, name: str, by: Optional[str] = None) -> Dict[str, Dict[float, float]]:
+    """Корзины гистограммы name, сложенные по всем сериям (или по значению метки by)"""
+    out: Dict[str, Dict[float, float]] = defaultdict(lambda: defaultdict(float))
+    for (metric, labels), value in samples.items():
+        if metric != f"{name}_bucket":
+            continue
+        d = dict(labels)
+        out[d.get(by, "") if by else ""][float(d["le"])] += value
+    return out
+
+
+def delta(after: Dict[float, float], before: Dict[float, float]) -> Dict[float, float]:
+    return {le: v - before.get(le, 0.0) for le, v in after.items()}
+
+
+def bucket_quantile(buckets: Dict[float, float], q: float) -> Optional[float]:
+    """Квантиль по кумулятивным корзинам с линейной интерполяцией (как histogram_quantile)"""
+    total = buckets.get(float("inf"), 0.0)
+    if total <= 0:
+        return None
+    rank = q * total
+    prev_bound, prev_count = 0.0, 0.0
+    for bound in sorted(buckets):
+        count = buckets[bound]
+        if count >= rank:
+            if bound == float("inf"):
+                return prev_bound
+            return prev_bound + (bound - prev_bound) * (rank - prev_count) / max(count - prev_count, 1e-12)
+        prev_bound, prev_count = bound, count
+    return prev_bound
+
+
+def sample_quantile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def fmt(seconds: Optional[float]) -> str:
+    return "—" if seconds is None else f"{seconds * 1000:.1f} мс"
+
+
+# ──────────────────────────── Пользователи ────────────────────────────
+class Simulation:
+    def __init__(self, args, tg: FakeTelegram, yk: FakeYooKassa, session: aiohttp.ClientSession):
+        self.args = args
+        self.tg = tg
+        self.yk = yk
+        self.session = session
+        self.steps: Dict[str, List[float]] = defaultdict(list)
+        self.outcomes: Counter = Counter()
+        self.failures: Counter = Counter()
+        self.updates = 0
+        self._update_id = 0
+        self._message_id = 10 ** 9
+
+    # апдейты Telegram
+    def _user(self, uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"u{uid}", "language_code": "ru"}
+
+    def _next_update(self, **body) -> dict:
+        self._update_id += 1
+        return {"update_id": self._update_id, **body}
+
+    def message(self, uid: int, text: Optional[str] = None, **extra) -> dict:
+        self._message_id += 1
+        msg = {"message_id": self._message_id, "date": int(time.time()),
+               "chat": {"id": uid, "type": "private"}, "from": self._user(uid), **extra}
+        if text is not None:
+            msg["text"] = text
+            if text.startswith("/"):
+                msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return self._next_update(message=msg)
+
+    def callback(self, uid: int, data: str, message_id: int) -> dict:
+        return self._next_update(callback_query={
+            "id": uuid.uuid4().hex, "from": self._user(uid), "chat_instance": "bench", "data": data,
+            "message": {"message_id": message_id, "date": int(time.time()),
+                        "chat": {"id": uid, "type": "private"}, "from": self.tg.bot_user, "text": "…"},
+        })
+
+    def pre_checkout(self, uid: int, query_id: str, invoice: dict) -> dict:
+        return self._next_update(pre_checkout_query={
+            "id": query_id, "from": self._user(uid), "currency": invoice["currency"],
+            "total_amount": invoice["total_amount"], "invoice_payload": invoice["payload"],
+        })
+
+    def successful_payment(self, uid: int, invoice: dict) -> dict:
+        return self.message(uid, successful_payment={
+            "currency": invoice["currency"], "total_amount": invoice["total_amount"],
+            "invoice_payload": invoice["payload"],
+            "telegram_payment_charge_id": f"bench-{uuid.uuid4().hex}",
+            "provider_payment_charge_id": "",
+        })
+
+    # транспорт
+    async def _post(self, path: str, body: dict, headers: Optional[dict] = None):
+        async with self.session.post(f"{self.args.bot_url}{path}", json=body, headers=headers) as r:
+            if r.status != 200:
+                raise StepFailed(path, f"HTTP {r.status}")
+
+    def update(self, body: dict) -> Callable[[], Awaitable]:
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.args.secret}
+
+        async def send():
+            self.updates += 1
+            await self._post(WEBHOOK_PATH, body, headers)
+        return send
+
+    def yookassa_notify(self, payment_id: str) -> Callable[[], Awaitable]:
+        body = {"type": "notification", "event": "payment.succeeded", "object": {"id": payment_id}}
+        return lambda: self._post(YOOKASSA_NOTIFY_PATH, body)
+
+    async def step(self, name: str, uid: int, send: Optional[Callable[[], Awaitable]], expect: Expect,
+                   key=None, timeout: Optional[float] = None, drain: bool = True,
+                   started: Optional[float] = None) -> Tuple[str, dict, object]:
+        """Отправляет апдейт и ждёт первый подходящий вызов Bot API в этот чат"""
+        inbox = self.tg.inbox(key if key is not None else uid)
+        if drain:
+            while not inbox.empty():
+                inbox.get_nowait()
+        start = started if started is not None else time.perf_counter()
+        if send is not None:
+            await send()
+        deadline = time.perf_counter() + (timeout or self.args.step_timeout)
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise StepFailed(name, "нет ответа")
+            try:
+                method, params, result = await asyncio.wait_for(inbox.get(), remaining)
+            except asyncio.TimeoutError:
+                raise StepFailed(name, "нет ответа") from None
+            if expect(method, params):
+                self.steps[name].append(time.perf_counter() - start)
+                return method, params, result
+
+    async def think(self):
+        if self.args.think:
+            await asyncio.sleep(random.uniform(0, 2 * self.args.think))
+
+    # сценарии
+    async def stars_top_up(self, uid: int):
+        _, _, menu = await self.step("top_up_menu", uid, self.update(self.message(uid, "💳 Пополнить баланс")), sent)
+        await self.think()
+        await self.step("pay_stars", uid, self.update(self.callback(uid, "pay_stars", menu["message_id"])), edited)
+        await self.think()
+        _, invoice, _ = await self.step(
+            "stars_invoice", uid, self.update(self.callback(uid, "stars_60", menu["message_id"])),
+            lambda m, p: m == "sendInvoice"
+        )
+        prices = json.loads(invoice["prices"])
+        invoice = {"currency": invoice["currency"], "payload": invoice["payload"],
+                   "total_amount": sum(int(p["amount"]) for p in prices)}
+        query_id = uuid.uuid4().hex
+        await self.step("pre_checkout", uid, self.update(self.pre_checkout(uid, query_id, invoice)),
+                        any_call, key=f"pcq:{query_id}")
+        await self.step("stars_paid", uid, self.update(self.successful_payment(uid, invoice)),
+                        sent_text("Оплата получена"))
+
+    async def rub_top_up(self, uid: int):
+        _, _, menu = await self.step("top_up_menu", uid, self.update(self.message(uid, "💳 Пополнить баланс")), sent)
+        await self.think()
+        await self.step("pay_rub", uid, self.update(self.callback(uid, "pay_rub", menu["message_id"])), edited)
+        await self.think()
+        _, params, _ = await self.step(
+            "rub_invoice", uid, self.update(self.callback(uid, "rubles_100", menu["message_id"])), edited
+        )
+        payment_id = self.yk.by_user.get(uid)
+        if payment_id is None or "yoomoney" not in params.get("reply_markup", ""):
+            raise StepFailed("rub_invoice", "платёж не создан")
+        self.yk.settle(payment_id)
+        await self.step("rub_paid", uid, self.yookassa_notify(payment_id), sent_text("Оплата"))
+
+    async def create_video(self, uid: int):
+        _, _, menu = await self.step("create_menu", uid, self.update(self.message(uid, "🎬 Создать видео")), sent)
+        mid = menu["message_id"]
+
+        async def choose(step: str, data: str):
+            await self.think()
+            await self.step(step, uid, self.update(self.callback(uid, data, mid)), edited)
+
+        await choose("prompt_type", "ptype_t2v")
+        if random.random() < self.args.pro_share:
+            await choose("tier", "tier_sora2pro")
+            await choose("quality", "qual_std")
+            await choose("quality_next", "quality_next")
+        else:
+            await choose("tier", "tier_sora2")
+        await choose("duration", "duration_10")
+        await choose("orientation", random.choice(("orientation_16_9", "orientation_9_16")))
+        await choose("continue", "continue_video")
+        await self.think()
+        # уникальный промпт — иначе сработает дедупликация одинаковых запросов
+        prompt = f"bench {uid} {uuid.uuid4().hex[:8]}: a cat surfing at sunset"
+        _, _, confirm = await self.step("prompt", uid, self.update(self.message(uid, prompt)), sent)
+        await self.think()
+        submitted = time.perf_counter()
+        _, params, _ = await self.step(
+            "confirm", uid, self.update(self.callback(uid, "confirm_video", confirm["message_id"])),
+            lambda m, p: m == "editMessageText"
+        )
+        if "создаётся" not in params.get("text", ""):
+            self.outcomes["video_rejected"] += 1
+            return
+        method, _, _ = await self.step(
+            "video_e2e", uid, None,
+            lambda m, p: m == "sendVideo" or "возвращены" in p.get("text", ""),
+            timeout=self.args.video_timeout, drain=False, started=submitted
+        )
+        self.outcomes["video_ok" if method == "sendVideo" else "video_refunded"] += 1
+
+    async def run_user(self, uid: int):
+        try:
+            await self.step("start", uid, self.update(self.message(uid, "/start")), sent)
+            await self.stars_top_up(uid)
+            await self.rub_top_up(uid)
+            await self.create_video(uid)
+            self.outcomes["users_ok"] += 1
+        except StepFailed as e:
+            self.outcomes["users_failed"] += 1
+            self.failures[f"{e.step}: {e.reason}"] += 1
+        except aiohttp.ClientError as e:
+            self.outcomes["users_failed"] += 1
+            self.failures[f"http: {type(e).__name__}"] += 1
+
+
+# ──────────────────────────── Запуск ──────────────────────────────────
+def spawn_bot(args) -> subprocess.Popen:
+    bot = urlsplit(args.bot_url)
+    env = dict(
+        os.environ,
+        TOKEN=args.token,
+        RUN_MODE="webhook",
+        PUBLIC_BASE_URL=args.bot_url,
+        HTTP_HOST=bot.hostname,
+        HTTP_PORT=str(bot.port or 80),
+        WEBHOOK_SECRET=args.secret,
+        TELEGRAM_API_BASE=f"http://{args.host}:{args.tg_port}",
+        KIE_API_BASE=f"http://{args.host}:{args.kie_port}",
+        KIE_API_KEY="bench",
+        YOOKASSA_API_BASE=f"http://{args.host}:{args.yk_port}/v3",
+        YOOKASSA_SHOP_ID="bench",
+        YOOKASSA_SECRET_KEY="bench",
+        CHANNEL_ID="-1001000000000",
+        OUTBOX_GLOBAL_RATE=str(args.outbox_rate),
+        DATABASE_URL=args.database_url,
+    )
+    log = open(args.bot_log, "w")
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, "main.py")],
+                            cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_ready(args, session: aiohttp.ClientSession, tg: FakeTelegram,
+                     proc: Optional[subprocess.Popen]):
+    """Бот готов, когда отвечает /metrics и (если мы его запускали) поставил вебхук"""
+    deadline = time.monotonic() + args.ready_timeout
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise SystemExit(f"Бот завершился с кодом {proc.returncode}, см. {args.bot_log}")
+        try:
+            async with session.get(f"{args.bot_url}/metrics") as r:
+                if r.status == 200 and (proc is None or tg.calls["setWebhook"]):
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.5)
+    raise SystemExit("Бот не поднялся за отведённое время")
+
+
+async def scrape(session: aiohttp.ClientSession, bot_url: str) -> Samples:
+    async with session.get(f"{bot_url}/metrics") as r:
+        return parse_metrics(await r.text())
+
+
+def report(sim: Simulation, wall: float, before: Samples, after: Samples,
+           tg: FakeTelegram, kie: FakeKie, yk: FakeYooKassa):
+    print(f"\n══ Итог: {sim.args.users} пользователей за {wall:.1f} с")
+    print(f"Пользователей: успешно {sim.outcomes['users_ok']}, с ошибкой {sim.outcomes['users_failed']}")
+    print(f"Пропускная способность: {sim.outcomes['users_ok'] / wall:.2f} сценариев/с, "
+          f"{sim.updates / wall:.1f} апдейтов/с")
+    print(f"Видео: готово {sim.outcomes['video_ok']}, возврат {sim.outcomes['video_refunded']}, "
+          f"отказ при перегрузке {sim.outcomes['video_rejected']}")
+    for reason, n in sim.failures.most_common(10):
+        print(f"  ✗ {reason} — {n}")
+
+    print("\n── Шаги (от апдейта до ответа бота)")
+    print(f"{'шаг':<16}{'n':>7}{'p50':>14}{'p99':>14}")
+    for name, values in sim.steps.items():
+        print(f"{name:<16}{len(values):>7}{fmt(sample_quantile(values, 0.5)):>14}"
+              f"{fmt(sample_quantile(values, 0.99)):>14}")
+
+    print("\n── Метрики бота за прогон")
+
+    def line(title: str, metric: str):
+        d = delta(histograms(after, metric)[""], histograms(before, metric)[""])
+        n = int(d.get(float("inf"), 0))
+        print(f"{title:<28}n={n:<8}p50={fmt(bucket_quantile(d, 0.5)):<12}p99={fmt(bucket_quantile(d, 0.99))}")
+
+    line("Хэндлеры (все)", "bot_handler_seconds")
+    line("Ожидание пула БД", "bot_db_pool_acquire_seconds")
+    line("Запросы к БД", "bot_db_query_seconds")
+    line("Запаздывание цикла событий", "bot_event_loop_lag_seconds")
+    line("Запросы к Bot API", "bot_telegram_request_seconds")
+    line("Запросы к KIE", "bot_kie_request_seconds")
+
+    handlers_after = histograms(after, "bot_handler_seconds", by="handler")
+    handlers_before = histograms(before, "bot_handler_seconds", by="handler")
+    rows = []
+    for name, buckets in handlers_after.items():
+        d = delta(buckets, handlers_before.get(name, {}))
+        if d.get(float("inf"), 0) > 0:
+            rows.append((bucket_quantile(d, 0.99) or 0.0, name, d))
+    print("\n── Самые медленные хэндлеры (p99)")
+    for p99, name, d in sorted(rows, reverse=True)[:8]:
+        print(f"{name:<28}n={int(d[float('inf')]):<8}p50={fmt(bucket_quantile(d, 0.5)):<12}p99={fmt(p99)}")
+
+    print("\n── Заглушки")
+    print("Bot API: " + ", ".join(f"{k}={v}" for k, v in tg.calls.most_common()))
+    print("KIE: " + ", ".join(f"{k}={v}" for k, v in sorted(kie.stats.items())))
+    print("YooKassa: " + ", ".join(f"{k}={v}" for k, v in sorted(yk.stats.items())))
+
+
+async def run(args):
+    tg = FakeTelegram(latency=args.tg_latency)
+    kie = FakeKie(latency=args.kie_latency, jitter=args.kie_jitter, throttle_rate=args.kie_throttle_rate,
+                  error_rate=args.kie_error_rate, job_fail_rate=args.kie_fail_rate)
+    yk = FakeYooKassa()
+    runners = [await serve(tg.app(), args.host, args.tg_port),
+               await serve(kie.app(), args.host, args.kie_port),
+               await serve(yk.app(), args.host, args.yk_port)]
+    print(f"Заглушки: TELEGRAM_API_BASE=http://{args.host}:{args.tg_port} "
+          f"KIE_API_BASE=http://{args.host}:{args.kie_port} "
+          f"YOOKASSA_API_BASE=http://{args.host}:{args.yk_port}/v3")
+
+    proc = spawn_bot(args) if args.spawn_bot else None
+    connector = aiohttp.TCPConnector(limit=args.concurrency * 2)
+    session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+    try:
+        await wait_ready(args, session, tg, proc)
+        before = await scrape(session, args.bot_url)
+        sim = Simulation(args, tg, yk, session)
+        sem = asyncio.Semaphore(args.concurrency)
+        uid_base = args.uid_base or int(time.time()) * 1000
+
+        async def user(i: int):
+            await asyncio.sleep(args.ramp * i / max(args.users, 1))
+            async with sem:
+                await sim.run_user(uid_base + i)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user(i) for i in range(args.users)))
+        wall = time.perf_counter() - started
+        after = await scrape(session, args.bot_url)
+        report(sim, wall, before, after, tg, kie, yk)
+    finally:
+        await session.close()
+        if proc is not None:
+            proc.send_signal(signal.SIGINT)
+            try:
+                proc.wait(timeout=20)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        for runner in runners:
+            await runner.cleanup()
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Нагрузочный тест бота на заглушках Telegram, KIE и YooKassa")
+    p.add_argument("--users", type=int, default=100, help="сколько пользователей прогнать")
+    p.add_argument("--concurrency", type=int, default=20, help="одновременно активных пользователей")
+    p.add_argument("--ramp", type=float, default=10.0, help="за сколько секунд стартуют все пользователи")
+    p.add_argument("--think", type=float, default=0.2, help="средняя пауза пользователя между шагами, с")
+    p.add_argument("--pro-share", type=float, default=0.3, help="доля заказов Sora 2 Pro")
+    p.add_argument("--step-timeout", type=float, default=15.0, help="ожидание ответа на шаг, с")
+    p.add_argument("--video-timeout", type=float, default=300.0, help="ожидание готового видео, с")
+    p.add_argument("--bot-url", default="http://127.0.0.1:8080", help="HTTP-сервер бота (вебхук, /metrics)")
+    p.add_argument("--secret", default="bench-secret", help="WEBHOOK_SECRET бота")
+    p.add_argument("--uid-base", type=int, default=0, help="первый id пользователя (по умолчанию от времени)")
+    p.add_argument("--host", default="127.0.0.1", help="адрес заглушек")
+    p.add_argument("--tg-port", type=int, default=8081)
+    p.add_argument("--kie-port", type=int, default=8082)
+    p.add_argument("--yk-port", type=int, default=8083)
+    p.add_argument("--tg-latency", type=float, default=0.03, help="задержка ответа Bot API, с")
+    p.add_argument("--kie-latency", type=float, default=20.0, help="среднее время генерации, с")
+    p.add_argument("--kie-jitter", type=float, default=0.3, help="разброс времени генерации (доля)")
+    p.add_argument("--kie-throttle-rate", type=float, default=0.0, help="доля 429 на createTask")
+    p.add_argument("--kie-error-rate", type=float, default=0.0, help="доля окончательных отказов createTask")
+    p.add_argument("--kie-fail-rate", type=float, default=0.0, help="доля задач, завершающихся ошибкой")
+    p.add_argument("--spawn-bot", action="store_true", help="запустить main.py дочерним процессом")
+    p.add_argument("--database-url", default=os.getenv("DATABASE_URL", ""), help="DATABASE_URL для бота")
+    p.add_argument("--token", default="123456:bench-token", help="TOKEN для бота")
+    p.add_argument("--outbox-rate", type=float, default=1000.0,
+                   help="OUTBOX_GLOBAL_RATE бота (лимит Telegram 30/с скрыл бы остальное)")
+    p.add_argument("--bot-log", default="bench-bot.log", help="куда писать вывод бота")
+    p.add_argument("--ready-timeout", type=float, default=60.0)
+    args = p.parse_args(argv)
+    args.bot_url = args.bot_url.rstrip("/")
+    if args.spawn_bot and not args.database_url:
+        p.error("--spawn-bot требует --database-url или DATABASE_URL")
+    return args
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
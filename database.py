@@ -1,106 +1,816 @@
 import asyncpg
 import os
+import json
+import time
+import inspect
+from contextlib import asynccontextmanager
+from datetime import datetime
 from dotenv import load_dotenv
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
+
+from metrics import DB_LATENCY, DB_ERRORS, DB_POOL_WAIT, timed_method
 
 load_dotenv()
 
+# Пул соединений: размер и таймауты настраиваются под нагрузку
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "20"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "30"))           # с, на стороне клиента
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", "15000"))      # мс, на стороне сервера
+DB_IDLE_LIFETIME = float(os.getenv("DB_IDLE_LIFETIME", "300"))              # с, простаивающее соединение
+
+# Таблицы с арендой строк между воркерами: ключ, условие «ещё в работе», отдаваемые колонки
+LEASE_TABLES = {
+    "kie_jobs": (
+        "task_id", "state = 'pending'",
+        "job_id, task_id, user_id, cost, model, params, next_poll_at, attempts, "
+        "COALESCE(started_at, created_at) AS started_at",
+    ),
+    "yookassa_payments": (
+        "payment_id", "status = 'pending'",
+        "payment_id, user_id, rubles, tokens, created_at",
+    ),
+}
+
+# ───── Миграции схемы ─────
+# Каждая применяется один раз и записывается в schema_migrations.
+# Уже применённые миграции не меняются — только новые в конец списка.
+MIGRATIONS: List[Tuple[int, str, str]] = [
+    (1, "users", """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            generations_left INTEGER DEFAULT 0
+        );
+    """),
+    # Задачи KIE в работе (переживают перезапуск бота)
+    (2, "kie_jobs", """
+        CREATE TABLE IF NOT EXISTS kie_jobs (
+            job_id TEXT PRIMARY KEY,
+            task_id TEXT UNIQUE,
+            user_id BIGINT NOT NULL,
+            cost INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            params JSONB NOT NULL DEFAULT '{}'::jsonb,
+            state TEXT NOT NULL DEFAULT 'pending',
+            next_poll_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS kie_jobs_pending_idx
+        ON kie_jobs (next_poll_at) WHERE state = 'pending';
+    """),
+    # Платежи YooKassa, ожидающие подтверждения
+    (3, "yookassa_payments", """
+        CREATE TABLE IF NOT EXISTS yookassa_payments (
+            payment_id TEXT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            rubles INTEGER NOT NULL,
+            tokens INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS yookassa_payments_pending_idx
+        ON yookassa_payments (created_at) WHERE status = 'pending';
+    """),
+    # Состояния FSM aiogram (общие для всех воркеров бота)
+    (4, "fsm_states", """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data JSONB NOT NULL DEFAULT '{}'::jsonb,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS fsm_states_updated_idx ON fsm_states (updated_at);
+    """),
+    # Журнал движения токенов (append-only); ключи идемпотентности — уникальные
+    (5, "token_ledger", """
+        CREATE TABLE IF NOT EXISTS token_ledger (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            delta INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            charge_id TEXT,
+            payment_id TEXT,
+            job_id TEXT,
+            meta JSONB,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS token_ledger_charge_uidx
+        ON token_ledger (charge_id) WHERE charge_id IS NOT NULL;
+        CREATE UNIQUE INDEX IF NOT EXISTS token_ledger_payment_uidx
+        ON token_ledger (payment_id) WHERE payment_id IS NOT NULL;
+        CREATE UNIQUE INDEX IF NOT EXISTS token_ledger_job_uidx
+        ON token_ledger (job_id, reason) WHERE job_id IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS token_ledger_user_idx ON token_ledger (user_id, created_at);
+    """),
+    # Координация воркеров: живые воркеры и аренда фоновых задач
+    (6, "worker_leases", """
+        CREATE TABLE IF NOT EXISTS bot_workers (
+            worker_id TEXT PRIMARY KEY,
+            heartbeat_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        ALTER TABLE kie_jobs
+        ADD COLUMN IF NOT EXISTS owner TEXT,
+        ADD COLUMN IF NOT EXISTS lease_until TIMESTAMPTZ;
+        ALTER TABLE yookassa_payments
+        ADD COLUMN IF NOT EXISTS owner TEXT,
+        ADD COLUMN IF NOT EXISTS lease_until TIMESTAMPTZ;
+    """),
+    # Готовое видео: file_id Telegram для повторной отправки без загрузки
+    (7, "kie_jobs_video", """
+        ALTER TABLE kie_jobs
+        ADD COLUMN IF NOT EXISTS video_url TEXT,
+        ADD COLUMN IF NOT EXISTS video_file_id TEXT,
+        ADD COLUMN IF NOT EXISTS video_meta JSONB;
+        CREATE INDEX IF NOT EXISTS kie_jobs_user_success_idx
+        ON kie_jobs (user_id, created_at DESC) WHERE state = 'success';
+    """),
+    # Дедупликация одинаковых запросов: хэш запроса и присоединившиеся пользователи
+    (8, "kie_jobs_dedup", """
+        ALTER TABLE kie_jobs
+        ADD COLUMN IF NOT EXISTS request_hash TEXT,
+        ADD COLUMN IF NOT EXISTS waiters JSONB NOT NULL DEFAULT '[]'::jsonb;
+        CREATE INDEX IF NOT EXISTS kie_jobs_request_hash_idx
+        ON kie_jobs (request_hash, user_id) WHERE request_hash IS NOT NULL;
+    """),
+    # Очередь перед createTask: строка state = 'queued' без task_id
+    (9, "kie_jobs_queue", """
+        CREATE INDEX IF NOT EXISTS kie_jobs_queued_idx
+        ON kie_jobs (owner) WHERE state = 'queued';
+    """),
+    # Время генерации: от createTask до финального статуса
+    (10, "kie_jobs_timing", """
+        ALTER TABLE kie_jobs
+        ADD COLUMN IF NOT EXISTS started_at TIMESTAMPTZ,
+        ADD COLUMN IF NOT EXISTS finished_at TIMESTAMPTZ;
+        CREATE INDEX IF NOT EXISTS kie_jobs_finished_idx
+        ON kie_jobs (finished_at) WHERE state = 'success';
+    """),
+    # Присоединившийся к чужой задаче — своя строка (state = 'attached') со ссылкой на задачу
+    (11, "kie_jobs_waiter_rows", """
+        ALTER TABLE kie_jobs
+        ADD COLUMN IF NOT EXISTS leader_task_id TEXT;
+        CREATE INDEX IF NOT EXISTS kie_jobs_leader_idx
+        ON kie_jobs (leader_task_id) WHERE leader_task_id IS NOT NULL;
+    """),
+    # Время генерации по часам KIE (createTime → completeTime), а не по моменту, когда заметил опрос
+    (12, "kie_jobs_gen_seconds", """
+        ALTER TABLE kie_jobs
+        ADD COLUMN IF NOT EXISTS gen_seconds REAL;
+    """),
+    # Неудачные задачи: поиск тех, по которым возврат так и не записался
+    (13, "kie_jobs_failed_idx", """
+        CREATE INDEX IF NOT EXISTS kie_jobs_failed_idx
+        ON kie_jobs (updated_at) WHERE state IN ('failed', 'timeout', 'error');
+    """),
+]
+
+# Ключ advisory lock: миграции выполняет только один воркер, остальные ждут
+MIGRATION_LOCK_ID = 0x50A2_0001
+
+# ───── Подготовленные запросы ─────
+# Готовятся один раз на каждое соединение пула (см. _init_connection)
+STATEMENTS: Dict[str, str] = {
+    # пользователи и баланс
+    "get_user": "SELECT user_id, generations_left FROM users WHERE user_id = $1",
+    "create_user": """
+        INSERT INTO users (user_id) VALUES ($1)
+        RETURNING user_id, generations_left
+    """,
+    "ensure_user": "INSERT INTO users (user_id) VALUES ($1) ON CONFLICT (user_id) DO NOTHING",
+    # одна строка в любом случае: только что созданная (created) или уже существующая
+    "upsert_user": """
+        WITH ins AS (
+            INSERT INTO users (user_id) VALUES ($1)
+            ON CONFLICT (user_id) DO NOTHING
+            RETURNING user_id, generations_left, true AS created
+        )
+        SELECT user_id, generations_left, created FROM ins
+        UNION ALL
+        SELECT user_id, generations_left, false FROM users
+        WHERE user_id = $1 AND NOT EXISTS (SELECT 1 FROM ins)
+    """,
+    "update_user_generations": "UPDATE users SET generations_left = $1 WHERE user_id = $2",
+    "has_generations": "SELECT generations_left > 0 FROM users WHERE user_id = $1",
+    "debit": """
+        WITH u AS (
+            UPDATE users SET generations_left = generations_left - $2
+            WHERE user_id = $1 AND generations_left >= $2
+            RETURNING generations_left
+        ), l AS (
+            INSERT INTO token_ledger (user_id, delta, reason, job_id)
+            SELECT $1, -$2, $3, $4 FROM u
+        )
+        SELECT generations_left FROM u
+    """,
+    # пакет: один условный UPDATE баланса на сумму, в журнал — строка на каждый job_id
+    "debit_many": """
+        WITH u AS (
+            UPDATE users SET generations_left = generations_left - $2 * cardinality($4::text[])
+            WHERE user_id = $1 AND generations_left >= $2 * cardinality($4::text[])
+            RETURNING generations_left
+        ), l AS (
+            INSERT INTO token_ledger (user_id, delta, reason, job_id)
+            SELECT $1, -$2, $3, j FROM u, unnest($4::text[]) AS j
+        )
+        SELECT generations_left FROM u
+    """,
+    "credit": """
+        WITH l AS (
+            INSERT INTO token_ledger (user_id, delta, reason, charge_id, payment_id, job_id, meta)
+            SELECT $1, $2, $3, $4, $5, $6, $7
+            WHERE EXISTS (SELECT 1 FROM users WHERE user_id = $1)
+            ON CONFLICT DO NOTHING
+            RETURNING user_id, delta
+        )
+        UPDATE users u SET generations_left = u.generations_left + l.delta
+        FROM l WHERE u.user_id = l.user_id
+        RETURNING u.generations_left
+    """,
+    # задачи KIE
+    "queue_kie_job": """
+        INSERT INTO kie_jobs (job_id, user_id, cost, model, params, owner, request_hash, state)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, 'queued')
+        ON CONFLICT (job_id) DO NOTHING
+    """,
+    "create_kie_job": """
+        INSERT INTO kie_jobs (job_id, task_id, user_id, cost, model, params, next_poll_at,
+                              owner, lease_until, request_hash, started_at)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, now() + make_interval(secs => $9), $10, now())
+        ON CONFLICT (job_id) DO UPDATE
+        SET task_id = EXCLUDED.task_id, state = 'pending', next_poll_at = EXCLUDED.next_poll_at,
+            owner = EXCLUDED.owner, lease_until = EXCLUDED.lease_until, started_at = now(),
+            updated_at = now()
+        WHERE kie_jobs.state = 'queued'
+        RETURNING job_id
+    """,
+    "get_kie_job_state": "SELECT state FROM kie_jobs WHERE job_id = $1",
+    "fail_queued_kie_job": """
+        UPDATE kie_jobs SET state = 'failed', updated_at = now()
+        WHERE job_id = $1 AND state = 'queued'
+    """,
+    "fail_orphaned_kie_jobs": """
+        UPDATE kie_jobs SET state = 'failed', updated_at = now()
+        WHERE state = 'queued' AND (
+            owner IS NULL
+            OR (owner = $1 AND created_at < $2)
+            OR (owner <> $1 AND owner NOT IN (
+                SELECT worker_id FROM bot_workers
+                WHERE heartbeat_at > now() - make_interval(secs => $3)
+            ))
+        )
+        RETURNING job_id, user_id, cost
+    """,
+    # списано по job_id, задача завершилась неудачей, а возврата в журнале нет
+    "get_unrefunded_kie_jobs": """
+        SELECT j.job_id, j.user_id, j.cost
+        FROM kie_jobs j
+        WHERE j.state IN ('failed', 'timeout', 'error')
+          AND j.updated_at > now() - interval '7 days'
+          AND j.updated_at < now() - make_interval(secs => $1)
+          AND EXISTS (SELECT 1 FROM token_ledger l
+                      WHERE l.job_id = j.job_id AND l.reason = 'generation')
+          AND NOT EXISTS (SELECT 1 FROM token_ledger l
+                          WHERE l.job_id = j.job_id AND l.reason = 'refund')
+        ORDER BY j.updated_at
+        LIMIT 100
+    """,
+    "get_kie_job": f"""
+        SELECT {LEASE_TABLES["kie_jobs"][2]}
+        FROM kie_jobs
+        WHERE task_id = $1 AND state = 'pending'
+    """,
+    "update_kie_job_progress": """
+        UPDATE kie_jobs SET attempts = $2, next_poll_at = $3, updated_at = now()
+        WHERE task_id = $1 AND state = 'pending'
+    """,
+    "finish_kie_job": """
+        UPDATE kie_jobs SET state = $2, finished_at = now(), gen_seconds = $3, updated_at = now()
+        WHERE task_id = $1 AND state = 'pending'
+        RETURNING waiters
+    """,
+    "finish_kie_waiters": """
+        UPDATE kie_jobs SET state = $2, finished_at = now(), updated_at = now()
+        WHERE leader_task_id = $1 AND state = 'attached'
+    """,
+    "find_inflight_kie_job": """
+        SELECT task_id, user_id FROM kie_jobs
+        WHERE request_hash = $1 AND state = 'pending'
+        ORDER BY created_at DESC
+        LIMIT 1
+    """,
+    "attach_kie_waiter": """
+        WITH a AS (
+            UPDATE kie_jobs SET waiters = waiters || jsonb_build_array($2::jsonb), updated_at = now()
+            WHERE task_id = $1 AND state = 'pending'
+            RETURNING task_id, model, params, request_hash
+        ), w AS (
+            INSERT INTO kie_jobs (job_id, user_id, cost, model, params, request_hash, state, leader_task_id)
+            SELECT $3, $4, $5, model, params, request_hash, 'attached', task_id FROM a
+            ON CONFLICT (job_id) DO NOTHING
+        )
+        SELECT task_id FROM a
+    """,
+    "find_cached_video": """
+        SELECT job_id FROM kie_jobs
+        WHERE request_hash = $1 AND user_id = $2 AND state = 'success'
+          AND (video_file_id IS NOT NULL OR video_url IS NOT NULL)
+        ORDER BY created_at DESC
+        LIMIT 1
+    """,
+    "save_kie_video": """
+        UPDATE kie_jobs
+        SET video_url = COALESCE($2, video_url),
+            video_file_id = COALESCE($3, video_file_id),
+            video_meta = COALESCE($4, video_meta),
+            updated_at = now()
+        WHERE task_id = $1 OR leader_task_id = $1
+    """,
+    "get_user_videos": """
+        SELECT job_id, task_id, params, video_url, video_file_id, created_at
+        FROM kie_jobs
+        WHERE user_id = $1 AND state = 'success'
+          AND (video_file_id IS NOT NULL OR video_url IS NOT NULL)
+        ORDER BY created_at DESC
+        LIMIT $2
+    """,
+    "get_kie_video": """
+        SELECT job_id, COALESCE(task_id, leader_task_id) AS task_id, user_id, params,
+               video_url, video_file_id, video_meta
+        FROM kie_jobs
+        WHERE job_id = $1 AND state = 'success'
+    """,
+    "completion_percentiles": """
+        SELECT model,
+               COALESCE(params->>'quality', '') AS quality,
+               COALESCE(params->>'duration', '') AS duration,
+               percentile_cont(ARRAY[0.1, 0.5, 0.9]) WITHIN GROUP (
+                   ORDER BY gen_seconds
+               ) AS p
+        FROM kie_jobs
+        WHERE state = 'success' AND gen_seconds IS NOT NULL
+          AND finished_at > now() - make_interval(secs => $1)
+        GROUP BY 1, 2, 3
+        HAVING count(*) >= $2
+    """,
+    # платежи YooKassa
+    "create_yookassa_payment": """
+        INSERT INTO yookassa_payments (payment_id, user_id, rubles, tokens, owner, lease_until)
+        VALUES ($1, $2, $3, $4, $5, now() + make_interval(secs => $6))
+        ON CONFLICT (payment_id) DO NOTHING
+    """,
+    "get_pending_yookassa_payments": f"""
+        SELECT {LEASE_TABLES["yookassa_payments"][2]}
+        FROM yookassa_payments
+        WHERE status = 'pending' AND owner = $1
+        ORDER BY created_at
+    """,
+    "settle_yookassa_payment": """
+        UPDATE yookassa_payments SET status = $2, updated_at = now()
+        WHERE payment_id = $1 AND status = ANY($3::text[])
+        RETURNING payment_id, user_id, rubles, tokens
+    """,
+    # координация воркеров
+    "heartbeat_worker": """
+        WITH hb AS (
+            INSERT INTO bot_workers (worker_id, heartbeat_at) VALUES ($1, now())
+            ON CONFLICT (worker_id) DO UPDATE SET heartbeat_at = now()
+        ), gone AS (
+            DELETE FROM bot_workers WHERE heartbeat_at < now() - interval '1 day'
+        )
+        SELECT count(*) + 1 FROM bot_workers
+        WHERE heartbeat_at > now() - make_interval(secs => $2) AND worker_id <> $1
+    """,
+    "leave_worker": "DELETE FROM bot_workers WHERE worker_id = $1",
+    # состояния FSM
+    "get_fsm": "SELECT state, data FROM fsm_states WHERE key = $1",
+    "delete_fsm": "DELETE FROM fsm_states WHERE key = $1",
+    "save_fsm": """
+        INSERT INTO fsm_states (key, state, data, updated_at)
+        VALUES ($1, $2, $3, now())
+        ON CONFLICT (key) DO UPDATE
+        SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = now()
+    """,
+    "save_fsm_state": """
+        INSERT INTO fsm_states (key, state, updated_at)
+        VALUES ($1, $2, now())
+        ON CONFLICT (key) DO UPDATE SET state = EXCLUDED.state, updated_at = now()
+    """,
+    "save_fsm_data": """
+        INSERT INTO fsm_states (key, data, updated_at)
+        VALUES ($1, $2, now())
+        ON CONFLICT (key) DO UPDATE SET data = EXCLUDED.data, updated_at = now()
+    """,
+    "expire_fsm": """
+        WITH d AS (
+            DELETE FROM fsm_states WHERE updated_at < now() - make_interval(secs => $1)
+            RETURNING 1
+        )
+        SELECT count(*) FROM d
+    """,
+}
+
+# Аренда строк: по запросу на каждую таблицу из LEASE_TABLES
+for _table, (_key, _pending, _columns) in LEASE_TABLES.items():
+    STATEMENTS.update({
+        f"release_all_leases:{_table}":
+            f"UPDATE {_table} SET owner = NULL, lease_until = NULL WHERE owner = $1",
+        f"count_leasable:{_table}": f"SELECT count(*) FROM {_table} WHERE {_pending}",
+        f"renew_leases:{_table}": f"""
+            UPDATE {_table} SET lease_until = now() + make_interval(secs => $2)
+            WHERE owner = $1 AND {_pending}
+            RETURNING {_key}
+        """,
+        f"claim_leases:{_table}": f"""
+            UPDATE {_table} SET owner = $1, lease_until = now() + make_interval(secs => $2)
+            WHERE {_key} IN (
+                SELECT {_key} FROM {_table}
+                WHERE {_pending} AND (owner IS NULL OR lease_until < now())
+                ORDER BY created_at
+                LIMIT $3
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING {_columns}
+        """,
+        f"release_leases:{_table}": f"""
+            UPDATE {_table} SET owner = NULL, lease_until = NULL
+            WHERE owner = $1 AND {_key} = ANY($2::text[])
+        """,
+    })
+
+
+class PreparedConnection(asyncpg.Connection):
+    """Соединение пула с заранее подготовленными запросами из STATEMENTS"""
+    __slots__ = ("statements",)
+
+
 class Database:
+    """
+    Доступ к PostgreSQL. Все запросы — именованные подготовленные выражения,
+    которые создаются один раз на соединение; методы возвращают asyncpg.Record
+    (кортеж с доступом по имени колонки) без копирования в dict.
+    """
+
     def __init__(self):
         self.pool: Optional[asyncpg.Pool] = None
-    
+
     async def connect(self):
         """Подключение к базе данных PostgreSQL"""
         database_url = os.getenv("DATABASE_URL")
         if not database_url:
             raise ValueError("DATABASE_URL не найден в переменных окружения")
-        
+
+        # схему обновляем до создания пула: запросы готовятся уже под неё
+        await self.migrate(database_url)
+
         self.pool = await asyncpg.create_pool(
             database_url,
-            min_size=1,
-            max_size=10,
-            command_timeout=60
+            min_size=DB_POOL_MIN,
+            max_size=DB_POOL_MAX,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            max_inactive_connection_lifetime=DB_IDLE_LIFETIME,
+            server_settings={"statement_timeout": str(DB_STATEMENT_TIMEOUT)},
+            connection_class=PreparedConnection,
+            init=self._init_connection
         )
-        
-        # Создаем таблицы если их нет
-        await self.create_tables()
-    
+
+    @staticmethod
+    async def _init_connection(conn: PreparedConnection):
+        """JSONB читаем и пишем как обычные dict/list; готовим все запросы"""
+        await conn.set_type_codec(
+            "jsonb", encoder=json.dumps, decoder=json.loads, schema="pg_catalog"
+        )
+        conn.statements = {name: await conn.prepare(sql) for name, sql in STATEMENTS.items()}
+
     async def close(self):
         """Закрытие соединения с базой данных"""
         if self.pool:
             await self.pool.close()
-    
-    async def create_tables(self):
-        """Создание таблиц в базе данных"""
-        async with self.pool.acquire() as conn:
-            # Таблица пользователей
+
+    @staticmethod
+    async def migrate(database_url: str):
+        """Применение новых миграций из MIGRATIONS (каждая — в своей транзакции)"""
+        conn = await asyncpg.connect(database_url)
+        try:
+            await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_ID)
             await conn.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    generations_left INTEGER DEFAULT 0
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
                 )
             """)
-    
-    async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
-        """Получение пользователя по ID"""
+            applied = {r[0] for r in await conn.fetch("SELECT version FROM schema_migrations")}
+            for version, name, sql in MIGRATIONS:
+                if version in applied:
+                    continue
+                async with conn.transaction():
+                    await conn.execute(sql)
+                    await conn.execute(
+                        "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+                        version, name
+                    )
+        finally:
+            await conn.close()
+
+    @asynccontextmanager
+    async def _acquire(self):
+        """pool.acquire() с замером ожидания свободного соединения"""
+        start = time.perf_counter()
         async with self.pool.acquire() as conn:
-            row = await conn.fetchrow(
-                "SELECT * FROM users WHERE user_id = $1", user_id
-            )
-            return dict(row) if row else None
-    
-    async def create_user(self, user_id: int) -> Dict[str, Any]:
+            DB_POOL_WAIT.observe(time.perf_counter() - start)
+            yield conn
+
+    async def _fetch(self, name: str, *args) -> List[asyncpg.Record]:
+        async with self._acquire() as conn:
+            return await conn.statements[name].fetch(*args)
+
+    async def _fetchrow(self, name: str, *args) -> Optional[asyncpg.Record]:
+        async with self._acquire() as conn:
+            return await conn.statements[name].fetchrow(*args)
+
+    async def _fetchval(self, name: str, *args) -> Any:
+        async with self._acquire() as conn:
+            return await conn.statements[name].fetchval(*args)
+
+    async def get_user(self, user_id: int) -> Optional[asyncpg.Record]:
+        """Получение пользователя по ID"""
+        return await self._fetchrow("get_user", user_id)
+
+    async def create_user(self, user_id: int) -> asyncpg.Record:
         """Создание нового пользователя"""
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow("""
-                INSERT INTO users (user_id)
-                VALUES ($1)
-                RETURNING *
-            """, user_id)
-            return dict(row)
-    
+        return await self._fetchrow("create_user", user_id)
+
+    async def upsert_user(self, user_id: int) -> asyncpg.Record:
+        """Пользователь с созданием при отсутствии — за один запрос (user_id, generations_left, created)"""
+        row = await self._fetchrow("upsert_user", user_id)
+        if row is None:
+            # строку вставили параллельно и она не попала в снимок запроса — читаем ещё раз
+            row = await self._fetchrow("upsert_user", user_id)
+        return row
+
     async def update_user_generations(self, user_id: int, generations_left: int):
         """Обновление количества генераций пользователя"""
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                "UPDATE users SET generations_left = $1 WHERE user_id = $2",
-                generations_left, user_id
-            )
-    
+        await self._fetch("update_user_generations", generations_left, user_id)
+
+    async def debit(self, user_id: int, amount: int, reason: str = "generation",
+                    job_id: Optional[str] = None) -> Optional[int]:
+        """
+        Атомарное списание одним условным UPDATE вместе с записью в token_ledger.
+        Возвращает новый баланс или None, если токенов не хватает (или пользователя нет).
+        """
+        return await self._fetchval("debit", user_id, amount, reason, job_id)
+
+    async def debit_many(self, user_id: int, amount: int, job_ids: List[str],
+                         reason: str = "generation") -> Optional[int]:
+        """
+        Списание amount за каждый job_id одним условным UPDATE (всё или ничего),
+        в token_ledger — отдельная строка на каждый job_id. Возвращает новый баланс или None.
+        """
+        return await self._fetchval("debit_many", user_id, amount, reason, job_ids)
+
+    @staticmethod
+    async def _credit(conn: PreparedConnection, user_id: int, amount: int, reason: str,
+                      charge_id: Optional[str] = None, payment_id: Optional[str] = None,
+                      job_id: Optional[str] = None, meta: Optional[Dict[str, Any]] = None) -> Optional[int]:
+        return await conn.statements["credit"].fetchval(
+            user_id, amount, reason, charge_id, payment_id, job_id, meta
+        )
+
+    async def credit(self, user_id: int, amount: int, reason: str = "admin",
+                     charge_id: Optional[str] = None, payment_id: Optional[str] = None,
+                     job_id: Optional[str] = None, meta: Optional[Dict[str, Any]] = None) -> Optional[int]:
+        """
+        Атомарное начисление одним запросом вместе с записью в token_ledger.
+        Возвращает новый баланс или None, если пользователя нет или операция
+        с таким charge_id / payment_id / (job_id, reason) уже проведена.
+        """
+        async with self._acquire() as conn:
+            return await self._credit(conn, user_id, amount, reason,
+                                      charge_id, payment_id, job_id, meta)
+
     async def add_generations(self, user_id: int, amount: int):
         """Добавление генераций к балансу пользователя"""
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                "UPDATE users SET generations_left = generations_left + $1 WHERE user_id = $2",
-                amount, user_id
-            )
-    
+        await self.credit(user_id, amount)
+
+    async def apply_star_payment(self, user_id: int, telegram_payment_charge_id: str,
+                                 stars: int, tokens: int, raw_payload: Dict[str, Any]) -> bool:
+        """Идемпотентное зачисление оплаты Stars. False — платёж уже был учтён"""
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                await conn.statements["ensure_user"].fetch(user_id)
+                balance = await self._credit(
+                    conn, user_id, tokens, "stars",
+                    charge_id=telegram_payment_charge_id,
+                    meta={"stars": stars, "payload": raw_payload},
+                )
+                return balance is not None
+
     async def use_generation(self, user_id: int) -> bool:
         """Использование одной генерации. Возвращает True если успешно, False если недостаточно генераций"""
-        async with self.pool.acquire() as conn:
-            # Проверяем есть ли генерации
-            user = await conn.fetchrow(
-                "SELECT generations_left FROM users WHERE user_id = $1", user_id
-            )
-            
-            if not user or user['generations_left'] <= 0:
-                return False
-            
-            # Уменьшаем количество генераций
-            await conn.execute(
-                "UPDATE users SET generations_left = generations_left - 1 WHERE user_id = $1",
-                user_id
-            )
-            return True
-    
-    
+        return await self.debit(user_id, 1) is not None
+
+
     async def has_generations(self, user_id: int) -> bool:
         """Проверка есть ли у пользователя доступные генерации"""
-        async with self.pool.acquire() as conn:
-            user = await conn.fetchrow(
-                "SELECT generations_left FROM users WHERE user_id = $1", user_id
-            )
-            return user and user['generations_left'] > 0
+        return bool(await self._fetchval("has_generations", user_id))
+
+    # ───── Задачи KIE ─────
+    async def queue_kie_job(self, job_id: str, user_id: int, cost: int, model: str,
+                            params: Dict[str, Any], owner: str, request_hash: Optional[str] = None):
+        """Задача ждёт места в очереди перед createTask (токены уже списаны)"""
+        await self._fetch("queue_kie_job", job_id, user_id, cost, model, params, owner, request_hash)
+
+    async def create_kie_job(self, job_id: str, task_id: str, user_id: int, cost: int,
+                             model: str, params: Dict[str, Any], next_poll_at: datetime,
+                             owner: str, lease_seconds: float, request_hash: Optional[str] = None) -> bool:
+        """
+        Запись задачи KIE после получения taskId (сразу в аренде у создавшего воркера).
+        Строка из очереди переводится в работу; False — она уже закрыта как брошенная.
+        """
+        return await self._fetchval("create_kie_job", job_id, task_id, user_id, cost, model, params,
+                                    next_poll_at, owner, float(lease_seconds), request_hash) is not None
+
+    async def get_kie_job_state(self, job_id: str) -> Optional[str]:
+        """Состояние задачи по job_id; None — строки ещё нет (до очереди)"""
+        return await self._fetchval("get_kie_job_state", job_id)
+
+    async def fail_queued_kie_job(self, job_id: str):
+        """Закрытие строки очереди, если createTask так и не удался"""
+        await self._fetch("fail_queued_kie_job", job_id)
+
+    async def fail_orphaned_kie_jobs(self, worker_id: str, started_at: datetime,
+                                     ttl_seconds: float) -> List[asyncpg.Record]:
+        """
+        Закрывает строки очереди, чей воркер мёртв (или это прежний запуск этого воркера).
+        Возвращает их для возврата токенов.
+        """
+        return await self._fetch("fail_orphaned_kie_jobs", worker_id, started_at, float(ttl_seconds))
+
+    async def get_unrefunded_kie_jobs(self, grace_seconds: float) -> List[asyncpg.Record]:
+        """
+        Неудачные задачи (старше grace_seconds), за которые списано, но не возвращено.
+        Только с записью списания в token_ledger — задачи до журнала не трогаем.
+        """
+        return await self._fetch("get_unrefunded_kie_jobs", float(grace_seconds))
+
+    async def get_kie_job(self, task_id: str) -> Optional[asyncpg.Record]:
+        """Незавершённая задача KIE по taskId"""
+        return await self._fetchrow("get_kie_job", task_id)
+
+    async def update_kie_jobs_progress(self, progress: List[Tuple[str, int, datetime]]):
+        """Пакетное сохранение прогресса опроса: (task_id, attempts, next_poll_at)"""
+        if not progress:
+            return
+        async with self._acquire() as conn:
+            await conn.statements["update_kie_job_progress"].executemany(progress)
+
+    async def finish_kie_job(self, task_id: str, state: str,
+                             gen_seconds: Optional[float] = None) -> Optional[List[Dict[str, Any]]]:
+        """
+        Перевод задачи в финальное состояние вместе со строками присоединившихся.
+        Возвращает присоединившихся пользователей (waiters), если задачу завершил
+        именно этот вызов, иначе None.
+        """
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                row = await conn.statements["finish_kie_job"].fetchrow(task_id, state, gen_seconds)
+                if row is None:
+                    return None
+                # отдельным запросом: строки, присоединённые пока ждали блокировку, тоже видны
+                await conn.statements["finish_kie_waiters"].fetch(task_id, state)
+                return list(row["waiters"] or [])
+
+    async def find_inflight_kie_job(self, request_hash: str) -> Optional[asyncpg.Record]:
+        """Задача в работе с тем же хэшем запроса"""
+        return await self._fetchrow("find_inflight_kie_job", request_hash)
+
+    async def attach_kie_waiter(self, task_id: str, waiter: Dict[str, Any]) -> bool:
+        """
+        Присоединение пользователя к задаче в работе: запись в waiters задачи и своя строка
+        (job_id пользователя), по которой видео найдут /my_videos и кэш. False — задача уже завершена
+        """
+        return await self._fetchval("attach_kie_waiter", task_id, waiter, waiter["job_id"],
+                                    waiter["uid"], waiter["cost"]) is not None
+
+    async def find_cached_video(self, user_id: int, request_hash: str) -> Optional[str]:
+        """job_id последнего готового видео пользователя с тем же хэшем запроса"""
+        return await self._fetchval("find_cached_video", request_hash, user_id)
+
+    async def save_kie_video(self, task_id: str, video_url: Optional[str],
+                             file_id: Optional[str], meta: Optional[Dict[str, Any]]):
+        """Сохранение результата задачи: URL KIE и file_id, который вернул Telegram"""
+        await self._fetch("save_kie_video", task_id, video_url, file_id, meta)
+
+    async def get_user_videos(self, user_id: int, limit: int = 10) -> List[asyncpg.Record]:
+        """Последние готовые видео пользователя"""
+        return await self._fetch("get_user_videos", user_id, limit)
+
+    async def get_kie_video(self, job_id: str) -> Optional[asyncpg.Record]:
+        """Готовое видео по job_id"""
+        return await self._fetchrow("get_kie_video", job_id)
+
+    async def get_completion_percentiles(self, window_seconds: float,
+                                         min_samples: int) -> List[asyncpg.Record]:
+        """p10/p50/p90 времени генерации (с) по модели, качеству и длительности"""
+        return await self._fetch("completion_percentiles", float(window_seconds), min_samples)
+
+    # ───── Платежи YooKassa ─────
+    async def create_yookassa_payment(self, payment_id: str, user_id: int, rubles: int, tokens: int,
+                                      owner: str, lease_seconds: float):
+        """Запись созданного платежа YooKassa в ожидании оплаты (в аренде у создавшего воркера)"""
+        await self._fetch("create_yookassa_payment", payment_id, user_id, rubles, tokens,
+                          owner, float(lease_seconds))
+
+    async def get_pending_yookassa_payments(self, owner: str) -> List[asyncpg.Record]:
+        """Платежи воркера owner, по которым ещё нет финального статуса"""
+        return await self._fetch("get_pending_yookassa_payments", owner)
+
+    async def settle_yookassa_payment(self, payment_id: str, status: str) -> Optional[asyncpg.Record]:
+        """
+        Фиксирует финальный статус платежа и при успехе начисляет токены — в одной транзакции.
+        Возвращает строку платежа, если статус сменил именно этот вызов, иначе None (идемпотентно).
+        Успешная оплата принимается и после истечения ожидания (status = 'expired').
+        """
+        from_states = ["pending", "expired"] if status == "succeeded" else ["pending"]
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                row = await conn.statements["settle_yookassa_payment"].fetchrow(
+                    payment_id, status, from_states
+                )
+                if row and status == "succeeded":
+                    await conn.statements["ensure_user"].fetch(row["user_id"])
+                    await self._credit(conn, row["user_id"], row["tokens"], "yookassa",
+                                       payment_id=payment_id, meta={"rubles": row["rubles"]})
+                return row
+
+    # ───── Координация воркеров ─────
+    async def heartbeat_worker(self, worker_id: str, ttl_seconds: float) -> int:
+        """Отметка «воркер жив». Возвращает число живых воркеров (включая этот)"""
+        return await self._fetchval("heartbeat_worker", worker_id, float(ttl_seconds))
+
+    async def leave_worker(self, worker_id: str):
+        """Штатная остановка воркера: снимаем его аренды, чтобы их сразу забрали другие"""
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                for table in LEASE_TABLES:
+                    await conn.statements[f"release_all_leases:{table}"].fetch(worker_id)
+                await conn.statements["leave_worker"].fetch(worker_id)
+
+    async def count_leasable(self, table: str) -> int:
+        """Сколько строк таблицы ещё в работе (делятся между воркерами)"""
+        return await self._fetchval(f"count_leasable:{table}")
+
+    async def renew_leases(self, table: str, worker_id: str, ttl_seconds: float) -> List[str]:
+        """Продлевает аренду всех строк воркера. Возвращает ключи, которые всё ещё за ним"""
+        rows = await self._fetch(f"renew_leases:{table}", worker_id, float(ttl_seconds))
+        return [r[0] for r in rows]
+
+    async def claim_leases(self, table: str, worker_id: str, ttl_seconds: float,
+                           limit: int) -> List[asyncpg.Record]:
+        """Забирает до limit свободных строк или строк с истёкшей арендой (упавшие воркеры)"""
+        if limit <= 0:
+            return []
+        return await self._fetch(f"claim_leases:{table}", worker_id, float(ttl_seconds), limit)
+
+    async def release_leases(self, table: str, worker_id: str, keys: List[str]):
+        """Отдаёт строки обратно в общий пул (ребалансировка)"""
+        if not keys:
+            return
+        await self._fetch(f"release_leases:{table}", worker_id, keys)
+
+    # ───── Состояния FSM ─────
+    async def get_fsm(self, key: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        """Состояние и данные FSM по ключу"""
+        row = await self._fetchrow("get_fsm", key)
+        return (row["state"], row["data"]) if row else (None, {})
+
+    async def save_fsm(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        """Запись состояния и данных FSM; пустая запись удаляется"""
+        if state is None and not data:
+            await self._fetch("delete_fsm", key)
+            return
+        await self._fetch("save_fsm", key, state, data)
+
+    async def save_fsm_state(self, key: str, state: Optional[str]):
+        """Запись только состояния FSM"""
+        await self._fetch("save_fsm_state", key, state)
+
+    async def save_fsm_data(self, key: str, data: Dict[str, Any]):
+        """Запись только данных FSM"""
+        await self._fetch("save_fsm_data", key, data)
+
+    async def expire_fsm(self, ttl_seconds: int) -> int:
+        """Удаление брошенных сессий FSM старше ttl_seconds. Возвращает число удалённых"""
+        return await self._fetchval("expire_fsm", float(ttl_seconds))
+
+# Время и ошибки каждого публичного метода — в метриках
+for _name, _fn in list(vars(Database).items()):
+    if not _name.startswith("_") and inspect.iscoroutinefunction(_fn) \
+            and _name not in ("connect", "close", "migrate"):
+        setattr(Database, _name, timed_method(DB_LATENCY, DB_ERRORS)(_fn))
 
 # Глобальный экземпляр базы данных
 db = Database()
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional, Dict, Any
+
+from aiogram import Dispatcher, BaseMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+
+from database import Database
+
+
+class _Entry:
+    """Закэшированная в рамках одного апдейта запись FSM"""
+    __slots__ = ("state", "data", "dirty")
+
+    def __init__(self, state: Optional[str], data: Dict[str, Any]):
+        self.state = state
+        self.data = data
+        self.dirty = False
+
+
+# Кэш записей текущего апдейта; None — вне апдейта (пишем в БД сразу)
+_scope: ContextVar[Optional[Dict[str, _Entry]]] = ContextVar("fsm_scope", default=None)
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранилище FSM aiogram в PostgreSQL (таблица fsm_states, данные — JSONB)
+    поверх пула из database.py. Позволяет запускать несколько воркеров бота
+    и не терять мастер создания видео при перезапуске.
+
+    Внутри апдейта (см. FSMScopeMiddleware) запись читается из БД один раз,
+    все get_data/update_data идут в локальный кэш, а изменения
+    сбрасываются одной записью по завершении обработки.
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        parts = [key.bot_id, key.chat_id, key.user_id,
+                 getattr(key, "thread_id", None),
+                 getattr(key, "business_connection_id", None),
+                 key.destiny]
+        return ":".join("" if p is None else str(p) for p in parts)
+
+    @staticmethod
+    def _state_name(state: StateType) -> Optional[str]:
+        return state.state if isinstance(state, State) else state
+
+    async def _entry(self, scope: Dict[str, _Entry], k: str) -> _Entry:
+        entry = scope.get(k)
+        if entry is None:
+            state, data = await self.db.get_fsm(k)
+            entry = scope[k] = _Entry(state, dict(data))
+        return entry
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, scope = self._key(key), _scope.get()
+        if scope is None:
+            await self.db.save_fsm_state(k, self._state_name(state))
+            return
+        entry = await self._entry(scope, k)
+        entry.state = self._state_name(state)
+        entry.dirty = True
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        k, scope = self._key(key), _scope.get()
+        if scope is None:
+            state, _ = await self.db.get_fsm(k)
+            return state
+        return (await self._entry(scope, k)).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        k, scope = self._key(key), _scope.get()
+        if scope is None:
+            await self.db.save_fsm_data(k, dict(data))
+            return
+        entry = await self._entry(scope, k)
+        entry.data = dict(data)
+        entry.dirty = True
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        k, scope = self._key(key), _scope.get()
+        if scope is None:
+            _, data = await self.db.get_fsm(k)
+            return dict(data)
+        return dict((await self._entry(scope, k)).data)
+
+    async def close(self) -> None:
+        # пул принадлежит Database и закрывается вместе с ней
+        pass
+
+    @asynccontextmanager
+    async def scope(self):
+        """Кэш на время обработки одного апдейта с отложенной записью"""
+        entries: Dict[str, _Entry] = {}
+        token = _scope.set(entries)
+        try:
+            yield
+        finally:
+            _scope.reset(token)
+            for k, entry in entries.items():
+                if not entry.dirty:
+                    continue
+                try:
+                    await self.db.save_fsm(k, entry.state, entry.data)
+                except Exception:
+                    logging.exception(f"Не удалось сохранить FSM {k}")
+
+    async def expire_loop(self, ttl_seconds: int, interval: int = 600):
+        """Фоновая очистка брошенных сессий мастера"""
+        while True:
+            try:
+                removed = await self.db.expire_fsm(ttl_seconds)
+                if removed:
+                    logging.info(f"FSM: удалено {removed} брошенных сессий")
+            except Exception:
+                logging.exception("Ошибка очистки FSM")
+            await asyncio.sleep(interval)
+
+
+class FSMScopeMiddleware(BaseMiddleware):
+    """Оборачивает обработку апдейта в PostgresStorage.scope()"""
+
+    def __init__(self, storage: PostgresStorage):
+        self.storage = storage
+
+    async def __call__(self, handler, event, data):
+        async with self.storage.scope():
+            return await handler(event, data)
+
+
+def setup_fsm_scope(dp: Dispatcher, storage: PostgresStorage):
+    """
+    Ставит FSMScopeMiddleware перед FSMContextMiddleware диспетчера,
+    чтобы чтение состояния для фильтров тоже шло через кэш апдейта.
+    """
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(FSMScopeMiddleware(storage))
+    dp.update.outer_middleware(dp.fsm)
@@ -0,0 +1,140 @@
+import os
+import hmac
+import time
+import shutil
+import asyncio
+import hashlib
+import logging
+from typing import Tuple
+
+from aiohttp import web
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow не установлен — картинки сохраняются как есть
+    Image = None
+
+
+def target_size(orientation: str | None, tier: str | None, quality: str | None) -> Tuple[int, int]:
+    """Разрешение входной картинки под выбранную ориентацию и модель"""
+    hd = tier == "sora2_pro" and quality == "high"
+    long_side, short_side = (1792, 1024) if hd else (1280, 720)
+    if (orientation or "").strip() == "9:16":
+        return short_side, long_side
+    return long_side, short_side
+
+
+def _prepare_image(src: str, dst: str, size: Tuple[int, int]):
+    """Обрезка по центру под соотношение сторон, уменьшение (без увеличения) и JPEG"""
+    if Image is None:
+        shutil.copyfile(src, dst)
+        return
+    with Image.open(src) as img:
+        # JPEG можно декодировать сразу в уменьшенном масштабе (не меньше нужного)
+        side = max(size)
+        img.draft("RGB", (side, side))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        ratio = size[0] / size[1]
+        if img.width / img.height > ratio:
+            w = round(img.height * ratio)
+            img = img.crop(((img.width - w) // 2, 0, (img.width - w) // 2 + w, img.height))
+        else:
+            h = round(img.width / ratio)
+            img = img.crop((0, (img.height - h) // 2, img.width, (img.height - h) // 2 + h))
+        if img.width > size[0]:
+            img = img.resize(size, Image.LANCZOS)
+        img.save(dst, "JPEG", quality=90, optimize=True)
+
+
+class BlobStore:
+    """
+    Локальное хранилище картинок, адресуемое по содержимому, и выдача
+    их по подписанным короткоживущим ссылкам (для KIE вместо ссылки Telegram с токеном).
+    При нескольких воркерах root должен быть общим томом.
+    """
+
+    def __init__(self, root: str, signing_key: bytes, base_url: str, path_prefix: str = "/blobs"):
+        self.root = root
+        self.signing_key = signing_key
+        self.base_url = base_url.rstrip("/")
+        self.path_prefix = path_prefix
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self.path(name))
+
+    def touch(self, name: str) -> bool:
+        """Продлевает жизнь блоба (GC смотрит на mtime). False — блоба уже нет"""
+        try:
+            os.utime(self.path(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def blob_name(source_hash: str, size: Tuple[int, int]) -> str:
+        return hashlib.sha256(f"{source_hash}:{size[0]}x{size[1]}".encode()).hexdigest() + ".jpg"
+
+    async def put_image(self, src: str, source_hash: str, size: Tuple[int, int]) -> str:
+        """
+        Кладёт подготовленную картинку в хранилище. Повторная та же картинка не обрабатывается,
+        но её блоб «освежается» — иначе GC мог бы удалить его по старому mtime, пока он нужен
+        """
+        name = self.blob_name(source_hash, size)
+        if not self.touch(name):
+            tmp = self.path(f".{name}.{os.getpid()}.tmp")
+            try:
+                await asyncio.to_thread(_prepare_image, src, tmp, size)
+                os.replace(tmp, self.path(name))
+            finally:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+        return name
+
+    def _signature(self, name: str, expires: int) -> str:
+        return hmac.new(self.signing_key, f"{name}:{expires}".encode(), hashlib.sha256).hexdigest()
+
+    def signed_url(self, name: str, ttl: int) -> str:
+        """Подписанная ссылка на ttl секунд; блоб освежается, чтобы GC не удалил его раньше"""
+        self.touch(name)
+        expires = int(time.time()) + ttl
+        return f"{self.base_url}{self.path_prefix}/{name}?exp={expires}&sig={self._signature(name, expires)}"
+
+    def _verify(self, name: str, expires: str, sig: str) -> bool:
+        try:
+            exp = int(expires)
+        except (TypeError, ValueError):
+            return False
+        return exp >= time.time() and hmac.compare_digest(self._signature(name, exp), sig or "")
+
+    async def handler(self, request: web.Request) -> web.StreamResponse:
+        name = request.match_info["name"]
+        if "/" in name or name.startswith(".") or not self._verify(
+            name, request.query.get("exp"), request.query.get("sig")
+        ):
+            return web.Response(status=403)
+        if not self.exists(name):
+            return web.Response(status=404)
+        return web.FileResponse(self.path(name), headers={"Cache-Control": "private, max-age=300"})
+
+    def register(self, app: web.Application):
+        app.router.add_get(f"{self.path_prefix}/{{name}}", self.handler)
+
+    async def gc_loop(self, max_age: int, interval: int = 3600):
+        """Удаление картинок старше max_age секунд"""
+        while True:
+            try:
+                cutoff = time.time() - max_age
+                removed = 0
+                for entry in os.scandir(self.root):
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+                        removed += 1
+                if removed:
+                    logging.info(f"BlobStore: удалено {removed} старых картинок")
+            except Exception:
+                logging.exception("Ошибка очистки BlobStore")
+            await asyncio.sleep(interval)
@@ -0,0 +1,252 @@
+import time
+import asyncio
+import logging
+from typing import NamedTuple, Optional
+
+import aiohttp
+
+from metrics import Histogram
+
+# Ответы KIE «притормозите»: запрос точно не принят, его можно повторить позже.
+# 5xx и таймауты сюда не входят: шлюз мог ответить ошибкой, когда KIE уже принял
+# (и оплатил) задачу — повтор createTask создал бы вторую генерацию
+KIE_THROTTLE_CODES = {429, 455}
+
+
+class KieThrottled(RuntimeError):
+    """KIE ограничивает частоту (429/455) или запрос не ушёл — createTask можно повторить"""
+
+
+class KieUnavailable(KieThrottled):
+    """Предохранитель KIE разомкнут — запрос не отправлялся"""
+
+
+class CircuitBreaker:
+    """
+    Предохранитель перед KIE. В состоянии closed запросы идут как обычно;
+    после threshold сбоев подряд (нет соединения, таймаут, 5xx) он размыкается:
+    новые заказы отклоняются до списания, createTask ждут в очереди допуска,
+    опрос статусов стоит. Через cooldown уходит пробный запрос (half_open):
+    успех замыкает предохранитель, сбой размыкает снова с удвоенной паузой.
+    429 — не сбой: KIE жив, частоту регулирует допуск.
+    """
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, probe, threshold: int, cooldown: float, max_cooldown: float):
+        self.probe = probe
+        self.threshold = max(1, threshold)
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0            # сколько раз размыкался
+        self._probe_at = 0.0
+        self._listeners = []
+        self._probe_task: Optional[asyncio.Task] = None
+
+    @property
+    def closed(self) -> bool:
+        return self.state == self.CLOSED
+
+    def retry_in(self) -> float:
+        """Через сколько секунд следующий пробный запрос"""
+        return 0.0 if self.closed else max(0.0, self._probe_at - time.monotonic())
+
+    def add_listener(self, fn):
+        """fn() вызывается при каждой смене состояния"""
+        self._listeners.append(fn)
+
+    def _set(self, state: str):
+        if state == self.state:
+            return
+        self.state = state
+        for fn in self._listeners:
+            fn()
+
+    def success(self):
+        self.failures = 0
+        if not self.closed:
+            logging.info("KIE снова доступен: предохранитель замкнут")
+            self.cooldown = self.base_cooldown
+            self._set(self.CLOSED)
+
+    def failure(self):
+        self.failures += 1
+        if self.closed and self.failures >= self.threshold:
+            self.opened += 1
+            logging.warning(f"KIE недоступен ({self.failures} сбоев подряд): предохранитель разомкнут")
+            self._open()
+
+    def _open(self):
+        self._probe_at = time.monotonic() + self.cooldown
+        self._set(self.OPEN)
+        if self._probe_task is None or self._probe_task.done():
+            self._probe_task = asyncio.create_task(self._probe_loop())
+
+    async def _probe_loop(self):
+        while not self.closed:
+            await asyncio.sleep(self.retry_in())
+            if self.closed:
+                return
+            self._set(self.HALF_OPEN)
+            try:
+                ok = await self.probe()
+            except Exception:
+                ok = False
+            if ok:
+                self.success()
+            elif not self.closed:
+                self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+                self._probe_at = time.monotonic() + self.cooldown
+                self._set(self.OPEN)
+
+    async def close(self):
+        if self._probe_task:
+            self._probe_task.cancel()
+            await asyncio.gather(self._probe_task, return_exceptions=True)
+
+
+class KieResponse(NamedTuple):
+    """Разобранный ответ KIE: HTTP-статус и поля конверта {code, msg, data}"""
+    status: int
+    code: Optional[int]
+    msg: str
+    data: dict
+
+
+class KieClient:
+    """
+    Долгоживущий HTTP-клиент KIE: одна сессия с пулом keep-alive соединений
+    на все createTask и recordInfo (без TCP/TLS-рукопожатия на каждый запрос),
+    заголовки собраны один раз. Сбои соединения и 5xx учитывает предохранитель.
+    Сессия создаётся в start() и закрывается в close().
+    """
+
+    def __init__(self, base_url: str, api_key: str, *,
+                 limit: int = 100, limit_per_host: int = 50,
+                 keepalive_timeout: float = 60, dns_ttl: int = 300,
+                 create_timeout: float = 120, poll_timeout: float = 30,
+                 breaker_threshold: int = 5, breaker_cooldown: float = 15,
+                 breaker_max_cooldown: float = 300,
+                 latency: Optional[Histogram] = None):
+        base_url = base_url.rstrip("/")
+        self.create_url = f"{base_url}/api/v1/jobs/createTask"
+        self.status_url = f"{base_url}/api/v1/jobs/recordInfo"
+        self.headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_ttl = dns_ttl
+        self.create_timeout = aiohttp.ClientTimeout(total=create_timeout)
+        self.poll_timeout = aiohttp.ClientTimeout(total=poll_timeout)
+        self.latency = latency
+        self.breaker = CircuitBreaker(self.health, breaker_threshold, breaker_cooldown, breaker_max_cooldown)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_ttl,
+            keepalive_timeout=self.keepalive_timeout,
+            enable_cleanup_closed=True,
+        )
+        self._session = aiohttp.ClientSession(connector=connector, headers=self.headers,
+                                              timeout=self.poll_timeout)
+
+    async def close(self):
+        await self.breaker.close()
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            raise RuntimeError("KieClient не запущен: вызовите start()")
+        return self._session
+
+    def _observe(self, op: str, start: float, outcome: str):
+        if self.latency is not None:
+            self.latency.observe(time.perf_counter() - start, op, outcome)
+
+    async def _call(self, method: str, url: str, timeout: aiohttp.ClientTimeout, **kwargs) -> KieResponse:
+        """Запрос с учётом в предохранителе: нет ответа или 5xx — сбой, любой другой ответ — успех"""
+        try:
+            async with self.session.request(method, url, timeout=timeout, **kwargs) as r:
+                status = r.status
+                try:
+                    body = await r.json(content_type=None)
+                except ValueError:
+                    body = None
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.breaker.failure()
+            raise
+        if status >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        if not isinstance(body, dict):
+            body = {}
+        data = body.get("data")
+        return KieResponse(status, body.get("code"), str(body.get("msg") or ""),
+                           data if isinstance(data, dict) else {})
+
+    async def create_task(self, model: str, input: dict, callback_url: Optional[str] = None) -> str:
+        """
+        createTask → taskId. KieThrottled — запрос не принят, его можно повторить
+        (KieUnavailable — даже не отправлялся); остальные исключения, в том числе
+        5xx и таймаут, — окончательный отказ: задача могла создаться, повторять нельзя.
+        """
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            if not self.breaker.closed:
+                outcome = "circuit_open"
+                raise KieUnavailable("KIE createTask: предохранитель разомкнут")
+            payload = {"model": model, "input": input}
+            if callback_url:
+                payload["callBackUrl"] = callback_url
+            try:
+                resp = await self._call("POST", self.create_url, self.create_timeout, json=payload)
+            except aiohttp.ClientConnectorError as e:
+                outcome = "throttled"
+                # запрос не ушёл — повтор безопасен
+                raise KieThrottled(f"KIE createTask: нет соединения: {e}") from e
+            if resp.status in KIE_THROTTLE_CODES or resp.code in KIE_THROTTLE_CODES:
+                outcome = "throttled"
+                raise KieThrottled(f"KIE createTask throttled: status={resp.status}, code={resp.code}, msg={resp.msg}")
+            if resp.status != 200 or resp.code != 200:
+                raise RuntimeError(f"KIE createTask error: status={resp.status}, code={resp.code}, msg={resp.msg}")
+            task_id = resp.data.get("taskId") or resp.data.get("task_id")
+            if not task_id:
+                raise RuntimeError(f"KIE createTask: нет taskId в ответе: {resp}")
+            outcome = "ok"
+            return task_id
+        finally:
+            self._observe("createTask", start, outcome)
+
+    async def record_info(self, task_id: str) -> Optional[dict]:
+        """Запись recordInfo задачи; None — статус сейчас получить не удалось"""
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            resp = await self._call("GET", self.status_url, self.poll_timeout, params={"taskId": task_id})
+            if resp.status != 200 or resp.code != 200:
+                return None
+            outcome = "ok"
+            return resp.data
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+        finally:
+            self._observe("recordInfo", start, outcome)
+
+    async def health(self) -> bool:
+        """Пробный запрос предохранителя: recordInfo несуществующей задачи. Любой ответ не 5xx — KIE жив"""
+        try:
+            async with self.session.get(self.status_url, params={"taskId": "healthcheck"},
+                                        timeout=aiohttp.ClientTimeout(total=10)) as r:
+                return r.status < 500
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
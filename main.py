@@ -1,31 +1,51 @@
 import os
 import json
+import uuid
+import heapq
+import hashlib
+import time
+import math
+import tempfile
+import contextlib
+import socket
+from collections import OrderedDict, deque
+from contextvars import ContextVar
 import asyncio
 import logging
 import aiohttp
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-from typing import Dict, Set, Optional
+from typing import Dict, List, Set, Tuple, Optional
 from aiogram.enums import ChatMemberStatus
 
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
 from aiogram.types import (
     Message, CallbackQuery,
     InlineKeyboardMarkup, InlineKeyboardButton,
     LabeledPrice, PreCheckoutQuery,
-    ReplyKeyboardMarkup, KeyboardButton
+    ReplyKeyboardMarkup, KeyboardButton,
+    FSInputFile, InputFile
 )
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 
 # NEW: перехватываем конкретные исключения aiogram
-from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest, TelegramRetryAfter
-
-# YooKassa (без вебхуков — будем опрашивать статус)
-from yookassa import Configuration, Payment
+from aiogram.exceptions import (
+    TelegramForbiddenError, TelegramBadRequest, TelegramRetryAfter, TelegramNetworkError
+)
 
 from database import db  # ваш модуль Database с глобальным экземпляром db
+from fsm_storage import PostgresStorage, setup_fsm_scope
+from image_store import BlobStore, target_size
+from kie_client import CircuitBreaker, KieClient, KieThrottled, KieUnavailable
+from yookassa_client import YooKassaClient
+from metrics import REGISTRY
 
 # ──────────────────────────── Настройка ───────────────────────────────
 logging.basicConfig(level=logging.INFO)
@@ -34,25 +54,55 @@ load_dotenv()
 TOKEN = os.getenv("TOKEN")
 if not TOKEN:
     raise ValueError("TOKEN не найден в .env")
+# Свой сервер Bot API (локальный telegram-bot-api или заглушка из bench/)
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "").rstrip("/")
 
 # KIE
 KIE_API_BASE = os.getenv("KIE_API_BASE", "https://api.kie.ai")
 KIE_API_KEY = os.getenv("KIE_API_KEY")
 if not KIE_API_KEY:
     raise ValueError("KIE_API_KEY не найден в .env")
-JOBS_CREATE = f"{KIE_API_BASE}/api/v1/jobs/createTask"
-JOBS_STATUS = f"{KIE_API_BASE}/api/v1/jobs/recordInfo"
+
+# Режим работы: polling (по умолчанию) или webhook
+RUN_MODE = os.getenv("RUN_MODE", "polling").lower()
+# Публичный адрес нашего HTTP-сервера (для вебхука Telegram и колбэков KIE)
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")
+HTTP_HOST = os.getenv("HTTP_HOST", "0.0.0.0")
+HTTP_PORT = int(os.getenv("HTTP_PORT", "8080"))
+# HTTP-сервер нужен для вебхуков; в режиме polling — только если задан публичный адрес или порт
+HTTP_ENABLED = RUN_MODE == "webhook" or bool(PUBLIC_BASE_URL) or bool(os.getenv("HTTP_PORT"))
+if RUN_MODE == "webhook" and not PUBLIC_BASE_URL:
+    raise ValueError("RUN_MODE=webhook требует PUBLIC_BASE_URL")
+
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+KIE_CALLBACK_PATH = "/kie/callback"
+# Секрет в URL колбэка, чтобы чужие запросы не завершали наши задачи
+KIE_CALLBACK_SECRET = os.getenv("KIE_CALLBACK_SECRET") or hashlib.sha256(
+    f"kie-callback:{KIE_API_KEY}".encode()
+).hexdigest()[:32]
+KIE_CALLBACKS_ENABLED = bool(PUBLIC_BASE_URL)
 
 # YooKassa
 YOOKASSA_SHOP_ID = os.getenv("YOOKASSA_SHOP_ID")
 YOOKASSA_SECRET_KEY = os.getenv("YOOKASSA_SECRET_KEY")
 YOOKASSA_RETURN_URL = os.getenv("YOOKASSA_RETURN_URL", "https://t.me/your_bot_username")
-if not (YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY):
+YOOKASSA_ENABLED = bool(YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY)
+if not YOOKASSA_ENABLED:
     logging.warning("YooKassa не настроена: нет YOOKASSA_SHOP_ID/YOOKASSA_SECRET_KEY")
-
-if YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY:
-    Configuration.account_id = YOOKASSA_SHOP_ID
-    Configuration.secret_key = YOOKASSA_SECRET_KEY
+# для нагрузочных тестов API подменяется заглушкой (см. bench/)
+YOOKASSA_API_BASE = os.getenv("YOOKASSA_API_BASE", "https://api.yookassa.ru/v3").rstrip("/")
+
+YOOKASSA_NOTIFY_PATH = "/yookassa/notify"
+YOOKASSA_RECONCILE_INTERVAL = int(os.getenv("YOOKASSA_RECONCILE_INTERVAL", "15"))   # с
+YOOKASSA_RECONCILE_CONCURRENCY = int(os.getenv("YOOKASSA_RECONCILE_CONCURRENCY", "5"))
+# запас к началу окна выборки: created_at у YooKassa чуть раньше нашего (часы, время запроса)
+YOOKASSA_LIST_MARGIN = 600   # с
+YOOKASSA_PENDING_TTL = int(os.getenv("YOOKASSA_PENDING_TTL", "3600"))              # с
+# до стольких ожидающих платежей сверяем точечно (get_payment с нарастающей паузой),
+# больше — списком: он стоит столько же при любом числе наших платежей, но растёт с оборотом магазина
+YOOKASSA_LIST_THRESHOLD = int(os.getenv("YOOKASSA_LIST_THRESHOLD", "20"))
+YOOKASSA_CHECK_MAX_INTERVAL = 300   # с, потолок паузы между точечными проверками платежа
 
 # Канал для обязательной подписки
 CHANNEL_ID = int(os.getenv("CHANNEL_ID", "0"))
@@ -65,117 +115,521 @@ def _channel_ref():
 if not _channel_ref():
     logging.warning("⚠️ Проверка подписки включена, но не задан CHANNEL_ID/CHANNEL_USERNAME.")
 
-bot = Bot(token=TOKEN)
-storage = MemoryStorage()
+# Кэш проверки подписки: положительный ответ живёт дольше отрицательного
+SUB_CACHE_TTL_POSITIVE = int(os.getenv("SUB_CACHE_TTL_POSITIVE", "600"))   # с
+SUB_CACHE_TTL_NEGATIVE = int(os.getenv("SUB_CACHE_TTL_NEGATIVE", "30"))    # с
+SUB_CACHE_MAX_SIZE = int(os.getenv("SUB_CACHE_MAX_SIZE", "50000"))
+
+# Несколько воркеров: фоновые задачи (опрос KIE, сверка платежей) делятся арендой строк в БД
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+LEASE_TTL = int(os.getenv("LEASE_TTL", "30"))                     # с
+LEASE_RENEW_INTERVAL = int(os.getenv("LEASE_RENEW_INTERVAL", "10"))  # с
+
+# Хранилище FSM: postgres (по умолчанию, несколько воркеров) или memory
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres").lower()
+FSM_TTL = int(os.getenv("FSM_TTL", str(24 * 3600)))   # брошенные сессии мастера, с
+
+# Картинки для i2v: храним у себя и отдаём KIE по подписанной ссылке (без токена бота в URL).
+# При нескольких воркерах BLOB_DIR должен быть общим томом.
+BLOB_DIR = os.getenv("BLOB_DIR", os.path.join(tempfile.gettempdir(), "sora_blobs"))
+BLOB_SIGNING_KEY = (os.getenv("BLOB_SIGNING_KEY") or hashlib.sha256(
+    f"blobs:{TOKEN}".encode()
+).hexdigest()).encode()
+BLOB_URL_TTL = int(os.getenv("BLOB_URL_TTL", str(2 * 3600)))     # с
+BLOB_MAX_AGE = int(os.getenv("BLOB_MAX_AGE", str(24 * 3600)))    # с
+blob_store: Optional[BlobStore] = None
+if PUBLIC_BASE_URL:
+    blob_store = BlobStore(BLOB_DIR, BLOB_SIGNING_KEY, PUBLIC_BASE_URL)
+else:
+    logging.warning("PUBLIC_BASE_URL не задан: картинки для i2v уходят в KIE ссылкой Telegram")
+
+if TELEGRAM_API_BASE:
+    bot = Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_BASE)))
+else:
+    bot = Bot(token=TOKEN)
+storage = MemoryStorage() if FSM_STORAGE == "memory" else PostgresStorage(db)
 dp = Dispatcher(storage=storage)
+if isinstance(storage, PostgresStorage):
+    setup_fsm_scope(dp, storage)
+
+# ──────────────────────────── Метрики ─────────────────────────────────
+# Выдаются в формате Prometheus на /metrics (см. HTTP-сервер)
+HANDLER_LATENCY = REGISTRY.histogram("bot_handler_seconds", "Время обработки апдейта хэндлером", ("handler",))
+HANDLER_ERRORS = REGISTRY.counter("bot_handler_errors_total", "Исключения в хэндлерах", ("handler",))
+TELEGRAM_LATENCY = REGISTRY.histogram("bot_telegram_request_seconds", "Время запросов к Bot API", ("method",))
+TELEGRAM_RESULTS = REGISTRY.counter("bot_telegram_requests_total", "Запросы к Bot API по исходу", ("method", "outcome"))
+KIE_LATENCY = REGISTRY.histogram("bot_kie_request_seconds", "Время запросов к KIE", ("op", "outcome"))
+YOOKASSA_LATENCY = REGISTRY.histogram("bot_yookassa_request_seconds", "Время запросов к YooKassa", ("op", "outcome"))
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время и ошибки каждого хэндлера (метка — имя функции)"""
+
+    async def __call__(self, handler, event, data):
+        name = getattr(getattr(data.get("handler"), "callback", None), "__name__", "unknown")
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start, name)
+
+for _name, _observer in dp.observers.items():
+    if _name not in ("update", "error"):
+        _observer.middleware(HandlerMetricsMiddleware())
+
+LOOP_LAG = REGISTRY.histogram(
+    "bot_event_loop_lag_seconds", "Запаздывание цикла событий",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+LOOP_LAG_INTERVAL = 0.5   # с
+
+async def loop_lag_monitor():
+    """Насколько позже положенного просыпается sleep: блокирующий код в цикле событий"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(max(0.0, loop.time() - start - LOOP_LAG_INTERVAL))
 
 # Храним id последнего инвойса Stars на пользователя, чтобы удалить его после оплаты
 LAST_INVOICE_MSG: Dict[int, int] = {}
-# Fallback-набор, если в БД нет идемпотентного метода
-APPLIED_CHARGES: Set[str] = set()
 
-# ──────────────────────────── БЕЗОПАСНЫЕ ОБЁРТКИ ──────────────────────
-async def _retry_after_sleep(e: TelegramRetryAfter):
-    try:
-        await asyncio.sleep(max(0, int(e.retry_after)))
-    except Exception:
-        await asyncio.sleep(1)
+# ──────────────────────────── Очередь исходящих ───────────────────────
+# Общий лимит Telegram ~30 сообщений/с на бота и ~1 сообщение/с в один чат
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_CHAT_BURST = 3          # короткая серия в чат (ответ + правка меню) без ожидания
+OUTBOX_CONCURRENCY = 16        # одновременных запросов к Bot API
+OUTBOX_MAX_RETRIES = 3
+OUTBOX_MAX_CHATS = 10000       # размер LRU корзин по чатам
+
+# Классы приоритета: меньше — раньше
+PRIORITY_PAYMENT = 0   # подтверждения оплат, инвойсы
+PRIORITY_RESULT = 1    # готовые видео, возвраты
+PRIORITY_NORMAL = 2    # обычные ответы
+PRIORITY_EDIT = 3      # правки меню
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity"""
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Сколько ждать до появления токена (0 — можно сейчас)"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+class _Outgoing:
+    __slots__ = ("priority", "seq", "chat_id", "call", "futures", "attempts", "key", "kind")
+
+    def __init__(self, priority: int, seq: int, chat_id: int, call, key, kind):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.call = call
+        self.futures: List[asyncio.Future] = []
+        self.attempts = 0
+        self.key = key
+        self.kind = kind
+
+class TelegramOutbox:
+    """
+    Планировщик исходящих запросов к Bot API.
+    Глобальная корзина токенов + корзина на чат, классы приоритета,
+    не больше одного запроса в полёте на чат (порядок FIFO — внутри класса
+    приоритета; сообщение с более высоким приоритетом обгоняет ждущие в том же чате),
+    склейка повторных правок одного сообщения и ограниченные повторы
+    на RetryAfter/сетевых ошибках. Пока запрос ждёт повтора, чат остаётся занят
+    (следующие сообщения не обгоняют его), а новая правка того же сообщения
+    склеивается с ним. Результат — future: Message/True или None.
+    """
 
-async def safe_send_message(bot: Bot, chat_id: int, text: str, **kwargs) -> bool:
-    try:
-        await bot.send_message(chat_id, text, **kwargs)
+    def __init__(self):
+        self._heap: List[Tuple[int, int, _Outgoing]] = []       # готовые к отправке
+        self._deferred: List[Tuple[float, int, _Outgoing]] = []  # ждут корзину чата или RetryAfter
+        self._blocked: Dict[int, List[_Outgoing]] = {}           # ждут завершения запроса в тот же чат
+        self._busy: Set[int] = set()
+        self._held: Dict[int, _Outgoing] = {}                    # чат занят до повтора этого запроса
+        self._pending_keys: Dict[tuple, _Outgoing] = {}
+        self._chat_buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self._global = TokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_RATE)
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._sem = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._heap) + len(self._deferred) + sum(len(v) for v in self._blocked.values())
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, drain_timeout: float = 5.0):
+        """Даём очереди досылаться drain_timeout секунд, затем останавливаем"""
+        deadline = time.monotonic() + drain_timeout
+        while (len(self) or self._busy) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def submit(self, chat_id: int, call, priority: int = PRIORITY_NORMAL,
+               key: tuple | None = None, kind: str | None = None) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        if self._task is None:
+            # очередь не запущена (старт/остановка) — отправляем напрямую
+            item = _Outgoing(priority, 0, chat_id, call, None, kind)
+            item.futures.append(fut)
+            asyncio.create_task(self._execute(item, direct=True))
+            return fut
+        if key is not None:
+            pending = self._pending_keys.get(key)
+            if pending is not None and pending.kind == kind:
+                # ещё не отправленная правка того же сообщения — просто заменяем её
+                pending.call = call
+                pending.priority = min(pending.priority, priority)
+                pending.futures.append(fut)
+                return fut
+        self._seq += 1
+        item = _Outgoing(priority, self._seq, chat_id, call, key, kind)
+        item.futures.append(fut)
+        if key is not None:
+            self._pending_keys[key] = item
+        heapq.heappush(self._heap, (item.priority, item.seq, item))
+        self._wakeup.set()
+        return fut
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST)
+            if len(self._chat_buckets) > OUTBOX_MAX_CHATS:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _pick(self, now: float) -> Optional[_Outgoing]:
+        while self._deferred and self._deferred[0][0] <= now:
+            _, _, item = heapq.heappop(self._deferred)
+            heapq.heappush(self._heap, (item.priority, item.seq, item))
+        while self._heap:
+            _, _, item = heapq.heappop(self._heap)
+            if item.chat_id in self._busy and self._held.get(item.chat_id) is not item:
+                self._blocked.setdefault(item.chat_id, []).append(item)
+                continue
+            wait = self._chat_bucket(item.chat_id).delay(now)
+            if wait > 0:
+                heapq.heappush(self._deferred, (now + wait, item.seq, item))
+                continue
+            return item
+        return None
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            item = self._pick(now)
+            if item is None:
+                timeout = self._deferred[0][0] - now if self._deferred else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            wait = self._global.delay(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self._sem.acquire()
+            now = time.monotonic()
+            self._global.take(now)
+            self._chat_bucket(item.chat_id).take(now)
+            self._busy.add(item.chat_id)
+            self._held.pop(item.chat_id, None)
+            if item.key is not None and self._pending_keys.get(item.key) is item:
+                del self._pending_keys[item.key]
+            asyncio.create_task(self._execute(item))
+
+    def _retry(self, item: _Outgoing, delay: float) -> bool:
+        """
+        Повтор через delay секунд. Чат остаётся занят до отправки повтора,
+        ключ правки снова регистрируется — новая правка заменит устаревшую.
+        False — повторов больше не будет.
+        """
+        item.attempts += 1
+        if item.attempts > OUTBOX_MAX_RETRIES or self._task is None:
+            return False
+        if item.key is not None:
+            newer = self._pending_keys.get(item.key)
+            if newer is not None and newer is not item and newer.kind == item.kind:
+                # пока запрос был в полёте, пришла правка свежее — отправится она
+                newer.futures.extend(item.futures)
+                item.futures = []
+                return False
+            self._pending_keys[item.key] = item
+        self._held[item.chat_id] = item
+        heapq.heappush(self._deferred, (time.monotonic() + delay, item.seq, item))
         return True
-    except TelegramRetryAfter as e:
-        await _retry_after_sleep(e)
+
+    async def _execute(self, item: _Outgoing, direct: bool = False):
+        result = None
+        method = item.kind or "other"
+        outcome = "error"
+        retrying = False
+        start = time.perf_counter()
         try:
-            await bot.send_message(chat_id, text, **kwargs)
-            return True
+            result = await item.call()
+            outcome = "ok"
+            if result is None:
+                result = True
+        except TelegramRetryAfter as e:
+            outcome = "retry_after"
+            if not direct and self._retry(item, max(1, int(e.retry_after))):
+                retrying = True
+                return
+        except (TelegramForbiddenError, TelegramBadRequest):
+            # Например, бот заблокирован или "message is not modified" — молча игнорируем
+            outcome = "rejected"
+        except (TelegramNetworkError, asyncio.TimeoutError):
+            outcome = "network"
+            if not direct and self._retry(item, 2 ** item.attempts):
+                retrying = True
+                return
         except Exception:
-            return False
-    except (TelegramForbiddenError, TelegramBadRequest):
-        return False
-    except Exception:
-        logging.exception("safe_send_message: unexpected")
-        return False
+            logging.exception(f"outbox: unexpected error (chat {item.chat_id})")
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - start, method)
+            TELEGRAM_RESULTS.inc(method, outcome)
+            if not direct:
+                # ждущий повтора запрос держит чат: остальные сообщения чата не обгоняют его
+                if not retrying:
+                    self._busy.discard(item.chat_id)
+                    for blocked in self._blocked.pop(item.chat_id, []):
+                        heapq.heappush(self._heap, (blocked.priority, blocked.seq, blocked))
+                self._sem.release()
+                self._wakeup.set()
+        for fut in item.futures:
+            if not fut.done():
+                fut.set_result(result)
+
+outbox = TelegramOutbox()
 
-async def safe_send_video(bot: Bot, chat_id: int, video: str, **kwargs) -> bool:
-    try:
-        await bot.send_video(chat_id=chat_id, video=video, **kwargs)
+# ──────────────────────────── БЕЗОПАСНЫЕ ОБЁРТКИ ──────────────────────
+# Все запросы идут через outbox. wait=False — поставить в очередь и сразу вернуться.
+async def _via_outbox(chat_id: int, call, priority: int, wait: bool,
+                      key: tuple | None = None, kind: str | None = None):
+    fut = outbox.submit(chat_id, call, priority, key=key, kind=kind)
+    if not wait:
         return True
-    except TelegramRetryAfter as e:
-        await _retry_after_sleep(e)
-        try:
-            await bot.send_video(chat_id=chat_id, video=video, **kwargs)
-            return True
-        except Exception:
-            return False
-    except (TelegramForbiddenError, TelegramBadRequest):
-        return False
-    except Exception:
-        logging.exception("safe_send_video: unexpected")
-        return False
+    return await fut
+
+async def safe_send_message(bot: Bot, chat_id: int, text: str,
+                            priority: int = PRIORITY_NORMAL, wait: bool = False, **kwargs) -> bool:
+    result = await _via_outbox(chat_id, lambda: bot.send_message(chat_id, text, **kwargs), priority, wait,
+                               kind="send_message")
+    return result is not None
+
+async def safe_send_video(bot: Bot, chat_id: int, video: str | InputFile,
+                          priority: int = PRIORITY_RESULT, **kwargs) -> Optional[Message]:
+    result = await _via_outbox(
+        chat_id, lambda: bot.send_video(chat_id=chat_id, video=video, **kwargs), priority, True,
+        kind="send_video"
+    )
+    return result if isinstance(result, Message) else None
 
 async def safe_send_invoice(bot: Bot, **kwargs) -> Optional[Message]:
-    try:
-        return await bot.send_invoice(**kwargs)
-    except TelegramRetryAfter as e:
-        await _retry_after_sleep(e)
-        try:
-            return await bot.send_invoice(**kwargs)
-        except Exception:
-            return None
-    except (TelegramForbiddenError, TelegramBadRequest):
-        return None
-    except Exception:
-        logging.exception("safe_send_invoice: unexpected")
-        return None
+    result = await _via_outbox(kwargs["chat_id"], lambda: bot.send_invoice(**kwargs), PRIORITY_PAYMENT, True,
+                               kind="send_invoice")
+    return result if isinstance(result, Message) else None
 
 async def safe_answer(message: Message, text: str, **kwargs) -> bool:
     return await safe_send_message(message.bot, message.chat.id, text, **kwargs)
 
-async def safe_edit_text(msg: Message, text: str, **kwargs) -> bool:
-    try:
-        await msg.edit_text(text, **kwargs)
-        return True
-    except TelegramRetryAfter as e:
-        await _retry_after_sleep(e)
-        try:
-            await msg.edit_text(text, **kwargs)
-            return True
-        except Exception:
-            return False
-    except (TelegramForbiddenError, TelegramBadRequest):
-        # Например, "message is not modified" или нельзя редактировать — молча игнорируем
-        return False
-    except Exception:
-        logging.exception("safe_edit_text: unexpected")
-        return False
+async def safe_edit_text(msg: Message, text: str,
+                         priority: int = PRIORITY_EDIT, wait: bool = False, **kwargs) -> bool:
+    result = await _via_outbox(
+        msg.chat.id, lambda: msg.edit_text(text, **kwargs), priority, wait,
+        key=(msg.chat.id, msg.message_id), kind="edit_text"
+    )
+    return result is not None
 
-async def safe_edit_reply_markup(msg: Message, **kwargs) -> bool:
-    try:
-        await msg.edit_reply_markup(**kwargs)
-        return True
-    except TelegramRetryAfter as e:
-        await _retry_after_sleep(e)
-        try:
-            await msg.edit_reply_markup(**kwargs)
-            return True
-        except Exception:
-            return False
-    except (TelegramForbiddenError, TelegramBadRequest):
-        return False
-    except Exception:
-        logging.exception("safe_edit_reply_markup: unexpected")
-        return False
+async def safe_edit_reply_markup(msg: Message, priority: int = PRIORITY_EDIT,
+                                 wait: bool = False, **kwargs) -> bool:
+    result = await _via_outbox(
+        msg.chat.id, lambda: msg.edit_reply_markup(**kwargs), priority, wait,
+        key=(msg.chat.id, msg.message_id), kind="edit_reply_markup"
+    )
+    return result is not None
 
 async def safe_delete_message(bot: Bot, chat_id: int, message_id: int) -> bool:
-    try:
-        await bot.delete_message(chat_id=chat_id, message_id=message_id)
-        return True
-    except (TelegramForbiddenError, TelegramBadRequest):
-        return False
-    except Exception:
-        return False
+    result = await _via_outbox(
+        chat_id, lambda: bot.delete_message(chat_id=chat_id, message_id=message_id), PRIORITY_EDIT, False,
+        kind="delete_message"
+    )
+    return result is not None
+
+# ──────────────────────────── Антифлуд ────────────────────────────────
+# Бюджет на пользователя: сообщения и нажатия кнопок считаются отдельно
+FLOOD_MESSAGE_RATE = float(os.getenv("FLOOD_MESSAGE_RATE", "1"))       # в секунду
+FLOOD_MESSAGE_BURST = float(os.getenv("FLOOD_MESSAGE_BURST", "5"))
+FLOOD_CALLBACK_RATE = float(os.getenv("FLOOD_CALLBACK_RATE", "2"))     # в секунду
+FLOOD_CALLBACK_BURST = float(os.getenv("FLOOD_CALLBACK_BURST", "8"))
+FLOOD_MAX_USERS = int(os.getenv("FLOOD_MAX_USERS", "50000"))           # размер LRU
+FLOOD_NOTICE_INTERVAL = 3      # не чаще одного ответа на отброшенные нажатия, с
+
+FLOOD_DROPPED = REGISTRY.counter("bot_flood_dropped_total", "Апдейты, отброшенные антифлудом", ("kind", "reason"))
+
+class _FloodState:
+    __slots__ = ("messages", "callbacks", "inflight", "noticed_at")
+
+    def __init__(self):
+        self.messages = TokenBucket(FLOOD_MESSAGE_RATE, FLOOD_MESSAGE_BURST)
+        self.callbacks = TokenBucket(FLOOD_CALLBACK_RATE, FLOOD_CALLBACK_BURST)
+        self.inflight: Set[tuple] = set()   # сообщения и кнопки, которые сейчас обрабатываются
+        self.noticed_at = 0.0
+
+class FloodControlMiddleware(BaseMiddleware):
+    """
+    Антифлуд первым в цепочке апдейта — до FSM, хэндлеров, БД и Bot API.
+    У каждого активного пользователя две корзины токенов (сообщения и кнопки)
+    в LRU ограниченного размера, проверка — O(1). Апдейт сверх бюджета отбрасывается;
+    повтор того же текста или кнопки, пока первый ещё обрабатывается, склеивается с ним.
+    На отброшенное нажатие — только answerCallbackQuery, не чаще раза в FLOOD_NOTICE_INTERVAL.
+    Оплаты (pre_checkout_query, successful_payment) не ограничиваются.
+    """
+
+    def __init__(self, max_users: int):
+        self.max_users = max_users
+        self._users: "OrderedDict[int, _FloodState]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def _state(self, user_id: int) -> _FloodState:
+        st = self._users.get(user_id)
+        if st is None:
+            st = self._users[user_id] = _FloodState()
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return st
+
+    async def __call__(self, handler, event: types.Update, data):
+        msg, cq = event.message, event.callback_query
+        if msg is not None and msg.from_user and not msg.successful_payment:
+            kind, user_id, key = "message", msg.from_user.id, ("m", msg.text or msg.content_type)
+        elif cq is not None:
+            kind, user_id, key = "callback", cq.from_user.id, ("c", cq.data)
+        else:
+            return await handler(event, data)
+
+        st = self._state(user_id)
+        if key in st.inflight:
+            reason = "duplicate"
+        else:
+            bucket = st.messages if kind == "message" else st.callbacks
+            now = time.monotonic()
+            if bucket.delay(now) > 0:
+                reason = "rate"
+            else:
+                bucket.take(now)
+                st.inflight.add(key)
+                try:
+                    return await handler(event, data)
+                finally:
+                    st.inflight.discard(key)
+
+        FLOOD_DROPPED.inc(kind, reason)
+        if cq is not None:
+            await self._notice(st, cq, reason)
+        return None
+
+    @staticmethod
+    async def _notice(st: _FloodState, cq: CallbackQuery, reason: str):
+        """Снимает «часики» с кнопки; повтор уже обрабатываемой кнопки — без текста"""
+        now = time.monotonic()
+        if now - st.noticed_at < FLOOD_NOTICE_INTERVAL:
+            return
+        st.noticed_at = now
+        with contextlib.suppress(Exception):
+            await bot.answer_callback_query(cq.id, text="⏳ Не так быстро" if reason == "rate" else None)
+
+def setup_flood_control(dp: Dispatcher, middleware: FloodControlMiddleware):
+    """Ставит антифлуд первым среди outer-middleware апдейта, до чтения FSM из БД"""
+    chain = list(dp.update.outer_middleware)
+    for m in chain:
+        dp.update.outer_middleware.unregister(m)
+    dp.update.outer_middleware(middleware)
+    for m in chain:
+        dp.update.outer_middleware(m)
+
+flood_control = FloodControlMiddleware(FLOOD_MAX_USERS)
+setup_flood_control(dp, flood_control)
+
+# ──────────────────────────── Пользователь апдейта ────────────────────
+class UserAccount:
+    """
+    Строка users автора апдейта. Читается при первом load() — сразу с созданием,
+    если её нет (пользователь не нажимал /start), — и дальше в рамках апдейта
+    берётся из памяти. Списания и начисления внутри апдейта обновляют баланс
+    через account_changed().
+    """
+    __slots__ = ("user_id", "balance", "created")
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.balance: Optional[int] = None
+        self.created = False
+
+    async def load(self) -> "UserAccount":
+        if self.balance is None:
+            row = await db.upsert_user(self.user_id)
+            self.balance = row["generations_left"]
+            self.created = self.created or row["created"]
+        return self
+
+# Пользователь текущего апдейта; None — вне апдейта (фоновые задачи, HTTP)
+_account: ContextVar[Optional[UserAccount]] = ContextVar("account", default=None)
+
+def account_changed(user_id: int, balance: Optional[int] = None):
+    """Баланс пользователя изменился: новый баланс или None — перечитать при следующем load()"""
+    account = _account.get()
+    if account is not None and account.user_id == user_id:
+        account.balance = balance
+
+class UserAccountMiddleware(BaseMiddleware):
+    """Кладёт ленивый UserAccount в data["account"] (хэндлеры получают его аргументом account)"""
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or user.is_bot:
+            return await handler(event, data)
+        account = UserAccount(user.id)
+        data["account"] = account
+        token = _account.set(account)
+        try:
+            return await handler(event, data)
+        finally:
+            _account.reset(token)
+
+dp.update.outer_middleware(UserAccountMiddleware())
 
 # ──────────────────────────── Состояния ───────────────────────────────
 class VideoCreationStates(StatesGroup):
@@ -186,11 +640,15 @@ class VideoCreationStates(StatesGroup):
     waiting_for_image = State()
     waiting_for_prompt = State()
     waiting_for_confirmation = State()
+    waiting_for_batch = State()                 # пакет: описания, варианты, ориентации
 
 class BalanceStates(StatesGroup):
     waiting_for_payment_method = State()
 
 def subscribe_keyboard() -> InlineKeyboardMarkup:
+    return keyboards.get("subscribe")
+
+def _build_subscribe_keyboard() -> InlineKeyboardMarkup:
     """
     Две кнопки:
     - Подписаться на канал (URL)
@@ -203,26 +661,84 @@ def subscribe_keyboard() -> InlineKeyboardMarkup:
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-async def is_user_subscribed(user_id: int) -> bool:
+SUBSCRIBED_STATUSES = {
+    ChatMemberStatus.MEMBER,
+    ChatMemberStatus.ADMINISTRATOR,
+    ChatMemberStatus.CREATOR,
+}
+
+class SubscriptionCache:
+    """
+    LRU-кэш результатов get_chat_member по user_id с раздельными TTL
+    для «подписан» и «не подписан». Считает попадания для метрик.
+    """
+
+    def __init__(self, ttl_positive: float, ttl_negative: float, max_size: int):
+        self.ttl_positive = ttl_positive
+        self.ttl_negative = ttl_negative
+        self.max_size = max_size
+        self._items: "OrderedDict[int, Tuple[bool, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int, allow_negative: bool = True) -> Optional[bool]:
+        item = self._items.get(user_id)
+        if item is not None:
+            subscribed, expires_at = item
+            if expires_at > time.monotonic() and (subscribed or allow_negative):
+                self._items.move_to_end(user_id)
+                self.hits += 1
+                return subscribed
+        self.misses += 1
+        return None
+
+    def set(self, user_id: int, subscribed: bool):
+        ttl = self.ttl_positive if subscribed else self.ttl_negative
+        self._items[user_id] = (subscribed, time.monotonic() + ttl)
+        self._items.move_to_end(user_id)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self._items.pop(user_id, None)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+sub_cache = SubscriptionCache(SUB_CACHE_TTL_POSITIVE, SUB_CACHE_TTL_NEGATIVE, SUB_CACHE_MAX_SIZE)
+
+async def is_user_subscribed(user_id: int, allow_negative_cache: bool = True) -> bool:
     """
     True — если пользователь подписан (member/admin/owner).
     ВАЖНО: бот должен быть админом в канале.
+    allow_negative_cache=False — перепроверить, если в кэше «не подписан» (кнопка «Я подписался»).
     """
     chat = _channel_ref()
     if not chat:
         return True  # если канал не задан — пропускаем проверку
+    cached = sub_cache.get(user_id, allow_negative=allow_negative_cache)
+    if cached is not None:
+        return cached
     try:
         member = await bot.get_chat_member(chat_id=chat, user_id=user_id)
-        return member.status in {
-            ChatMemberStatus.MEMBER,
-            ChatMemberStatus.ADMINISTRATOR,
-            ChatMemberStatus.CREATOR,
-        }
+        subscribed = member.status in SUBSCRIBED_STATUSES
+        sub_cache.set(user_id, subscribed)
+        return subscribed
     except Exception as e:
         logging.exception(f"get_chat_member failed: {e}")
-        # на ошибке лучше подстраховаться и не пускать
+        # на ошибке лучше подстраховаться и не пускать (и не кэшировать)
         return False
 
+def _is_our_channel(chat: types.Chat) -> bool:
+    if CHANNEL_ID:
+        return chat.id == CHANNEL_ID
+    return bool(CHANNEL_USERNAME) and (chat.username or "").lower() == CHANNEL_USERNAME.lstrip("@").lower()
+
 # ──────────────────────────── Цены генераций ──────────────────────────
 def calc_cost_credits(tier: str, quality: str | None, duration: int) -> int:
     if tier == "sora2":
@@ -233,6 +749,10 @@ def calc_cost_credits(tier: str, quality: str | None, duration: int) -> int:
         return 90 if duration == 10 else 135
     return 30 if duration == 10 else 35
 
+# Пакетный заказ: описания × варианты × ориентации за одно подтверждение
+BATCH_MAX_JOBS = int(os.getenv("BATCH_MAX_JOBS", "8"))     # видео в одном пакете
+BATCH_MAX_VARIANTS = 4
+
 def duration_price_text(tier: str | None, quality: str | None) -> str:
     if not tier:
         return "Выберите длительность и ориентацию:"
@@ -257,7 +777,7 @@ def duration_price_text(tier: str | None, quality: str | None) -> str:
 def back_btn(data: str) -> InlineKeyboardButton:
     return InlineKeyboardButton(text="🔙 Назад", callback_data=data)
 
-def get_reply_keyboard() -> ReplyKeyboardMarkup:
+def _build_reply_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton(text="🎬 Создать видео")],
@@ -268,7 +788,7 @@ def get_reply_keyboard() -> ReplyKeyboardMarkup:
         input_field_placeholder="Выберите действие…"
     )
 
-def get_prompt_type_keyboard(selected: str | None = None):
+def _build_prompt_type_keyboard(selected: str | None = None):
     t2v = "✅ Текст → Видео" if selected == "t2v" else "Текст → Видео"
     i2v = "✅ Фото → Видео" if selected == "i2v" else "Фото → Видео"
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -277,7 +797,7 @@ def get_prompt_type_keyboard(selected: str | None = None):
         [back_btn("back_to_main")]
     ])
 
-def get_model_tier_keyboard(selected: str | None = None):
+def _build_model_tier_keyboard(selected: str | None = None):
     s2 = "✅ Sora 2" if selected == "sora2" else "Sora 2"
     s2p = "✅ Sora 2 Pro" if selected == "sora2_pro" else "Sora 2 Pro"
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -286,7 +806,7 @@ def get_model_tier_keyboard(selected: str | None = None):
         [back_btn("back_to_prompt_type")]
     ])
 
-def get_quality_keyboard(selected: str | None = None):
+def _build_quality_keyboard(selected: str | None = None):
     std = "✅ Стандарт" if selected == "std" else "Стандарт"
     high = "✅ Высокое" if selected == "high" else "Высокое"
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -296,8 +816,8 @@ def get_quality_keyboard(selected: str | None = None):
         [back_btn("back_to_model_tier")]
     ])
 
-def get_duration_orientation_keyboard(selected_duration: int | None = None,
-                                      selected_orientation: str | None = None):
+def _build_duration_orientation_keyboard(selected_duration: int | None = None,
+                                         selected_orientation: str | None = None):
     d10 = "✅ 10 с" if selected_duration == 10 else "10 с"
     d15 = "✅ 15 с" if selected_duration == 15 else "15 с"
     o916 = "✅ 9:16 (верт.)" if selected_orientation == "9:16" else "9:16"
@@ -311,17 +831,138 @@ def get_duration_orientation_keyboard(selected_duration: int | None = None,
         [back_btn("back_to_quality_or_tier")]
     ])
 
-def get_confirmation_keyboard():
-    return InlineKeyboardMarkup(inline_keyboard=[
+def _build_confirmation_keyboard(has_cached: bool = False):
+    rows = [
         [InlineKeyboardButton(text="✅ Подтвердить", callback_data="confirm_video")],
+        [InlineKeyboardButton(text="📦 Несколько видео", callback_data="batch_video")],
         [InlineKeyboardButton(text="✏️ Изменить", callback_data="change_video")],
         [back_btn("back_to_prompt")]
+    ]
+    if has_cached:
+        rows.insert(0, [InlineKeyboardButton(text="♻️ Прислать готовое (бесплатно)", callback_data="reuse_video")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def _build_batch_keyboard(variants: int = 1, both: bool = False, allow_both: bool = True):
+    rows = [[InlineKeyboardButton(text=f"✅ ×{n}" if n == variants else f"×{n}", callback_data=f"batch_n_{n}")
+             for n in range(1, BATCH_MAX_VARIANTS + 1)]]
+    if allow_both:
+        both_text = "✅ Обе ориентации" if both else "Обе ориентации"
+        rows.append([InlineKeyboardButton(text=both_text, callback_data="batch_both")])
+    rows += [
+        [InlineKeyboardButton(text="🗑 Сбросить описания", callback_data="batch_reset")],
+        [InlineKeyboardButton(text="✅ Подтвердить пакет", callback_data="confirm_batch")],
+        [back_btn("back_to_prompt")]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def _build_top_up_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⭐ Звёзды", callback_data="pay_stars")],
+        [InlineKeyboardButton(text="💵 Рубли (YooKassa)", callback_data="pay_rub")],
+        [back_btn("back_to_main")]
     ])
 
-# ──────────────────────────── Утилиты KIE ─────────────────────────────
-def _kie_headers():
-    return {"Authorization": f"Bearer {KIE_API_KEY}", "Content-Type": "application/json"}
+def _build_star_packs_keyboard():
+    rows = [[InlineKeyboardButton(text=p["title"], callback_data=f"stars_{k}")]
+            for k, p in STAR_PACKS.items()]
+    return InlineKeyboardMarkup(inline_keyboard=rows + [[back_btn("top_up_balance")]])
+
+def _build_rub_packs_keyboard():
+    rows = [[InlineKeyboardButton(text=f"💵 {p['rubles']}₽ → {p['tokens']} токенов", callback_data=f"rubles_{k}")]
+            for k, p in RUB_PACKS.items()]
+    return InlineKeyboardMarkup(inline_keyboard=rows + [[back_btn("top_up_balance")]])
+
+# экраны, где есть только кнопка «Назад»
+BACK_ONLY_TARGETS = ("back_to_duration", "pay_rub")
+
+class KeyboardRegistry:
+    """
+    Все клавиатуры бота, собранные заранее. Вариантов выбора в мастере немного,
+    поэтому каждая комбинация строится один раз и отдаётся общим экземпляром
+    (модели aiogram неизменяемы). После изменения STAR_PACKS / RUB_PACKS
+    или настроек канала нужно вызвать rebuild().
+    """
+
+    def __init__(self):
+        self._items: Dict[tuple, object] = {}
+
+    def rebuild(self):
+        items: Dict[tuple, object] = {
+            ("reply",): _build_reply_keyboard(),
+            ("subscribe",): _build_subscribe_keyboard(),
+            ("top_up",): _build_top_up_keyboard(),
+            ("star_packs",): _build_star_packs_keyboard(),
+            ("rub_packs",): _build_rub_packs_keyboard(),
+        }
+        for selected in (None, "t2v", "i2v"):
+            items[("prompt_type", selected)] = _build_prompt_type_keyboard(selected)
+        for selected in (None, "sora2", "sora2_pro"):
+            items[("model_tier", selected)] = _build_model_tier_keyboard(selected)
+        for selected in (None, "std", "high"):
+            items[("quality", selected)] = _build_quality_keyboard(selected)
+        for duration in (None, 10, 15):
+            for orientation in (None, "9:16", "16:9"):
+                items[("duration_orientation", duration, orientation)] = \
+                    _build_duration_orientation_keyboard(duration, orientation)
+        for has_cached in (False, True):
+            items[("confirmation", has_cached)] = _build_confirmation_keyboard(has_cached)
+        for variants in range(1, BATCH_MAX_VARIANTS + 1):
+            for both in (False, True):
+                for allow_both in (False, True):
+                    items[("batch", variants, both, allow_both)] = \
+                        _build_batch_keyboard(variants, both, allow_both)
+        for target in BACK_ONLY_TARGETS:
+            items[("back", target)] = InlineKeyboardMarkup(inline_keyboard=[[back_btn(target)]])
+        # замена целиком: хэндлеры видят либо старый, либо новый набор
+        self._items = items
+
+    def get(self, *key):
+        if not self._items:
+            self.rebuild()
+        kb = self._items.get(key)
+        if kb is None:
+            # неизвестная отметка (например, старые данные FSM) — вариант без отметок
+            kb = self._items[key[:1] + (None,) * (len(key) - 1)]
+        return kb
+
+keyboards = KeyboardRegistry()
 
+def get_reply_keyboard() -> ReplyKeyboardMarkup:
+    return keyboards.get("reply")
+
+def get_prompt_type_keyboard(selected: str | None = None):
+    return keyboards.get("prompt_type", selected)
+
+def get_model_tier_keyboard(selected: str | None = None):
+    return keyboards.get("model_tier", selected)
+
+def get_quality_keyboard(selected: str | None = None):
+    return keyboards.get("quality", selected)
+
+def get_duration_orientation_keyboard(selected_duration: int | None = None,
+                                      selected_orientation: str | None = None):
+    return keyboards.get("duration_orientation", selected_duration, selected_orientation)
+
+def get_confirmation_keyboard(has_cached: bool = False):
+    return keyboards.get("confirmation", bool(has_cached))
+
+def get_batch_keyboard(variants: int = 1, both: bool = False, allow_both: bool = True):
+    variants = min(max(int(variants or 1), 1), BATCH_MAX_VARIANTS)
+    return keyboards.get("batch", variants, bool(both), bool(allow_both))
+
+def back_keyboard(target: str) -> InlineKeyboardMarkup:
+    return keyboards.get("back", target)
+
+WELCOME_TEXT = (
+    "👋 Привет! Я делаю видео с помощью Sora 2.\n\n"
+    "1️⃣ Тип: Текст→Видео или Фото→Видео\n"
+    "2️⃣ Модель: Sora 2 / Sora 2 Pro (Стандарт/Высокое)\n"
+    "3️⃣ Выбери длительность и ориентацию\n"
+    "4️⃣ Опиши сцену — и готово!\n\n"
+    "💳 Пополнить — внизу (⭐ или 💵). Баланс — «💰 Баланс»."
+)
+
+# ──────────────────────────── Утилиты KIE ─────────────────────────────
 def _map_aspect_ratio(o: str) -> str:
     return "portrait" if o.strip() == "9:16" else "landscape"
 
@@ -337,10 +978,9 @@ def _build_kie_model(ptype: str, tier: str, quality: str | None) -> str:
 
 # ─────────────────────────────── Хэндлеры UI ──────────────────────────
 @dp.message(Command("start"))
-async def cmd_start(message: types.Message):
+async def cmd_start(message: types.Message, account: UserAccount):
     uid = message.from_user.id
-    if not await db.get_user(uid):
-        await db.create_user(uid)
+    await account.load()
 
     # 👇 Проверка подписки
     if not await is_user_subscribed(uid):
@@ -351,22 +991,14 @@ async def cmd_start(message: types.Message):
         )
         return
 
-    text = (
-        "👋 Привет! Я делаю видео с помощью Sora 2.\n\n"
-        "1️⃣ Тип: Текст→Видео или Фото→Видео\n"
-        "2️⃣ Модель: Sora 2 / Sora 2 Pro (Стандарт/Высокое)\n"
-        "3️⃣ Выбери длительность и ориентацию\n"
-        "4️⃣ Опиши сцену — и готово!\n\n"
-        "💳 Пополнить — внизу (⭐ или 💵). Баланс — «💰 Баланс»."
-    )
-    await safe_answer(message, text, reply_markup=get_reply_keyboard())
+    await safe_answer(message, WELCOME_TEXT, reply_markup=get_reply_keyboard())
 
 @dp.message(Command("menu"))
 async def cmd_menu(message: Message):
     await safe_answer(message, "Нижнее меню включено.", reply_markup=get_reply_keyboard())
 
 @dp.message(F.text == "🎬 Создать видео")
-async def menu_create_video(message: Message, state: FSMContext):
+async def menu_create_video(message: Message, state: FSMContext, account: UserAccount):
     uid = message.from_user.id
 
     # 👇 Проверка подписки
@@ -378,37 +1010,39 @@ async def menu_create_video(message: Message, state: FSMContext):
         )
         return
 
-    if not await db.has_generations(uid):
+    if (await account.load()).balance <= 0:
         await safe_answer(message, "❌ У вас нет токенов. Нажмите «💳 Пополнить баланс».")
         return
     await state.set_state(VideoCreationStates.waiting_for_prompt_type)
     await state.update_data(
         prompt_type=None, tier=None, quality=None,
         duration=None, orientation=None,
-        image_url=None, prompt=None, cost=None, kie_model=None
+        image_url=None, image_blob=None, image_key=None, prompt=None, cost=None, kie_model=None,
+        request_hash=None, cached_job_id=None,
+        batch_prompts=None, batch_variants=1, batch_both=False
     )
     await safe_answer(message, "Выберите тип промпта:", reply_markup=get_prompt_type_keyboard())
 
 @dp.callback_query(F.data == "check_sub")
 async def on_check_sub(callback: CallbackQuery, state: FSMContext):
     uid = callback.from_user.id
-    if await is_user_subscribed(uid):
+    if await is_user_subscribed(uid, allow_negative_cache=False):
         await safe_edit_text(callback.message, "Спасибо за подписку! Доступ открыт ✅\nНажмите «🎬 Создать видео».")
-        text = (
-            "👋 Привет! Я делаю видео с помощью Sora 2.\n\n"
-            "1️⃣ Тип: Текст→Видео или Фото→Видео\n"
-            "2️⃣ Модель: Sora 2 / Sora 2 Pro (Стандарт/Высокое)\n"
-            "3️⃣ Выбери длительность и ориентацию\n"
-            "4️⃣ Опиши сцену — и готово!\n\n"
-            "💳 Пополнить — внизу (⭐ или 💵). Баланс — «💰 Баланс»."
-        )
-        await safe_send_message(bot, uid, text, reply_markup=get_reply_keyboard())
+        await safe_send_message(bot, uid, WELCOME_TEXT, reply_markup=get_reply_keyboard())
     else:
         try:
             await callback.answer("Похоже, подписки всё ещё нет 🤔", show_alert=True)
         except Exception:
             pass
 
+# изменения участников канала: сразу обновляем кэш подписки
+@dp.chat_member()
+async def on_channel_member_update(event: types.ChatMemberUpdated):
+    if not _is_our_channel(event.chat):
+        return
+    member = event.new_chat_member
+    sub_cache.set(member.user.id, member.status in SUBSCRIBED_STATUSES)
+
 # назад в «главное»
 @dp.callback_query(F.data == "back_to_main")
 async def back_to_main(callback: CallbackQuery, state: FSMContext):
@@ -526,14 +1160,14 @@ async def cont_video(callback: CallbackQuery, state: FSMContext):
         await safe_edit_text(
             callback.message,
             "📷 Отправьте изображение (как фото, не файл).",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[back_btn("back_to_duration")]])
+            reply_markup=back_keyboard("back_to_duration")
         )
     else:
         await state.set_state(VideoCreationStates.waiting_for_prompt)
         await safe_edit_text(
             callback.message,
             "✍️ Введите описание для видео:",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[back_btn("back_to_duration")]])
+            reply_markup=back_keyboard("back_to_duration")
         )
 
 # назад c prompt/image → к длительности/ориентации
@@ -557,15 +1191,55 @@ async def back_to_duration(callback: CallbackQuery, state: FSMContext):
 async def got_image(message: types.Message, state: FSMContext):
     ph = message.photo[-1]
     file = await bot.get_file(ph.file_id)
-    img_url = f"https://api.telegram.org/file/bot{TOKEN}/{file.file_path}"
-    await state.update_data(image_url=img_url)
+    if blob_store is None:
+        img_url = f"https://api.telegram.org/file/bot{TOKEN}/{file.file_path}"
+        # file_unique_id одинаков для одной и той же картинки — ключ для дедупликации запросов
+        await state.update_data(image_url=img_url, image_key=ph.file_unique_id)
+    else:
+        data = await state.get_data()
+        try:
+            name, digest = await ingest_image(
+                file.file_path,
+                target_size(data.get("orientation"), data.get("tier"), data.get("quality"))
+            )
+        except Exception:
+            logging.exception(f"Не удалось обработать картинку {ph.file_id}")
+            await safe_answer(message, "⚠️ Не удалось обработать картинку. Попробуйте другую.")
+            return
+        # ключ дедупликации — хэш содержимого исходного файла
+        await state.update_data(image_url=None, image_blob=name, image_key=digest)
     await state.set_state(VideoCreationStates.waiting_for_prompt)
     await safe_answer(
         message,
         "✍️ Добавьте описание.",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[back_btn("back_to_duration")]])
+        reply_markup=back_keyboard("back_to_duration")
     )
 
+async def ingest_image(file_path: str, size: Tuple[int, int]) -> Tuple[str, str]:
+    """
+    Скачивает файл из Telegram потоком во временный файл, попутно считая sha256,
+    и кладёт подготовленную картинку в blob_store. Возвращает (имя блоба, хэш исходника).
+    """
+    url = bot.session.api.file_url(bot.token, file_path)
+    sha = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(prefix="i2v_", suffix=os.path.splitext(file_path)[1])
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for chunk in bot.session.stream_content(url, chunk_size=65536):
+                sha.update(chunk)
+                f.write(chunk)
+        digest = sha.hexdigest()
+        return await blob_store.put_image(tmp_path, digest, size), digest
+    finally:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_path)
+
+def _image_url(data: dict) -> str | None:
+    """Ссылка на картинку для KIE: подписанная ссылка на блоб выдаётся в момент отправки"""
+    if data.get("image_blob") and blob_store is not None:
+        return blob_store.signed_url(data["image_blob"], BLOB_URL_TTL)
+    return data.get("image_url")
+
 @dp.message(VideoCreationStates.waiting_for_image)
 async def got_not_image(message: types.Message, state: FSMContext):
     await safe_answer(message, "Пожалуйста, отправьте картинку как _фото_, не файлом.", parse_mode="Markdown")
@@ -579,7 +1253,15 @@ async def prompt_msg(message: types.Message, state: FSMContext):
     data = await state.get_data()
     model = _build_kie_model(data.get("prompt_type"), data.get("tier"), data.get("quality"))
     cost = calc_cost_credits(data.get("tier"), data.get("quality"), data.get("duration"))
-    await state.update_data(kie_model=model, cost=cost)
+    request_hash = _request_hash(
+        model,
+        _input_payload(prompt, data["duration"], data.get("orientation"), _image_url(data),
+                       data.get("tier"), data.get("quality")),
+        data.get("image_key")
+    )
+    cached_job_id = await db.find_cached_video(message.from_user.id, request_hash)
+    await state.update_data(kie_model=model, cost=cost, request_hash=request_hash,
+                            cached_job_id=cached_job_id, batch_prompts=None)
 
     tier_human = "Sora 2 Pro" if data.get("tier") == "sora2_pro" else "Sora 2"
     quality_human = ""
@@ -598,7 +1280,9 @@ async def prompt_msg(message: types.Message, state: FSMContext):
         "",
         f"📝 {prompt}"
     ]
-    await safe_answer(message, "\n".join(info), reply_markup=get_confirmation_keyboard())
+    if cached_job_id:
+        info += ["", "♻️ Такое видео вы уже генерировали — можно получить его бесплатно."]
+    await safe_answer(message, "\n".join(info), reply_markup=get_confirmation_keyboard(bool(cached_job_id)))
 
 # назад с подтверждения → prompt
 @dp.callback_query(F.data == "back_to_prompt")
@@ -607,7 +1291,7 @@ async def back_to_prompt(callback: CallbackQuery, state: FSMContext):
     await safe_edit_text(
         callback.message,
         "✍️ Измените описание:",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[back_btn("back_to_duration")]])
+        reply_markup=back_keyboard("back_to_duration")
     )
 
 # «Изменить» → вернуться к длительности/ориентации
@@ -628,73 +1312,245 @@ async def change_video(callback: CallbackQuery, state: FSMContext):
 
 # подтверждение → проверка баланса, списание, запуск
 @dp.callback_query(F.data == "confirm_video")
-async def confirm_video(callback: CallbackQuery, state: FSMContext):
+async def confirm_video(callback: CallbackQuery, state: FSMContext, account: UserAccount):
     data = await state.get_data()
     uid = callback.from_user.id
-    cost = int(data.get("cost") or 0)
-    user = await db.get_user(uid)
+    # старая кнопка после сброса или истечения FSM — ни списания, ни задачи
+    if not data.get("kie_model") or not data.get("prompt") or not data.get("cost"):
+        await safe_edit_text(callback.message, "⚠️ Заказ устарел. Нажмите «🎬 Создать видео».")
+        await state.clear()
+        return
+    cost = int(data["cost"])
+    request_hash = data.get("request_hash")
+    # один id на списание, задачу KIE и возможный возврат — связывает их в token_ledger
+    job_id = uuid.uuid4().hex
+
+    # тот же запрос этого пользователя уже генерируется (повторное нажатие) — второй раз не списываем
+    inflight = await find_inflight_request(request_hash)
+    if inflight and inflight[0] == uid:
+        await safe_edit_text(callback.message, "⏳ Это видео уже генерируется — пришлём, как только будет готово.")
+        await state.clear()
+        return
+    # очередь в KIE переполнена или KIE недоступен — не списываем, чтобы потом не возвращать
+    if not inflight and admission.overloaded():
+        await safe_edit_text(callback.message, "⏳ Сейчас слишком много заказов. Попробуйте через несколько минут.")
+        return
+    if not inflight and not kie_breaker.closed:
+        await safe_edit_text(callback.message, "⚠️ Сервис генерации временно недоступен. Попробуйте через несколько минут, токены не списаны.")
+        return
 
-    if not user or user["generations_left"] < cost:
-        bal = user["generations_left"] if user else 0
+    # списание ровно cost — одним условным UPDATE
+    balance = await db.debit(uid, cost, job_id=job_id)
+    if balance is None:
+        bal = (await account.load()).balance
         await safe_edit_text(callback.message, f"❌ Недостаточно токенов.\nНужно {cost}, у вас {bal}.")
         await state.clear()
         return
+    account_changed(uid, balance)
+    await state.clear()
 
-    # списание ровно cost
-    await db.update_user_generations(uid, user["generations_left"] - cost)
     await safe_edit_text(callback.message, f"🎬 Видео создаётся…\n💳 Списано {cost} токенов.")
+    # место в KIE ждём вне хэндлера: FSM и антифлуд отпускают пользователя сразу
+    spawn_submission(run_submission(uid, data, cost, job_id))
 
+# готовое видео из кэша вместо новой генерации
+@dp.callback_query(F.data == "reuse_video")
+async def reuse_video(callback: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    uid = callback.from_user.id
+    job_id = data.get("cached_job_id")
+    if job_id and await resend_video(uid, job_id, uid):
+        await safe_edit_text(callback.message, "♻️ Отправили готовое видео. Токены не списаны.")
+        await state.clear()
+        return
     try:
-        await send_to_kie_api(
-            uid,
-            data["kie_model"],
-            data["prompt"],
-            data["duration"],
-            data.get("orientation"),
-            data.get("image_url"),
-            cost,
-            data.get("tier"),
-            data.get("quality"),
-            data.get("prompt_type")
-        )
+        await callback.answer("❌ Видео недоступно, подтвердите новую генерацию.", show_alert=True)
     except Exception:
-        await db.add_generations(uid, cost)  # возврат при исключении
-    finally:
+        pass
+
+# ─────────────── Пакетный заказ ────────────────
+def _batch_jobs(data: dict) -> List[dict]:
+    """Видео пакета: каждое описание × ориентации × варианты"""
+    orientations = [data.get("orientation")]
+    if data.get("batch_both") and data.get("prompt_type") == "t2v":
+        orientations.append("16:9" if orientations[0] == "9:16" else "9:16")
+    variants = int(data.get("batch_variants") or 1)
+    return [
+        {"prompt": prompt, "orientation": orientation, "variant": variant}
+        for prompt in data.get("batch_prompts") or [data.get("prompt")]
+        for orientation in orientations
+        for variant in range(variants)
+    ]
+
+def _batch_text(data: dict) -> str:
+    prompts = data.get("batch_prompts") or []
+    jobs = len(_batch_jobs(data))
+    cost = int(data.get("cost") or 0)
+    orientation = data.get("orientation")
+    if data.get("batch_both") and data.get("prompt_type") == "t2v":
+        orientation = "9:16 и 16:9"
+    info = [
+        "📦 Несколько видео за одно подтверждение.",
+        "Пришлите ещё описания — по одному на строку, каждое станет отдельным видео.",
+        "",
+        f"📝 Описаний: {len(prompts)}",
+    ]
+    info += [f"{i}. {p if len(p) <= 80 else p[:79] + '…'}" for i, p in enumerate(prompts, 1)]
+    info += [
+        f"🔁 Вариантов каждого: {int(data.get('batch_variants') or 1)}",
+        f"📱 Ориентация: {orientation}",
+        f"🎬 Видео: {jobs} (не больше {BATCH_MAX_JOBS})",
+        f"💳 Стоимость: {jobs} × {cost} = {jobs * cost} токенов",
+    ]
+    if jobs > BATCH_MAX_JOBS:
+        info += ["", "⚠️ Слишком много видео — уменьшите число вариантов или сбросьте описания."]
+    return "\n".join(info)
+
+def _batch_keyboard(data: dict):
+    return get_batch_keyboard(data.get("batch_variants"), data.get("batch_both"),
+                              data.get("prompt_type") == "t2v")
+
+# «Несколько видео» на экране подтверждения
+@dp.callback_query(F.data == "batch_video")
+async def batch_video(callback: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    if not data.get("prompt") or not data.get("kie_model"):
+        await safe_edit_text(callback.message, "⚠️ Заказ устарел. Нажмите «🎬 Создать видео».")
         await state.clear()
+        return
+    if not data.get("batch_prompts"):
+        data = await state.update_data(batch_prompts=[data["prompt"]], batch_variants=1, batch_both=False)
+    await state.set_state(VideoCreationStates.waiting_for_batch)
+    await safe_edit_text(callback.message, _batch_text(data), reply_markup=_batch_keyboard(data))
+
+@dp.callback_query(VideoCreationStates.waiting_for_batch, F.data.startswith("batch_n_"))
+async def batch_variants_cb(callback: CallbackQuery, state: FSMContext):
+    n = min(max(int(callback.data.rsplit("_", 1)[1]), 1), BATCH_MAX_VARIANTS)
+    data = await state.update_data(batch_variants=n)
+    await safe_edit_text(callback.message, _batch_text(data), reply_markup=_batch_keyboard(data))
+
+@dp.callback_query(VideoCreationStates.waiting_for_batch, F.data == "batch_both")
+async def batch_both_cb(callback: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    data = await state.update_data(batch_both=not data.get("batch_both"))
+    await safe_edit_text(callback.message, _batch_text(data), reply_markup=_batch_keyboard(data))
+
+@dp.callback_query(VideoCreationStates.waiting_for_batch, F.data == "batch_reset")
+async def batch_reset_cb(callback: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    data = await state.update_data(batch_prompts=[data["prompt"]])
+    await safe_edit_text(callback.message, _batch_text(data), reply_markup=_batch_keyboard(data))
+
+# ещё описания: по одному на строку
+@dp.message(VideoCreationStates.waiting_for_batch, F.text, ~F.text.startswith("/"),
+            ~F.text.in_({"💰 Баланс", "💳 Пополнить баланс"}))
+async def batch_prompts_msg(message: Message, state: FSMContext):
+    data = await state.get_data()
+    prompts = list(data.get("batch_prompts") or [data["prompt"]])
+    # повтор описания — не новое видео (для вариантов есть ×N); сравниваем как _request_hash
+    seen = {" ".join(p.split()) for p in prompts}
+    for line in message.text.splitlines():
+        norm = " ".join(line.split())
+        if norm and norm not in seen:
+            seen.add(norm)
+            prompts.append(norm)
+    data = await state.update_data(batch_prompts=prompts[:BATCH_MAX_JOBS])
+    await safe_answer(message, _batch_text(data), reply_markup=_batch_keyboard(data))
+
+# подтверждение пакета → одно списание, задачи в KIE параллельно (с ограничением)
+@dp.callback_query(VideoCreationStates.waiting_for_batch, F.data == "confirm_batch")
+async def confirm_batch(callback: CallbackQuery, state: FSMContext, account: UserAccount):
+    data = await state.get_data()
+    uid = callback.from_user.id
+    jobs = _batch_jobs(data)
+    cost = int(data.get("cost") or 0)
+    total = cost * len(jobs)
+
+    if len(jobs) > BATCH_MAX_JOBS:
+        try:
+            await callback.answer(f"❌ Не больше {BATCH_MAX_JOBS} видео за раз.", show_alert=True)
+        except Exception:
+            pass
+        return
+    # пакет целиком должен поместиться в очередь KIE — иначе не списываем
+    if len(admission) + len(jobs) > admission.max_queue:
+        await safe_edit_text(callback.message, "⏳ Сейчас слишком много заказов. Попробуйте через несколько минут.")
+        return
+    if not kie_breaker.closed:
+        await safe_edit_text(callback.message, "⚠️ Сервис генерации временно недоступен. Попробуйте через несколько минут, токены не списаны.")
+        return
+
+    # один условный UPDATE баланса на весь пакет, в token_ledger — строка на каждое видео:
+    # у видео свой job_id, по нему и возврат
+    for job in jobs:
+        job["job_id"] = uuid.uuid4().hex
+    balance = await db.debit_many(uid, cost, [job["job_id"] for job in jobs])
+    if balance is None:
+        bal = (await account.load()).balance
+        await safe_edit_text(callback.message, f"❌ Недостаточно токенов.\nНужно {total}, у вас {bal}.")
+        return
+    account_changed(uid, balance)
+    await state.clear()
+
+    await safe_edit_text(
+        callback.message,
+        f"🎬 Создаём {len(jobs)} видео…\n💳 Списано {total} токенов.\n"
+        f"Ролики придут по мере готовности; одновременно генерируется до {KIE_BATCH_CONCURRENCY}."
+    )
+
+    spawn_submission(run_batch(uid, data, jobs, cost))
+
+async def run_batch(uid: int, data: dict, jobs: List[dict], cost: int):
+    """Задачи пакета в KIE: не больше KIE_BATCH_CONCURRENCY одновременно, итог — одним сообщением"""
+    sem = asyncio.Semaphore(KIE_BATCH_CONCURRENCY)
+
+    async def submit(job: dict):
+        job_data = dict(data, prompt=job["prompt"], orientation=job["orientation"], request_hash=None)
+        # одинаковые варианты — разные генерации: склеивать с чужой задачей можно только первый,
+        # и только с задачей другого пользователя — своя уже оплачена отдельно
+        if job["variant"] == 0:
+            with contextlib.suppress(Exception):
+                request_hash = _request_hash(
+                    data["kie_model"],
+                    _input_payload(job["prompt"], data["duration"], job["orientation"], _image_url(data),
+                                   data.get("tier"), data.get("quality")),
+                    data.get("image_key")
+                )
+                inflight = await find_inflight_request(request_hash)
+                if not inflight or inflight[0] != uid:
+                    job_data["request_hash"] = request_hash
+        async with sem:
+            return await run_submission(uid, job_data, cost, job["job_id"], batch=True)
+
+    results = await asyncio.gather(*(submit(job) for job in jobs))
+    failed = len(jobs) - results.count(True)
+    if failed:
+        await safe_send_message(
+            bot, uid,
+            f"❌ Не удалось запустить {failed} из {len(jobs)} видео. "
+            f"Возвращено {results.count(False) * cost} токенов.",
+            priority=PRIORITY_RESULT
+        )
 
 # ─────────────── Баланс и пополнение ────────────────
 @dp.message(F.text == "💰 Баланс")
-async def menu_check_balance(message: Message):
-    uid = message.from_user.id
-    user = await db.get_user(uid)
-    txt = f"💰 Ваш баланс:\n\n🪙 Токенов: {user['generations_left']}" if user else "❌ Пользователь не найден"
-    await safe_answer(message, txt)
+async def menu_check_balance(message: Message, account: UserAccount):
+    await account.load()
+    await safe_answer(message, f"💰 Ваш баланс:\n\n🪙 Токенов: {account.balance}")
 
 @dp.message(F.text == "💳 Пополнить баланс")
 async def menu_top_up_balance(message: Message, state: FSMContext):
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⭐ Звёзды", callback_data="pay_stars")],
-        [InlineKeyboardButton(text="💵 Рубли (YooKassa)", callback_data="pay_rub")],
-        [back_btn("back_to_main")],
-    ])
-    await safe_answer(message, "💳 Выберите способ пополнения:", reply_markup=kb)
+    await safe_answer(message, "💳 Выберите способ пополнения:", reply_markup=keyboards.get("top_up"))
     await state.set_state(BalanceStates.waiting_for_payment_method)
 
 @dp.callback_query(F.data == "check_balance")
-async def check_balance_cb(callback: CallbackQuery):
-    uid = callback.from_user.id
-    user = await db.get_user(uid)
-    txt = f"💰 Ваш баланс:\n\n🪙 Токенов: {user['generations_left']}" if user else "❌ Пользователь не найден"
-    await safe_edit_text(callback.message, txt)
+async def check_balance_cb(callback: CallbackQuery, account: UserAccount):
+    await account.load()
+    await safe_edit_text(callback.message, f"💰 Ваш баланс:\n\n🪙 Токенов: {account.balance}")
 
 @dp.callback_query(F.data == "top_up_balance")
 async def top_up_balance_cb(callback: CallbackQuery, state: FSMContext):
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⭐ Звёзды", callback_data="pay_stars")],
-        [InlineKeyboardButton(text="💵 Рубли (YooKassa)", callback_data="pay_rub")],
-        [back_btn("back_to_main")]
-    ])
-    await safe_edit_text(callback.message, "💳 Выберите способ пополнения:", reply_markup=kb)
+    await safe_edit_text(callback.message, "💳 Выберите способ пополнения:", reply_markup=keyboards.get("top_up"))
     await state.set_state(BalanceStates.waiting_for_payment_method)
 
 # ──────────────────────────── Команда /get_id ────────────────────────────
@@ -724,15 +1580,70 @@ async def cmd_give_tokens(message: types.Message):
         await safe_answer(message, "❌ ID и количество должны быть числами.")
         return
 
-    user = await db.get_user(target_id)
-    if not user:
+    balance = await db.credit(target_id, amount)
+    if balance is None:
         await safe_answer(message, "⚠️ Пользователь с таким ID не найден в базе.")
         return
-
-    await db.add_generations(target_id, amount)
+    account_changed(target_id, balance)
 
     await safe_answer(message, f"✅ Пользователю <b>{target_id}</b> начислено <b>{amount}</b> токенов.", parse_mode="HTML")
-    await safe_send_message(bot, target_id, f"🎁 Вам начислено <b>{amount}</b> токенов администратором.", parse_mode="HTML")
+    await safe_send_message(bot, target_id, f"🎁 Вам начислено <b>{amount}</b> токенов администратором.", parse_mode="HTML", priority=PRIORITY_PAYMENT)
+
+# ──────────────────────────── Мои видео (повторная отправка) ─────────────
+def _video_button_text(row: dict) -> str:
+    params = row["params"] or {}
+    prompt = (params.get("prompt") or "").strip().replace("\n", " ")
+    if len(prompt) > 28:
+        prompt = prompt[:27] + "…"
+    return f"🎬 {row['created_at']:%d.%m %H:%M} · {params.get('duration')} с · {prompt}"
+
+@dp.message(Command("my_videos"))
+async def cmd_my_videos(message: Message):
+    rows = await db.get_user_videos(message.from_user.id, limit=10)
+    if not rows:
+        await safe_answer(message, "У вас пока нет готовых видео.")
+        return
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=_video_button_text(r), callback_data=f"video_{r['job_id']}")]
+        for r in rows
+    ])
+    await safe_answer(message, "🎞 Ваши последние видео — нажмите, чтобы получить ещё раз:", reply_markup=kb)
+
+async def resend_video(chat_id: int, job_id: str, requester_id: int) -> bool:
+    """Повторная отправка готового видео (по file_id, без новой загрузки)"""
+    row = await db.get_kie_video(job_id)
+    if not row or (row["user_id"] != requester_id and requester_id not in ADMIN_IDS):
+        return False
+    msg = await send_job_video(chat_id, row["video_url"], row["video_file_id"], caption="🎬 Готовый ролик")
+    if msg and not row["video_file_id"]:
+        file_id, meta = _video_meta(msg)
+        await db.save_kie_video(row["task_id"], None, file_id, meta)
+    return msg is not None
+
+@dp.callback_query(F.data.startswith("video_"))
+async def resend_video_cb(callback: CallbackQuery):
+    job_id = callback.data.split("_", 1)[1]
+    ok = await resend_video(callback.from_user.id, job_id, callback.from_user.id)
+    try:
+        if ok:
+            await callback.answer()
+        else:
+            await callback.answer("❌ Видео недоступно", show_alert=True)
+    except Exception:
+        pass
+
+@dp.message(Command("video"))
+async def cmd_video(message: types.Message):
+    """Админ: /video job_id — получить видео задачи"""
+    if message.from_user.id not in ADMIN_IDS:
+        await safe_answer(message, "❌ У вас нет прав для использования этой команды.")
+        return
+    parts = message.text.split()
+    if len(parts) != 2:
+        await safe_answer(message, "⚙️ Использование: <code>/video job_id</code>", parse_mode="HTML")
+        return
+    if not await resend_video(message.chat.id, parts[1], message.from_user.id):
+        await safe_answer(message, "⚠️ Видео не найдено.")
 
 # ───── Stars: пакеты 20/60/120/300 → 30/100/200/500 токенов ─────
 STAR_PACKS = {
@@ -744,14 +1655,7 @@ STAR_PACKS = {
 
 @dp.callback_query(F.data == "pay_stars")
 async def pay_stars_cb(callback: CallbackQuery, state: FSMContext):
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=STAR_PACKS["20"]["title"],   callback_data="stars_20")],
-        [InlineKeyboardButton(text=STAR_PACKS["60"]["title"],   callback_data="stars_60")],
-        [InlineKeyboardButton(text=STAR_PACKS["120"]["title"],  callback_data="stars_120")],
-        [InlineKeyboardButton(text=STAR_PACKS["300"]["title"],  callback_data="stars_300")],
-        [back_btn("top_up_balance")]
-    ])
-    await safe_edit_text(callback.message, "⭐ Выберите пакет для пополнения:\nДешево звезды можно купить тут - @cheapiest_star_bot", reply_markup=kb)
+    await safe_edit_text(callback.message, "⭐ Выберите пакет для пополнения:\nДешево звезды можно купить тут - @cheapiest_star_bot", reply_markup=keyboards.get("star_packs"))
 
 @dp.callback_query(F.data.startswith("stars_"))
 async def stars_package_cb(callback: CallbackQuery):
@@ -822,39 +1726,35 @@ async def on_successful_stars_payment(message: Message):
             f"Stars mismatch: declared={pack_stars_declared}, paid={stars_paid}, payload={payload}"
         )
 
-    applied = False
     try:
-        if hasattr(db, "apply_star_payment"):
-            applied = await db.apply_star_payment(
-                user_id=uid,
-                telegram_payment_charge_id=charge_id,
-                stars=stars_paid,
-                tokens=tokens,
-                raw_payload=payload,
-            )
-        else:
-            if charge_id in APPLIED_CHARGES:
-                applied = False
-            else:
-                await db.add_generations(uid, tokens)
-                APPLIED_CHARGES.add(charge_id)
-                applied = True
+        applied = await db.apply_star_payment(
+            user_id=uid,
+            telegram_payment_charge_id=charge_id,
+            stars=stars_paid,
+            tokens=tokens,
+            raw_payload=payload,
+        )
     except Exception:
-        logging.exception("apply_star_payment error")
-        try:
-            await db.add_generations(uid, tokens)
-            applied = True
-        except Exception:
-            logging.exception("add_generations fallback error")
+        logging.exception(f"apply_star_payment error: charge_id={charge_id}")
+        await safe_answer(
+            message,
+            "❌ Не удалось зачислить оплату. Напишите в поддержку и укажите код платежа:\n"
+            f"<code>{charge_id}</code>",
+            parse_mode="HTML",
+            priority=PRIORITY_PAYMENT
+        )
+        return
+    account_changed(uid)
 
     if applied:
         await safe_answer(
             message,
             f"✅ Оплата получена: {stars_paid} ⭐\n"
-            f"🪙 Начислено: {tokens} токенов\nСпасибо! 🎉"
+            f"🪙 Начислено: {tokens} токенов\nСпасибо! 🎉",
+            priority=PRIORITY_PAYMENT
         )
     else:
-        await safe_answer(message, "ℹ️ Этот платёж уже был учтён ранее.")
+        await safe_answer(message, "ℹ️ Этот платёж уже был учтён ранее.", priority=PRIORITY_PAYMENT)
 
     # Удаляем чек (текущее сообщение) и инвойс Stars
     await safe_delete_message(bot, message.chat.id, message.message_id)
@@ -862,7 +1762,7 @@ async def on_successful_stars_payment(message: Message):
     if mid:
         await safe_delete_message(bot, message.chat.id, mid)
 
-# ───── YooKassa: Рубли без вебхуков (поллинг статуса) ─────
+# ───── YooKassa: Рубли (уведомления + фоновая сверка) ─────
 RUB_PACKS = {
     "30":  {"rubles": 30,  "tokens": 30},
     "100": {"rubles": 100, "tokens": 100},
@@ -870,8 +1770,12 @@ RUB_PACKS = {
     "500": {"rubles": 500, "tokens": 500},
 }
 
-def create_yookassa_payment(amount_rub: int, user_id: int, tokens: int):
-    payment = Payment.create({
+yookassa_client = YooKassaClient(
+    YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY, YOOKASSA_API_BASE, latency=YOOKASSA_LATENCY
+)
+
+async def create_yookassa_payment(amount_rub: int, user_id: int, tokens: int) -> Tuple[str, str]:
+    payment = await yookassa_client.create_payment({
         "amount": {"value": f"{amount_rub:.2f}", "currency": "RUB"},
         "confirmation": {"type": "redirect", "return_url": YOOKASSA_RETURN_URL},
         "capture": True,
@@ -888,43 +1792,118 @@ def create_yookassa_payment(amount_rub: int, user_id: int, tokens: int):
                 "vat_code": "1"
             }]
         }
-    })
-    return payment.confirmation.confirmation_url, payment.id
-
-async def check_yookassa_payment(payment_id: str, user_id: int, tokens: int):
-    try:
-        for _ in range(30):
-            payment = await asyncio.to_thread(Payment.find_one, payment_id)
-            status = getattr(payment, "status", None)
-            if status == "succeeded":
-                await db.add_generations(user_id, tokens)
-                await safe_send_message(bot, user_id, f"✅ Оплата {payment.amount.value}₽ получена.\n🪙 Начислено {tokens} токенов.")
-                return True
-            if status in ("canceled", "expired"):
-                await safe_send_message(bot, user_id, "❌ Оплата не завершена или отменена.")
-                return False
-            await asyncio.sleep(10)
-        await safe_send_message(bot, user_id, "⌛ Время ожидания оплаты истекло. Если оплатили — напишите в поддержку.")
-        return False
-    except Exception:
-        logging.exception("Ошибка при проверке статуса YooKassa")
-        await safe_send_message(bot, user_id, "❌ Ошибка при проверке оплаты. Если списало — свяжитесь с поддержкой.")
+    }, idempotence_key=uuid.uuid4().hex)
+    return payment.confirmation_url, payment.id
+
+async def apply_yookassa_status(payment_id: str, status: str | None, amount_value: str | None = None):
+    """Применяет финальный статус платежа. Повторные вызовы ничего не делают."""
+    if status == "succeeded":
+        row = await db.settle_yookassa_payment(payment_id, "succeeded")
+        if row:
+            amount = amount_value or row["rubles"]
+            await safe_send_message(bot, row["user_id"], f"✅ Оплата {amount}₽ получена.\n🪙 Начислено {row['tokens']} токенов.", priority=PRIORITY_PAYMENT)
+    elif status == "canceled":
+        row = await db.settle_yookassa_payment(payment_id, "canceled")
+        if row:
+            await safe_send_message(bot, row["user_id"], "❌ Оплата не завершена или отменена.", priority=PRIORITY_PAYMENT)
+
+async def _expire_or_settle_yookassa_payment(row: dict, sem: asyncio.Semaphore):
+    """Перед тем как признать платёж просроченным, проверяем его точечно"""
+    async with sem:
+        try:
+            payment = await yookassa_client.get_payment(row["payment_id"])
+        except Exception:
+            logging.exception(f"YooKassa: не удалось получить платёж {row['payment_id']}")
+            return
+    if payment.status in ("succeeded", "canceled"):
+        await apply_yookassa_status(row["payment_id"], payment.status, payment.amount_value)
+    elif await db.settle_yookassa_payment(row["payment_id"], "expired"):
+        await safe_send_message(bot, row["user_id"], "⌛ Время ожидания оплаты истекло. Если оплатили — напишите в поддержку.", priority=PRIORITY_PAYMENT)
+
+# точечная сверка: payment_id → (когда проверять, текущая пауза), монотонные секунды
+_yookassa_checks: Dict[str, Tuple[float, float]] = {}
+
+async def _check_yookassa_payment(row: dict, sem: asyncio.Semaphore) -> bool:
+    """Точечная проверка платежа. True — статус финальный и применён"""
+    async with sem:
+        try:
+            payment = await yookassa_client.get_payment(row["payment_id"])
+        except Exception:
+            logging.exception(f"YooKassa: не удалось получить платёж {row['payment_id']}")
+            return False
+    if payment.status not in ("succeeded", "canceled"):
         return False
+    await apply_yookassa_status(row["payment_id"], payment.status, payment.amount_value)
+    return True
+
+async def _reconcile_yookassa_by_id(rows: List[dict], sem: asyncio.Semaphore):
+    """
+    Немного ожидающих платежей — get_payment на каждый, с паузой от
+    YOOKASSA_RECONCILE_INTERVAL, удваивающейся до YOOKASSA_CHECK_MAX_INTERVAL:
+    обычно платёж подтверждает уведомление, сверка лишь подстраховывает.
+    """
+    now = time.monotonic()
+    due = [r for r in rows if _yookassa_checks.get(r["payment_id"], (0.0, 0.0))[0] <= now]
+    settled = await asyncio.gather(*(_check_yookassa_payment(r, sem) for r in due))
+    for row, done in zip(due, settled):
+        if done:
+            _yookassa_checks.pop(row["payment_id"], None)
+            continue
+        _, interval = _yookassa_checks.get(row["payment_id"], (0.0, 0.0))
+        interval = min(YOOKASSA_CHECK_MAX_INTERVAL, max(YOOKASSA_RECONCILE_INTERVAL, interval * 2))
+        _yookassa_checks[row["payment_id"]] = (now + interval, interval)
+
+async def reconcile_yookassa_payments(rows: List[dict]):
+    """
+    Сверка ожидающих платежей воркера. Пока их не больше YOOKASSA_LIST_THRESHOLD —
+    точечно, с нарастающей паузой; больше — пачкой: два списочных запроса
+    (succeeded и canceled за окно от самого старого ожидающего).
+    Платежи, которые пора признать просроченными, всегда проверяются точечно.
+    """
+    now = datetime.now(timezone.utc)
+    sem = asyncio.Semaphore(YOOKASSA_RECONCILE_CONCURRENCY)
+    stale = [r for r in rows if (now - r["created_at"]).total_seconds() > YOOKASSA_PENDING_TTL]
+    fresh = [r for r in rows if (now - r["created_at"]).total_seconds() <= YOOKASSA_PENDING_TTL]
+    # забываем паузы платежей, которые больше не ждут (оплачены по уведомлению, ушли другому воркеру)
+    waiting = {r["payment_id"] for r in fresh}
+    for payment_id in [p for p in _yookassa_checks if p not in waiting]:
+        del _yookassa_checks[payment_id]
+    if stale:
+        await asyncio.gather(*(_expire_or_settle_yookassa_payment(r, sem) for r in stale))
+    if not fresh:
+        return
+    if len(fresh) <= YOOKASSA_LIST_THRESHOLD:
+        await _reconcile_yookassa_by_id(fresh, sem)
+        return
+
+    since = min(r["created_at"] for r in fresh) - timedelta(seconds=YOOKASSA_LIST_MARGIN)
+    final = {}
+    for status in ("succeeded", "canceled"):
+        for payment in await yookassa_client.list_payments(status, created_gte=since):
+            final[payment.id] = payment
+    for row in fresh:
+        payment = final.get(row["payment_id"])
+        if payment is not None:
+            await apply_yookassa_status(row["payment_id"], payment.status, payment.amount_value)
+
+async def yookassa_reconcile_loop():
+    """Фоновая сверка платежей, которые арендует этот воркер"""
+    while True:
+        try:
+            pending = await db.get_pending_yookassa_payments(WORKER_ID)
+            if pending:
+                await reconcile_yookassa_payments(pending)
+        except Exception:
+            logging.exception("Ошибка при сверке платежей YooKassa")
+        await asyncio.sleep(YOOKASSA_RECONCILE_INTERVAL)
 
 @dp.callback_query(F.data == "pay_rub")
 async def pay_rub_cb(callback: CallbackQuery, state: FSMContext):
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"💵 {RUB_PACKS['30']['rubles']}₽ → {RUB_PACKS['30']['tokens']} токенов",   callback_data="rubles_30")],
-        [InlineKeyboardButton(text=f"💵 {RUB_PACKS['100']['rubles']}₽ → {RUB_PACKS['100']['tokens']} токенов", callback_data="rubles_100")],
-        [InlineKeyboardButton(text=f"💵 {RUB_PACKS['200']['rubles']}₽ → {RUB_PACKS['200']['tokens']} токенов", callback_data="rubles_200")],
-        [InlineKeyboardButton(text=f"💵 {RUB_PACKS['500']['rubles']}₽ → {RUB_PACKS['500']['tokens']} токенов", callback_data="rubles_500")],
-        [back_btn("top_up_balance")]
-    ])
-    await safe_edit_text(callback.message, "💵 Выберите пакет для пополнения (YooKassa):", reply_markup=kb)
+    await safe_edit_text(callback.message, "💵 Выберите пакет для пополнения (YooKassa):", reply_markup=keyboards.get("rub_packs"))
 
 @dp.callback_query(F.data.startswith("rubles_"))
 async def rubles_package_cb(callback: CallbackQuery):
-    if not (YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY):
+    if not YOOKASSA_ENABLED:
         try:
             await callback.answer("YooKassa не настроена", show_alert=True)
         except Exception:
@@ -943,7 +1922,8 @@ async def rubles_package_cb(callback: CallbackQuery):
     pkg = RUB_PACKS[pack]
 
     try:
-        pay_url, pay_id = await asyncio.to_thread(create_yookassa_payment, pkg["rubles"], uid, pkg["tokens"])
+        pay_url, pay_id = await create_yookassa_payment(pkg["rubles"], uid, pkg["tokens"])
+        await db.create_yookassa_payment(pay_id, uid, pkg["rubles"], pkg["tokens"], WORKER_ID, LEASE_TTL)
         await safe_edit_text(
             callback.message,
             f"💳 Счёт на {pkg['rubles']}₽ создан.\n"
@@ -955,13 +1935,12 @@ async def rubles_package_cb(callback: CallbackQuery):
                 ]
             )
         )
-        asyncio.create_task(check_yookassa_payment(pay_id, uid, pkg["tokens"]))
     except Exception:
         logging.exception("Ошибка при создании платежа YooKassa")
         await safe_edit_text(
             callback.message,
             "❌ Не удалось создать платёж. Попробуйте позже.",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[back_btn("pay_rub")]])
+            reply_markup=back_keyboard("pay_rub")
         )
 
 # ───────────────────────── Интеграция с KIE ───────────────────────────
@@ -979,104 +1958,1070 @@ def _input_payload(prompt: str, duration: int, orientation: str,
         p["size"] = "high" if quality == "high" else "standard"
     return p
 
+# ──────────────────────────── Клиент KIE ─────────────────────────────
+# Предохранитель: сбоев подряд до размыкания и пауза до пробного запроса
+KIE_BREAKER_FAILURES = int(os.getenv("KIE_BREAKER_FAILURES", "5"))
+KIE_BREAKER_COOLDOWN = float(os.getenv("KIE_BREAKER_COOLDOWN", "15"))    # с
+KIE_BREAKER_MAX_COOLDOWN = 300   # с
+KIE_CREATE_TIMEOUT = int(os.getenv("KIE_CREATE_TIMEOUT", "120"))         # с
+# Пул соединений к KIE: общий на createTask и опрос
+KIE_HTTP_LIMIT = int(os.getenv("KIE_HTTP_LIMIT", "100"))
+KIE_HTTP_LIMIT_PER_HOST = int(os.getenv("KIE_HTTP_LIMIT_PER_HOST", "50"))
+KIE_HTTP_KEEPALIVE = 60          # с
+
+kie_client = KieClient(
+    KIE_API_BASE, KIE_API_KEY,
+    limit=KIE_HTTP_LIMIT,
+    limit_per_host=KIE_HTTP_LIMIT_PER_HOST,
+    keepalive_timeout=KIE_HTTP_KEEPALIVE,
+    create_timeout=KIE_CREATE_TIMEOUT,
+    breaker_threshold=KIE_BREAKER_FAILURES,
+    breaker_cooldown=KIE_BREAKER_COOLDOWN,
+    breaker_max_cooldown=KIE_BREAKER_MAX_COOLDOWN,
+    latency=KIE_LATENCY,
+)
+kie_breaker = kie_client.breaker
+
 async def send_to_kie_api(uid: int, model: str, prompt: str, duration: int,
                           orientation: str, image_url: str | None,
-                          cost: int, tier: str, quality: str | None, ptype: str):
-    payload = {"model": model,
-               "input": _input_payload(prompt, duration, orientation, image_url, tier, quality)}
+                          cost: int, tier: str, quality: str | None, ptype: str,
+                          job_id: str, request_hash: str | None = None, batch: bool = False) -> str:
+    input_payload = _input_payload(prompt, duration, orientation, image_url, tier, quality)
+    callback_url = None
+    if KIE_CALLBACKS_ENABLED:
+        callback_url = f"{PUBLIC_BASE_URL}{KIE_CALLBACK_PATH}?token={KIE_CALLBACK_SECRET}"
+    params = {"prompt": prompt, "duration": duration, "orientation": orientation,
+              "image_url": image_url, "tier": tier, "quality": quality, "ptype": ptype}
+
+    # строка в очереди: если воркер упадёт до createTask, токены вернёт другой воркер
     try:
-        async with aiohttp.ClientSession() as s:
-            async with s.post(JOBS_CREATE, json=payload, headers=_kie_headers(), timeout=120) as r:
-                data = await r.json(content_type=None)
-                if r.status != 200 or data.get("code") != 200:
-                    await db.add_generations(uid, cost)
-                    raise RuntimeError(f"KIE createTask error: status={r.status}, body={data}")
-                task_id = (data.get("data") or {}).get("taskId") or (data.get("data") or {}).get("task_id")
-                if not task_id:
-                    await db.add_generations(uid, cost)
-                    raise RuntimeError(f"KIE createTask: нет taskId в ответе: {data}")
+        await db.queue_kie_job(job_id, uid, cost, model, params, WORKER_ID, request_hash)
+    except Exception:
+        logging.exception(f"Не удалось записать задачу {job_id} в очередь")
+
+    async def on_queued(position: int):
+        await safe_send_message(
+            bot, uid,
+            f"⏳ Сейчас много заказов — вы в очереди: {position}-й.\nГенерация начнётся автоматически."
+        )
+
+    try:
+        # пакет: об очереди сообщили один раз на весь заказ, лимит на пользователя — пакетный
+        task_id = await admission.submit(
+            uid, job_id, lambda: kie_client.create_task(model, input_payload, callback_url),
+            None if batch else on_queued, per_user=KIE_BATCH_CONCURRENCY if batch else None
+        )
     except Exception:
         logging.exception("Ошибка при отправке в KIE")
-        await db.add_generations(uid, cost)
-        await safe_send_message(bot, uid, "❌ Не удалось создать задачу. Токены возвращены.")
+        account_changed(uid, await db.credit(uid, cost, reason="refund", job_id=job_id))
+        with contextlib.suppress(Exception):
+            await db.fail_queued_kie_job(job_id)
+        if not batch:
+            # по пакету — одна сводка в confirm_batch
+            await safe_send_message(bot, uid, "❌ Не удалось создать задачу. Токены возвращены.", priority=PRIORITY_RESULT)
+        raise
+
+    job = KieJob(uid, task_id, duration, orientation, cost, job_id=job_id,
+                 model=model, quality=quality, started_at=time.time())
+    delay = completion_profile.next_delay(job)
+    # в опрос — до записи строки: координатор не примет её за строку без хозяина.
+    # Пока строки нет, задача не считается арендованной (persisted = False)
+    job.persisted = False
+    kie_scheduler.add(job, delay)
+    try:
+        if await db.create_kie_job(job_id, task_id, uid, cost, model, params,
+                                   datetime.now(timezone.utc) + timedelta(seconds=delay),
+                                   WORKER_ID, LEASE_TTL, request_hash):
+            job.persisted = True
+        else:
+            # строку очереди уже закрыли как брошенную (долгая пауза воркера) — видео всё равно выдадим
+            logging.warning(f"Задача KIE {task_id}: строка {job_id} уже закрыта, опрос без записи в БД")
+    except Exception:
+        # задача уже создана в KIE — опрашиваем её в любом случае, просто без записи в БД
+        logging.exception(f"Не удалось сохранить задачу KIE {task_id}")
+    return task_id
+
+# ──────────────────────────── Допуск задач в KIE ──────────────────────
+KIE_MAX_INFLIGHT = int(os.getenv("KIE_MAX_INFLIGHT", "20"))           # задач в KIE на воркер
+KIE_MIN_INFLIGHT = int(os.getenv("KIE_MIN_INFLIGHT", "2"))
+KIE_PER_USER_INFLIGHT = int(os.getenv("KIE_PER_USER_INFLIGHT", "2"))
+KIE_QUEUE_MAX = int(os.getenv("KIE_QUEUE_MAX", "200"))
+KIE_QUEUE_MAX_WAIT = int(os.getenv("KIE_QUEUE_MAX_WAIT", "1800"))    # с, дольше — возврат токенов
+KIE_THROTTLE_BACKOFF = 10      # пауза перед повтором createTask после 429/455, с
+# Пакетный заказ: задач одного пакета одновременно (и в createTask, и в лимите допуска)
+KIE_BATCH_CONCURRENCY = int(os.getenv("KIE_BATCH_CONCURRENCY", "3"))
+
+class _Ticket:
+    __slots__ = ("uid", "job_id", "future", "limit")
+
+    def __init__(self, uid: int, job_id: str, future: asyncio.Future, limit: int):
+        self.uid = uid
+        self.job_id = job_id
+        self.future = future
+        self.limit = limit      # задач пользователя одновременно
+
+class AdmissionController:
+    """
+    Допуск задач в KIE: общий лимит одновременных задач, лимит на пользователя
+    и FIFO-очередь ожидания. Место занято от createTask до финального статуса задачи.
+    Лимит подстраивается под реальную ёмкость KIE (AIMD): понемногу растёт после
+    успешных createTask и уменьшается вдвое при 429/455; такие запросы не
+    возвращаются пользователю с ошибкой, а повторяются в начале очереди.
+    """
+
+    def __init__(self, max_limit: int, min_limit: int, per_user: int, max_queue: int,
+                 backoff: float = KIE_THROTTLE_BACKOFF, cooldown: float = 5.0,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.per_user = max(1, per_user)
+        self.max_queue = max_queue
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.limit = float(self.max_limit)
+        self.active: Dict[str, int] = {}          # job_id → uid
+        self._per_user: Dict[int, int] = {}
+        self._queue: deque = deque()
+        self._last_decrease = 0.0
+        # пока предохранитель разомкнут, очередь стоит; замкнулся — пускаем ожидающих
+        self.breaker = breaker
+        if breaker is not None:
+            breaker.add_listener(self._grant)
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def overloaded(self) -> bool:
+        return len(self._queue) >= self.max_queue
+
+    def _take(self, uid: int, job_id: str):
+        self.active[job_id] = uid
+        self._per_user[uid] = self._per_user.get(uid, 0) + 1
+
+    def occupy(self, uid: int, job_id: Optional[str]):
+        """Учитывает задачу, взятую в работу без очереди (после перезапуска или от другого воркера)"""
+        if job_id and job_id not in self.active:
+            self._take(uid, job_id)
+
+    def release(self, job_id: Optional[str]):
+        uid = self.active.pop(job_id, None)
+        if uid is None:
+            return
+        left = self._per_user.get(uid, 0) - 1
+        if left > 0:
+            self._per_user[uid] = left
+        else:
+            self._per_user.pop(uid, None)
+        self._grant()
+
+    def _grant(self):
+        """Пускает ожидающих по порядку; пользователей на своём лимите пропускает"""
+        if self.breaker is not None and not self.breaker.closed:
+            return
+        free = int(self.limit) - len(self.active)
+        if free <= 0 or not self._queue:
+            return
+        waiting = deque()
+        while self._queue:
+            ticket = self._queue.popleft()
+            if ticket.future.done():
+                continue
+            if free > 0 and self._per_user.get(ticket.uid, 0) < ticket.limit:
+                self._take(ticket.uid, ticket.job_id)
+                ticket.future.set_result(None)
+                free -= 1
+            else:
+                waiting.append(ticket)
+        self._queue = waiting
+
+    def _on_success(self):
+        self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+        self._grant()
+
+    def _on_throttle(self):
+        now = time.monotonic()
+        # один всплеск отказов — одно уменьшение
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.min_limit), self.limit / 2)
+        logging.warning(f"KIE ограничивает запросы: лимит одновременных задач {self.limit:.1f}")
+
+    async def _wait(self, ticket: _Ticket, timeout: float, on_queued=None):
+        try:
+            if on_queued and not ticket.future.done():
+                await on_queued(self._queue.index(ticket) + 1)
+            await asyncio.wait_for(ticket.future, max(0.0, timeout))
+        except BaseException:
+            if ticket.future.done() and not ticket.future.cancelled():
+                self.release(ticket.job_id)
+            with contextlib.suppress(ValueError):
+                self._queue.remove(ticket)
+            raise
+
+    async def submit(self, uid: int, job_id: str, create, on_queued=None,
+                     max_wait: float = KIE_QUEUE_MAX_WAIT, per_user: Optional[int] = None) -> str:
+        """
+        Ждёт места и вызывает create() (createTask). При 429/455 повторяет
+        из начала очереди, пока не выйдет max_wait. on_queued(position) —
+        уведомление, если пришлось встать в очередь. per_user — свой лимит
+        задач пользователя вместо общего (пакетные заказы).
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max_wait
+        limit = max(1, per_user or self.per_user)
+        retry = False
+        while True:
+            ticket = _Ticket(uid, job_id, loop.create_future(), limit)
+            if retry:
+                self._queue.appendleft(ticket)
+            else:
+                self._queue.append(ticket)
+            self._grant()
+            await self._wait(ticket, deadline - loop.time(), None if retry else on_queued)
+            try:
+                result = await create()
+            except KieUnavailable:
+                # предохранитель разомкнулся, пока ждали места: обратно в начало очереди
+                self.release(job_id)
+                retry = True
+                continue
+            except KieThrottled:
+                self.release(job_id)
+                self._on_throttle()
+                if loop.time() + self.backoff > deadline:
+                    raise
+                logging.warning(f"KIE createTask отложен для {job_id}: повтор через {self.backoff} с")
+                await asyncio.sleep(self.backoff)
+                retry = True
+                continue
+            except BaseException:
+                self.release(job_id)
+                raise
+            self._on_success()
+            return result
+
+admission = AdmissionController(KIE_MAX_INFLIGHT, KIE_MIN_INFLIGHT, KIE_PER_USER_INFLIGHT, KIE_QUEUE_MAX,
+                                breaker=kie_breaker)
+
+# ──────────────────────────── Дедупликация запросов ───────────────────
+# Запросы, для которых прямо сейчас идёт createTask: хэш → (uid, future с task_id)
+KIE_SUBMITTING: Dict[str, Tuple[int, asyncio.Future]] = {}
+
+def _request_hash(model: str, input_payload: dict, image_key: str | None) -> str:
+    """
+    Хэш нормализованного запроса: модель + input для KIE.
+    Для i2v вместо ссылки на файл (она каждый раз разная) — ключ содержимого картинки.
+    """
+    norm = dict(input_payload)
+    norm["prompt"] = " ".join((norm.get("prompt") or "").split())
+    if "image_urls" in norm:
+        norm["image_urls"] = [image_key or ""]
+    raw = json.dumps({"model": model, "input": norm}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+async def find_inflight_request(request_hash: str | None) -> Optional[Tuple[int, Optional[str]]]:
+    """(uid владельца, task_id) такой же генерации в работе, если она есть"""
+    if not request_hash:
+        return None
+    local = KIE_SUBMITTING.get(request_hash)
+    if local:
+        return local[0], None
+    row = await db.find_inflight_kie_job(request_hash)
+    return (row["user_id"], row["task_id"]) if row else None
+
+async def submit_or_attach(uid: int, data: dict, cost: int, job_id: str, batch: bool = False):
+    """
+    Одинаковые запросы разных пользователей склеиваются в одну задачу KIE:
+    второй (уже оплативший) присоединяется к ней и получает тот же ролик.
+    """
+    request_hash = data.get("request_hash")
+    waiter = {"uid": uid, "job_id": job_id, "cost": cost}
+    if request_hash:
+        local = KIE_SUBMITTING.get(request_hash)
+        if local:
+            task_id = await asyncio.shield(local[1])
+        else:
+            row = await db.find_inflight_kie_job(request_hash)
+            task_id = row["task_id"] if row else None
+        if task_id and await db.attach_kie_waiter(task_id, waiter):
+            return
+
+    fut = asyncio.get_running_loop().create_future()
+    if request_hash:
+        KIE_SUBMITTING[request_hash] = (uid, fut)
+    task_id = None
+    try:
+        task_id = await send_to_kie_api(
+            uid,
+            data["kie_model"],
+            data["prompt"],
+            data["duration"],
+            data.get("orientation"),
+            _image_url(data),
+            cost,
+            data.get("tier"),
+            data.get("quality"),
+            data.get("prompt_type"),
+            job_id,
+            request_hash,
+            batch
+        )
+    finally:
+        fut.set_result(task_id)
+        if request_hash and KIE_SUBMITTING.get(request_hash, (None, None))[1] is fut:
+            del KIE_SUBMITTING[request_hash]
+
+# ──────────────────────────── Фоновая отправка заказов ─────────────────
+# Оплаченные заказы ждут места в KIE фоновыми задачами, а не в хэндлере апдейта
+SUBMIT_DRAIN_TIMEOUT = 10      # с: столько ждём при остановке, остальные отменяются с возвратом
+
+submissions: Set[asyncio.Task] = set()
+
+def spawn_submission(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    submissions.add(task)
+    task.add_done_callback(submissions.discard)
+    return task
+
+async def drain_submissions(timeout: float = SUBMIT_DRAIN_TIMEOUT):
+    """Остановка воркера: даём отправкам доработать, ждущие места в очереди отменяем"""
+    if not submissions:
+        return
+    _, pending = await asyncio.wait(set(submissions), timeout=timeout)
+    for t in pending:
+        t.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+async def run_submission(uid: int, data: dict, cost: int, job_id: str,
+                         batch: bool = False) -> Optional[bool]:
+    """
+    submit_or_attach для уже оплаченного заказа. True — задача создана (или присоединена),
+    False — не создана, токены возвращены; None — не создана и вернуть токены не удалось.
+    """
+    try:
+        await submit_or_attach(uid, data, cost, job_id, batch)
+        return True
+    except asyncio.CancelledError:
+        # остановка воркера, пока заказ ждал места: если задача в KIE не создана — возвращаем токены
+        try:
+            if await db.get_kie_job_state(job_id) in (None, "queued", "failed"):
+                await db.fail_queued_kie_job(job_id)
+                if await db.credit(uid, cost, reason="refund", job_id=job_id) is not None:
+                    await safe_send_message(
+                        bot, uid,
+                        "❌ Генерация не началась из-за перезапуска сервиса. Токены возвращены.",
+                        priority=PRIORITY_RESULT
+                    )
+        except Exception:
+            logging.exception(f"Не удалось вернуть токены за отменённый заказ {job_id}")
         raise
+    except Exception:
+        # ошибка может случиться и до send_to_kie_api (БД, устаревшие данные FSM) —
+        # возвращаем здесь; повторный возврат по тому же job_id ничего не начислит
+        logging.exception(f"Заказ {job_id} не отправлен в KIE")
+        try:
+            await db.fail_queued_kie_job(job_id)
+            if await db.credit(uid, cost, reason="refund", job_id=job_id) is not None and not batch:
+                await safe_send_message(bot, uid, "❌ Не удалось создать задачу. Токены возвращены.",
+                                        priority=PRIORITY_RESULT)
+        except Exception:
+            logging.exception(f"Не удалось вернуть токены за заказ {job_id}")
+            return None
+        return False
 
-    asyncio.create_task(check_video_status(uid, task_id, duration, orientation, cost))
+def _extract_video_url(d: dict) -> str | None:
+    resp_obj = d.get("response") or {}
+    video_url = resp_obj.get("videoUrl")
+    urls = resp_obj.get("resultUrls")
+    if not video_url and isinstance(urls, list) and urls:
+        video_url = urls[0]
 
-async def check_video_status(uid: int, task_id: str, duration: int, orientation: str, cost: int):
+    if not video_url and d.get("resultJson"):
+        try:
+            rj = d["resultJson"]
+            rj = json.loads(rj) if isinstance(rj, str) else rj
+            video_url = rj.get("result")
+            if not video_url:
+                r_urls = rj.get("resultUrls")
+                if isinstance(r_urls, list) and r_urls:
+                    video_url = r_urls[0]
+        except Exception:
+            pass
+    return video_url
+
+# ──────────────────────────── Планировщик задач KIE ───────────────────
+# С колбэками опрос — лишь страховка на случай потерянного колбэка, поэтому реже
+KIE_POLL_INTERVAL = 60 if KIE_CALLBACKS_ENABLED else 8   # шаг опроса, с
+KIE_POLL_MIN_STEP = 5         # самый частый опрос (около медианы), с
+KIE_POLL_MAX_STEP = 60        # самый редкий опрос (задача дольше обычного), с
+KIE_DEADLINE_MIN = 600        # таймаут задачи: не меньше…
+KIE_DEADLINE_MAX = 3600       # …и не больше, с
+KIE_STATS_WINDOW = 7 * 24 * 3600    # за какой период считать время генерации, с
+KIE_STATS_MIN_SAMPLES = 10
+KIE_STATS_REFRESH = 600       # с
+KIE_POLL_WORKERS = int(os.getenv("KIE_POLL_WORKERS", "8"))
+KIE_PERSIST_INTERVAL = 15     # как часто сбрасывать прогресс опроса в БД, с
+
+class KieJob:
+    """Задача KIE в работе: всё, что нужно для выдачи результата или возврата токенов."""
+    __slots__ = ("uid", "task_id", "duration", "orientation", "cost", "attempts", "next_poll_at",
+                 "persisted", "job_id", "model", "quality", "started_at", "paused")
+
+    def __init__(self, uid: int, task_id: str, duration: int, orientation: str, cost: int,
+                 attempts: int = 0, job_id: Optional[str] = None, model: Optional[str] = None,
+                 quality: Optional[str] = None, started_at: Optional[float] = None):
+        self.job_id = job_id
+        self.model = model
+        self.quality = quality
+        self.started_at = time.time() if started_at is None else started_at
+        self.uid = uid
+        self.task_id = task_id
+        self.duration = duration
+        self.orientation = orientation
+        self.cost = cost
+        self.attempts = attempts
+        self.next_poll_at = 0.0
+        self.persisted = True
+        # сколько секунд опрос стоял из-за недоступности KIE — не идёт в счёт таймаута
+        self.paused = 0.0
+
+def _generation_seconds(d: dict) -> Optional[float]:
+    """
+    Время генерации по часам KIE: createTime → completeTime записи (мс).
+    Момент, когда задачу заметил опрос, не годится: первый опрос идёт около p10,
+    и выборка никогда не опустилась бы ниже него. None — в записи нет времени.
+    """
     try:
-        async with aiohttp.ClientSession() as s:
-            for _ in range(90):  # ~12 минут, шаг 8с
-                async with s.get(
-                    JOBS_STATUS,
-                    params={"taskId": task_id},
-                    headers=_kie_headers(),
-                    timeout=30
-                ) as r:
-                    result = await r.json(content_type=None)
-                    if r.status != 200 or result.get("code") != 200:
-                        await asyncio.sleep(8); continue
-
-                    d = result.get("data") or {}
-                    state = (d.get("state") or "").lower()
-                    flag = d.get("successFlag")
-
-                    if state in ("", "wait", "queueing", "generating") or flag == 0:
-                        await asyncio.sleep(8); continue
-
-                    if state == "success" or flag == 1:
-                        video_url = None
-                        resp_obj = d.get("response") or {}
-                        video_url = resp_obj.get("videoUrl")
-                        urls = resp_obj.get("resultUrls")
-                        if not video_url and isinstance(urls, list) and urls:
-                            video_url = urls[0]
-
-                        if not video_url and d.get("resultJson"):
-                            try:
-                                rj = d["resultJson"]
-                                rj = json.loads(rj) if isinstance(rj, str) else rj
-                                video_url = rj.get("result")
-                                if not video_url:
-                                    r_urls = rj.get("resultUrls")
-                                    if isinstance(r_urls, list) and r_urls:
-                                        video_url = r_urls[0]
-                            except Exception:
-                                pass
-
-                        line_orient = f", 📱 {orientation}" if orientation else ""
-                        await safe_send_message(bot, uid, f"🎉 Ваше видео готово! ⏱️ {duration} с{line_orient}")
-                        if video_url:
-                            await safe_send_video(bot, uid, video_url, caption="🎬 Готовый ролик")
-                        else:
-                            await safe_send_message(bot, uid, "⚠️ Видео готово, но URL не найден в ответе.")
-                        return
-
-                    # ошибка
-                    fail_msg = d.get("failMsg") or d.get("errorMessage") or "Ошибка генерации"
-                    await db.add_generations(uid, cost)
-                    await safe_send_message(bot, uid, f"❌ Генерация не удалась: {fail_msg}. Токены возвращены.")
-                    return
-
-                await asyncio.sleep(8)
+        seconds = (float(d["completeTime"]) - float(d["createTime"])) / 1000
+    except (KeyError, TypeError, ValueError):
+        return None
+    return seconds if seconds > 0 else None
+
+class CompletionProfile:
+    """
+    Сколько обычно длится генерация: p10/p50/p90 успешных задач за последнюю
+    неделю по модели, качеству и длительности (по часам KIE, см. _generation_seconds). По ним строится расписание
+    опроса (первый опрос около p10, чаще всего — около медианы, после p90 реже)
+    и таймаут задачи. Пока статистики мало — консервативные оценки по умолчанию.
+    """
+
+    def __init__(self):
+        self._stats: Dict[Tuple[str, str, str], Tuple[float, float, float]] = {}
+
+    @staticmethod
+    def _key(model: Optional[str], quality: Optional[str], duration) -> Tuple[str, str, str]:
+        return model or "", quality or "", "" if duration is None else str(duration)
+
+    @staticmethod
+    def _default(model: Optional[str], quality: Optional[str], duration) -> Tuple[float, float, float]:
+        scale = 1.0
+        if "pro" in (model or ""):
+            scale *= 1.5
+        if quality == "high":
+            scale *= 1.5
+        if str(duration) == "15":
+            scale *= 1.3
+        return 60 * scale, 150 * scale, 300 * scale
+
+    def percentiles(self, job: KieJob) -> Tuple[float, float, float]:
+        key = self._key(job.model, job.quality, job.duration)
+        return self._stats.get(key) or self._default(*key)
+
+    def deadline(self, job: KieJob) -> float:
+        """Сколько ждать задачу от createTask до таймаута, с"""
+        _, _, p90 = self.percentiles(job)
+        return min(KIE_DEADLINE_MAX, max(KIE_DEADLINE_MIN, p90 * 2.5))
+
+    def next_delay(self, job: KieJob, now: Optional[float] = None) -> float:
+        """Через сколько секунд опрашивать задачу в следующий раз"""
+        elapsed = (time.time() if now is None else now) - job.started_at
+        p10, p50, p90 = self.percentiles(job)
+        if KIE_CALLBACKS_ENABLED:
+            # результат придёт колбэком; опрос — только если он потерялся
+            return max(KIE_POLL_INTERVAL, p90 - elapsed)
+        if elapsed < p10:
+            return p10 - elapsed
+        step = max(KIE_POLL_MIN_STEP, (p90 - p10) / 12)
+        if elapsed < p90:
+            # плотнее всего задачи завершаются около медианы
+            if abs(elapsed - p50) < (p90 - p10) / 4:
+                step /= 2
+            return max(KIE_POLL_MIN_STEP, step)
+        return min(KIE_POLL_MAX_STEP, step + (elapsed - p90) / 4)
+
+    async def refresh(self):
+        rows = await db.get_completion_percentiles(KIE_STATS_WINDOW, KIE_STATS_MIN_SAMPLES)
+        self._stats = {
+            (r["model"], r["quality"], r["duration"]): tuple(r["p"]) for r in rows
+        }
 
+    async def refresh_loop(self, interval: int = KIE_STATS_REFRESH):
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logging.exception("Не удалось обновить статистику времени генерации")
+            await asyncio.sleep(interval)
+
+completion_profile = CompletionProfile()
+
+class KieJobScheduler:
+    """
+    Единый планировщик опроса KIE вместо корутины на каждое видео.
+    Хранит все задачи в работе, держит кучу дедлайнов следующего опроса
+    и раздаёт созревшие задачи ограниченному пулу воркеров (запросы — через kie_client).
+    """
+
+    def __init__(self, workers: int = KIE_POLL_WORKERS):
+        self.jobs: Dict[str, KieJob] = {}
+        self._heap: List[Tuple[float, str]] = []
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._wakeup = asyncio.Event()
+        self._workers = max(1, workers)
+        self._tasks: List[asyncio.Task] = []
+        self._dirty: Set[str] = set()
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._dispatch_loop()),
+                       asyncio.create_task(self._persist_loop())]
+        self._tasks += [asyncio.create_task(self._worker()) for _ in range(self._workers)]
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self._persist()
+
+    @staticmethod
+    def job_from_row(row: dict) -> KieJob:
+        params = row["params"] or {}
+        return KieJob(row["user_id"], row["task_id"], params.get("duration"),
+                      params.get("orientation"), row["cost"], attempts=row["attempts"],
+                      job_id=row["job_id"], model=row["model"], quality=params.get("quality"),
+                      started_at=row["started_at"].timestamp())
+
+    def adopt(self, rows: List[dict]) -> int:
+        """Берёт в опрос задачи из БД (после перезапуска или от упавшего воркера)"""
+        now = datetime.now(timezone.utc)
+        adopted = 0
+        for row in rows:
+            if row["task_id"] in self.jobs:
+                continue
+            delay = max(0.0, (row["next_poll_at"] - now).total_seconds())
+            job = self.job_from_row(row)
+            admission.occupy(job.uid, job.job_id)
+            self.add(job, delay=delay)
+            adopted += 1
+        return adopted
+
+    def drop(self, task_ids: List[str]):
+        """Снимает задачи с опроса без финального статуса (их опрашивает другой воркер)"""
+        for task_id in task_ids:
+            job = self.jobs.pop(task_id, None)
+            self._dirty.discard(task_id)
+            if job:
+                admission.release(job.job_id)
+
+    def add(self, job: KieJob, delay: Optional[float] = None):
+        self.jobs[job.task_id] = job
+        self._schedule(job, completion_profile.next_delay(job) if delay is None else delay)
+
+    def _schedule(self, job: KieJob, delay: float):
+        job.next_poll_at = asyncio.get_running_loop().time() + delay
+        heapq.heappush(self._heap, (job.next_poll_at, job.task_id))
+        self._dirty.add(job.task_id)
+        self._wakeup.set()
+
+    async def _complete(self, job: KieJob, state: str,
+                        gen_seconds: Optional[float] = None) -> Optional[List[dict]]:
+        """
+        Фиксирует финальное состояние в БД (gen_seconds — время генерации по часам KIE,
+        для статистики) и только после этого снимает задачу с опроса.
+        Возвращает присоединившихся пользователей или None, если задачу уже завершил
+        кто-то другой или финал не записался (тогда задача остаётся на опросе и повторится).
+        """
+        waiters: Optional[List[dict]] = []
+        if job.persisted:
+            try:
+                waiters = await db.finish_kie_job(job.task_id, state, gen_seconds)
+            except Exception:
+                logging.exception(f"Не удалось записать финал задачи KIE {job.task_id}, повтор опросом")
+                if job.task_id in self.jobs:
+                    self._schedule(job, KIE_POLL_MIN_STEP)
+                return None
+        self.jobs.pop(job.task_id, None)
+        self._dirty.discard(job.task_id)
+        admission.release(job.job_id)
+        return waiters
+
+    async def _persist(self):
+        if not self._dirty:
+            return
+        loop_now = asyncio.get_running_loop().time()
+        wall_now = datetime.now(timezone.utc)
+        progress = []
+        for task_id in self._dirty:
+            job = self.jobs.get(task_id)
+            if job:
+                at = wall_now + timedelta(seconds=max(0.0, job.next_poll_at - loop_now))
+                progress.append((task_id, job.attempts, at))
+        self._dirty = set()
+        try:
+            await db.update_kie_jobs_progress(progress)
+        except Exception:
+            logging.exception("Не удалось сохранить прогресс опроса KIE")
+
+    async def _persist_loop(self):
+        while True:
+            await asyncio.sleep(KIE_PERSIST_INTERVAL)
+            await self._persist()
+
+    async def _dispatch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            while self._heap and self._heap[0][0] <= now:
+                due, task_id = heapq.heappop(self._heap)
+                job = self.jobs.get(task_id)
+                # устаревшие записи (задача завершена или перепланирована) пропускаем
+                if job and job.next_poll_at == due:
+                    self._ready.put_nowait(task_id)
+            timeout = self._heap[0][0] - now if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            task_id = await self._ready.get()
+            job = self.jobs.get(task_id)
+            if not job:
+                continue
+            try:
+                await self._poll(job)
+            except Exception:
+                logging.exception("Ошибка при проверке статуса видео")
+                # восстановление тоже может упасть (БД) — воркер опроса при этом должен жить;
+                # не дошедший возврат потом доделает WorkerCoordinator._refund_missed
+                try:
+                    if task_id in self.jobs:
+                        waiters = await self._complete(job, "error")
+                        if waiters is not None:
+                            await refund_kie_job(job, "❌ Ошибка при генерации. Токены возвращены.", waiters)
+                except Exception:
+                    logging.exception(f"Не удалось завершить задачу KIE {task_id} после ошибки")
+
+    def _retry_later(self, job: KieJob) -> bool:
+        now = time.time()
+        left = completion_profile.deadline(job) - (now - job.started_at - job.paused)
+        if left <= 0:
+            return False
+        # последний опрос — ровно в момент дедлайна
+        self._schedule(job, min(completion_profile.next_delay(job, now), left))
+        return True
+
+    async def _apply_record(self, job: KieJob, d: dict) -> bool:
+        """Разбирает запись recordInfo/колбэка. True — задача завершена"""
+        state = (d.get("state") or "").lower()
+        flag = d.get("successFlag")
+
+        if state == "success" or flag == 1:
+            waiters = await self._complete(job, "success", _generation_seconds(d))
+            if waiters is not None:
+                await deliver_kie_result(job, _extract_video_url(d), waiters)
+            return True
+
+        if state not in ("", "wait", "queueing", "generating") and flag != 0:
+            # ошибка
+            waiters = await self._complete(job, "failed")
+            if waiters is not None:
+                fail_msg = d.get("failMsg") or d.get("errorMessage") or "Ошибка генерации"
+                await refund_kie_job(job, f"❌ Генерация не удалась: {fail_msg}. Токены возвращены.", waiters)
+            return True
+        return False
+
+    async def on_callback(self, task_id: str, d: dict) -> bool:
+        """Результат пришёл колбэком KIE. False — задача неизвестна или уже завершена"""
+        job = self.jobs.get(task_id)
+        if not job:
+            # задачу может опрашивать другой воркер: завершение в БД всё равно идемпотентно
+            row = await db.get_kie_job(task_id)
+            if not row:
+                return False
+            job = self.job_from_row(row)
+        await self._apply_record(job, d)
+        return True
+
+    async def _poll(self, job: KieJob):
+        if not kie_breaker.closed:
+            # KIE недоступен: ждём пробного запроса, не тратя попытку и время до таймаута
+            delay = max(KIE_POLL_MIN_STEP, kie_breaker.retry_in())
+            job.paused += delay
+            self._schedule(job, delay)
+            return
+        job.attempts += 1
+        d = await kie_client.record_info(job.task_id)
+        if d is not None and await self._apply_record(job, d):
+            return
+
+        if not self._retry_later(job):
             # таймаут
-            await db.add_generations(uid, cost)
-            await safe_send_message(bot, uid, "⏳ Истекло время ожидания. Токены возвращены.")
+            waiters = await self._complete(job, "timeout")
+            if waiters is not None:
+                await refund_kie_job(job, "⏳ Истекло время ожидания. Токены возвращены.", waiters)
+
+kie_scheduler = KieJobScheduler()
+
+# ──────────────────────────── Координация воркеров ─────────────────────
+class WorkerCoordinator:
+    """
+    Делит фоновую работу между воркерами через аренду строк в БД.
+    Каждый тик: heartbeat, продление своих аренд, сброс лишнего сверх
+    справедливой доли (ребалансировка при появлении новых воркеров)
+    и захват свободных строк и строк упавших воркеров (истёкшая аренда).
+    Финальные переходы задач и платежей условные, поэтому даже при
+    кратком пересечении двух владельцев возврат и начисление — однократные.
+    """
+
+    def __init__(self, worker_id: str, ttl: float, interval: float):
+        self.worker_id = worker_id
+        self.ttl = ttl
+        self.interval = interval
+        self.live_workers = 1
+        # строки очереди этого же WORKER_ID, созданные до запуска процесса, — брошенные
+        self.started_at = datetime.now(timezone.utc)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.tick()
+            except Exception:
+                logging.exception("Ошибка координации воркеров")
+
+    async def tick(self):
+        self.live_workers = max(1, await db.heartbeat_worker(self.worker_id, self.ttl))
+        local = {t for t, job in kie_scheduler.jobs.items() if job.persisted}
+        await self._balance("kie_jobs", local, kie_scheduler.adopt, kie_scheduler.drop,
+                            held=lambda: kie_scheduler.jobs)
+        await self._balance("yookassa_payments", None, None, None)
+        await self._refund_orphaned()
+        await self._refund_missed()
+
+    async def _refund_orphaned(self):
+        """Возврат токенов за задачи, застрявшие в очереди упавшего воркера"""
+        rows = await db.fail_orphaned_kie_jobs(self.worker_id, self.started_at, self.ttl)
+        for row in rows:
+            if await db.credit(row["user_id"], row["cost"], reason="refund", job_id=row["job_id"]) is not None:
+                await safe_send_message(
+                    bot, row["user_id"],
+                    "❌ Генерация не началась из-за перезапуска сервиса. Токены возвращены.",
+                    priority=PRIORITY_RESULT
+                )
+        if rows:
+            logging.info(f"kie_jobs: возвращено {len(rows)} задач из очереди упавших воркеров")
+
+    async def _refund_missed(self):
+        """
+        Возврат за задачи, которые завершились неудачей, но возврат не записался
+        (сбой БД между финальным статусом и начислением). Повтор безопасен:
+        второй возврат по тому же job_id token_ledger не примет.
+        """
+        rows = await db.get_unrefunded_kie_jobs(KIE_REFUND_GRACE)
+        refunded = 0
+        for row in rows:
+            if await db.credit(row["user_id"], row["cost"], reason="refund", job_id=row["job_id"]) is None:
+                continue
+            refunded += 1
+            await safe_send_message(
+                bot, row["user_id"],
+                "❌ Генерация не удалась. Токены возвращены.",
+                priority=PRIORITY_RESULT
+            )
+        if refunded:
+            logging.info(f"kie_jobs: довозвращено {refunded} задач без возврата")
+
+    async def _balance(self, table: str, local: Optional[Set[str]], adopt, drop, held=None):
+        owned = await db.renew_leases(table, self.worker_id, self.ttl)
+        if local is not None:
+            # аренду перехватил другой воркер, пока мы не успели её продлить
+            lost = local - set(owned)
+            if lost:
+                drop(list(lost))
+        if held is not None:
+            # строка за нами, а в работе её нет (например, не записался финал) — отпускаем:
+            # иначе аренда продлевалась бы вечно и задачу никто бы больше не опрашивал
+            in_work = held()
+            stray = [k for k in owned if k not in in_work]
+            if stray:
+                logging.warning(f"{table}: {len(stray)} строк за воркером без задачи в работе — отпускаем")
+                await db.release_leases(table, self.worker_id, stray)
+                owned = [k for k in owned if k in in_work]
+        fair_share = math.ceil(await db.count_leasable(table) / self.live_workers)
+        if len(owned) > fair_share:
+            excess = owned[fair_share:]
+            await db.release_leases(table, self.worker_id, excess)
+            if drop:
+                drop(excess)
+        elif len(owned) < fair_share:
+            rows = await db.claim_leases(table, self.worker_id, self.ttl, fair_share - len(owned))
+            if rows and adopt:
+                adopted = adopt(rows)
+                logging.info(f"{table}: взято в работу {adopted} (воркер {self.worker_id})")
+
+# неудачная задача без возврата дольше этого (с) — возврат не дошёл, его довозвращает координатор
+KIE_REFUND_GRACE = 300
+
+coordinator = WorkerCoordinator(WORKER_ID, LEASE_TTL, LEASE_RENEW_INTERVAL)
+
+# ──────────────────────────── Выдача готовых видео ────────────────────
+VIDEO_UPLOAD_LIMIT = 50 * 1024 * 1024   # лимит загрузки файла через Bot API
+
+def _video_meta(msg: Message) -> Tuple[Optional[str], Optional[dict]]:
+    """file_id и метаданные видео из отправленного сообщения"""
+    media = msg.video or msg.document or msg.animation
+    if not media:
+        return None, None
+    meta = {"file_unique_id": media.file_unique_id}
+    for attr in ("file_size", "duration", "width", "height", "mime_type"):
+        value = getattr(media, attr, None)
+        if value is not None:
+            meta[attr] = value
+    return media.file_id, meta
+
+async def _upload_video_from_url(chat_id: int, url: str, **kwargs) -> Optional[Message]:
+    """Запасной путь: качаем файл потоком во временный файл и загружаем сами"""
+    path = os.path.join(tempfile.gettempdir(), f"kie-{uuid.uuid4().hex}.mp4")
+    try:
+        size = 0
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300)) as s:
+            async with s.get(url) as r:
+                if r.status != 200:
+                    logging.warning(f"Скачивание видео: HTTP {r.status} для {url}")
+                    return None
+                with open(path, "wb") as f:
+                    async for chunk in r.content.iter_chunked(1 << 16):
+                        size += len(chunk)
+                        if size > VIDEO_UPLOAD_LIMIT:
+                            logging.warning(f"Видео больше {VIDEO_UPLOAD_LIMIT} байт: {url}")
+                            return None
+                        f.write(chunk)
+        return await safe_send_video(bot, chat_id, FSInputFile(path), **kwargs)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        logging.exception(f"Не удалось скачать видео {url}")
+        return None
+    finally:
+        with contextlib.suppress(OSError):
+            os.unlink(path)
+
+async def send_job_video(chat_id: int, video_url: str | None, file_id: str | None = None,
+                         **kwargs) -> Optional[Message]:
+    """
+    Отправка готового видео: сначала по file_id (без загрузки),
+    затем по URL KIE, затем скачиванием и загрузкой файла.
+    """
+    if file_id:
+        msg = await safe_send_video(bot, chat_id, file_id, **kwargs)
+        if msg:
+            return msg
+    if not video_url:
+        return None
+    msg = await safe_send_video(bot, chat_id, video_url, **kwargs)
+    if msg is None:
+        msg = await _upload_video_from_url(chat_id, video_url, **kwargs)
+    return msg
+
+async def deliver_kie_result(job: KieJob, video_url: str | None, waiters: List[dict] = ()):
+    line_orient = f", 📱 {job.orientation}" if job.orientation else ""
+    ready_text = f"🎉 Ваше видео готово! ⏱️ {job.duration} с{line_orient}"
+    await safe_send_message(bot, job.uid, ready_text, priority=PRIORITY_RESULT)
+    if not video_url:
+        await safe_send_message(bot, job.uid, "⚠️ Видео готово, но URL не найден в ответе.", priority=PRIORITY_RESULT)
+        for w in waiters:
+            await safe_send_message(bot, w["uid"], "⚠️ Видео готово, но URL не найден в ответе.", priority=PRIORITY_RESULT)
+        return
+    msg = await send_job_video(job.uid, video_url, caption="🎬 Готовый ролик")
+    file_id, meta = _video_meta(msg) if msg else (None, None)
+    try:
+        await db.save_kie_video(job.task_id, video_url, file_id, meta)
     except Exception:
-        logging.exception("Ошибка при проверке статуса видео")
-        await db.add_generations(uid, cost)
-        await safe_send_message(bot, uid, "❌ Ошибка при генерации. Токены возвращены.")
+        logging.exception(f"Не удалось сохранить видео задачи {job.task_id}")
+    if not msg:
+        await safe_send_message(
+            bot, job.uid,
+            "⚠️ Не удалось отправить видео. Попробуйте получить его позже: /my_videos",
+            priority=PRIORITY_RESULT
+        )
+    # присоединившимся — тот же ролик по file_id, без повторной загрузки
+    for w in waiters:
+        await safe_send_message(bot, w["uid"], ready_text, priority=PRIORITY_RESULT)
+        if not await send_job_video(w["uid"], video_url, file_id, caption="🎬 Готовый ролик"):
+            await safe_send_message(
+                bot, w["uid"],
+                "⚠️ Не удалось отправить видео. Попробуйте получить его позже: /my_videos",
+                priority=PRIORITY_RESULT
+            )
+
+async def refund_kie_job(job: KieJob, text: str, waiters: List[dict] = ()):
+    await db.credit(job.uid, job.cost, reason="refund", job_id=job.job_id)
+    await safe_send_message(bot, job.uid, text, priority=PRIORITY_RESULT)
+    for w in waiters:
+        await refund_waiter(w, text)
+
+async def refund_waiter(waiter: dict, text: str):
+    await db.credit(waiter["uid"], waiter["cost"], reason="refund", job_id=waiter["job_id"])
+    await safe_send_message(bot, waiter["uid"], text, priority=PRIORITY_RESULT)
+
+# ───────────────────────────── HTTP-сервер ────────────────────────────
+async def kie_callback_handler(request: web.Request) -> web.Response:
+    """Колбэк KIE о завершении задачи (тот же формат data, что у recordInfo)"""
+    if request.query.get("token") != KIE_CALLBACK_SECRET:
+        return web.Response(status=403)
+    try:
+        body = await request.json()
+    except Exception:
+        return web.Response(status=400)
+    d = body.get("data") or {}
+    task_id = d.get("taskId") or d.get("task_id")
+    if not task_id:
+        return web.Response(status=400)
+    try:
+        known = await kie_scheduler.on_callback(task_id, d)
+        if not known:
+            logging.info(f"Колбэк KIE для неизвестной задачи {task_id}")
+    except Exception:
+        logging.exception("Ошибка обработки колбэка KIE")
+    # KIE не нужно повторять доставку: статус в любом случае подхватит опрос
+    return web.json_response({"ok": True})
+
+async def yookassa_notify_handler(request: web.Request) -> web.Response:
+    """
+    Уведомления YooKassa payment.succeeded / payment.canceled.
+    Тело уведомления не подписано, поэтому статус перепроверяем запросом к API.
+    """
+    try:
+        body = await request.json()
+    except Exception:
+        return web.Response(status=400)
+    if body.get("event") not in ("payment.succeeded", "payment.canceled"):
+        return web.Response(status=200)
+    payment_id = (body.get("object") or {}).get("id")
+    if not payment_id:
+        return web.Response(status=400)
+    try:
+        payment = await yookassa_client.get_payment(payment_id)
+        await apply_yookassa_status(payment_id, payment.status, payment.amount_value)
+    except Exception:
+        logging.exception(f"Ошибка обработки уведомления YooKassa {payment_id}")
+        # не 200 — YooKassa повторит уведомление
+        return web.Response(status=500)
+    return web.Response(status=200)
+
+REGISTRY.counter_fn("bot_subscription_cache_hits_total", "Попадания в кэш подписки", lambda: sub_cache.hits)
+REGISTRY.counter_fn("bot_subscription_cache_misses_total", "Промахи кэша подписки", lambda: sub_cache.misses)
+REGISTRY.gauge("bot_subscription_cache_hit_ratio", "Доля попаданий в кэш подписки", lambda: sub_cache.hit_ratio)
+REGISTRY.gauge("bot_subscription_cache_size", "Записей в кэше подписки", lambda: len(sub_cache))
+REGISTRY.gauge("bot_flood_tracked_users", "Пользователей в LRU антифлуда", lambda: len(flood_control))
+REGISTRY.gauge("bot_outbox_queue_depth", "Запросов к Bot API в очереди", lambda: len(outbox))
+REGISTRY.gauge("bot_kie_queue_depth", "Задач в очереди на createTask", lambda: len(admission))
+REGISTRY.gauge("bot_kie_inflight", "Задач KIE, занимающих место в лимите", lambda: len(admission.active))
+REGISTRY.gauge("bot_kie_admission_limit", "Текущий лимит одновременных задач KIE", lambda: admission.limit)
+REGISTRY.gauge("bot_kie_breaker_state", "Предохранитель KIE: 0 — замкнут, 1 — пробный запрос, 2 — разомкнут",
+               lambda: (kie_breaker.CLOSED, kie_breaker.HALF_OPEN, kie_breaker.OPEN).index(kie_breaker.state))
+REGISTRY.counter_fn("bot_kie_breaker_opened_total", "Размыканий предохранителя KIE", lambda: kie_breaker.opened)
+REGISTRY.gauge("bot_kie_polling_jobs", "Задач KIE на опросе у этого воркера", lambda: len(kie_scheduler.jobs))
+REGISTRY.gauge("bot_db_pool_size", "Соединений в пуле БД", lambda: db.pool.get_size() if db.pool else 0)
+REGISTRY.gauge("bot_db_pool_idle", "Свободных соединений в пуле БД", lambda: db.pool.get_idle_size() if db.pool else 0)
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """Метрики в текстовом формате Prometheus"""
+    return web.Response(text=REGISTRY.render(), content_type="text/plain")
+
+def build_web_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post(KIE_CALLBACK_PATH, kie_callback_handler)
+    app.router.add_post(YOOKASSA_NOTIFY_PATH, yookassa_notify_handler)
+    app.router.add_get("/metrics", metrics_handler)
+    if blob_store is not None:
+        blob_store.register(app)
+    if RUN_MODE == "webhook":
+        SimpleRequestHandler(
+            dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None
+        ).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+    return app
+
+async def start_http_server() -> web.AppRunner:
+    runner = web.AppRunner(build_web_app())
+    await runner.setup()
+    await web.TCPSite(runner, HTTP_HOST, HTTP_PORT).start()
+    logging.info(f"HTTP-сервер слушает {HTTP_HOST}:{HTTP_PORT}")
+    return runner
+
+async def run_webhook():
+    await bot.set_webhook(
+        f"{PUBLIC_BASE_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    logging.info("Вебхук Telegram установлен")
+    await asyncio.Event().wait()
 
 # ───────────────────────────── Точка входа ────────────────────────────
 async def main():
+    runner: Optional[web.AppRunner] = None
+    background: List[asyncio.Task] = []
     try:
         await db.connect()
         logging.info("DB connected")
-        await dp.start_polling(bot)
+        keyboards.rebuild()
+        outbox.start()
+        await kie_client.start()
+        if YOOKASSA_ENABLED:
+            await yookassa_client.start()
+        await kie_scheduler.start()
+        # первый тик сразу поднимает незавершённые задачи и платежи
+        await coordinator.tick()
+        background.append(asyncio.create_task(coordinator.run()))
+        if isinstance(storage, PostgresStorage):
+            background.append(asyncio.create_task(storage.expire_loop(FSM_TTL)))
+        if YOOKASSA_ENABLED:
+            background.append(asyncio.create_task(yookassa_reconcile_loop()))
+        if blob_store is not None:
+            background.append(asyncio.create_task(blob_store.gc_loop(BLOB_MAX_AGE)))
+        background.append(asyncio.create_task(completion_profile.refresh_loop()))
+        background.append(asyncio.create_task(loop_lag_monitor()))
+        if HTTP_ENABLED:
+            runner = await start_http_server()
+        if RUN_MODE == "webhook":
+            await run_webhook()
+        else:
+            # chat_member приходит только если явно указан в allowed_updates
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     except Exception as e:
         logging.error(f"Ошибка при запуске бота: {e}")
     finally:
+        for t in background:
+            t.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        await drain_submissions()
+        await kie_scheduler.stop()
+        await kie_client.close()
+        await yookassa_client.close()
+        # досылаем очередь до закрытия HTTP-сессии бота
+        await outbox.stop()
+        if runner:
+            await runner.cleanup()
+        await bot.session.close()
+        if db.pool:
+            try:
+                await db.leave_worker(WORKER_ID)
+            except Exception:
+                logging.exception("Не удалось снять аренды воркера")
         await db.close()
         logging.info("DB closed")
 
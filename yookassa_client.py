@@ -0,0 +1,138 @@
+import time
+import uuid
+import asyncio
+from datetime import datetime, timezone
+from typing import List, NamedTuple, Optional
+
+import aiohttp
+
+from metrics import Histogram
+
+
+class YooKassaError(RuntimeError):
+    """Ответ YooKassa с ошибкой (4xx или 5xx после всех повторов)"""
+
+    def __init__(self, status: int, code: Optional[str] = None, description: Optional[str] = None):
+        super().__init__(f"YooKassa: HTTP {status} {code or ''} {description or ''}".strip())
+        self.status = status
+        self.code = code
+
+
+class YooKassaPayment(NamedTuple):
+    """Поля платежа, которые нужны боту"""
+    id: str
+    status: str
+    amount_value: str
+    currency: str
+    confirmation_url: Optional[str]
+    metadata: dict
+
+    @classmethod
+    def from_json(cls, d: dict) -> "YooKassaPayment":
+        amount = d.get("amount") or {}
+        return cls(
+            id=d["id"],
+            status=d.get("status") or "",
+            amount_value=amount.get("value") or "",
+            currency=amount.get("currency") or "",
+            confirmation_url=(d.get("confirmation") or {}).get("confirmation_url"),
+            metadata=d.get("metadata") or {},
+        )
+
+
+class YooKassaClient:
+    """
+    Асинхронный клиент API YooKassa v3 на aiohttp вместо синхронного SDK в потоках:
+    одна сессия с keep-alive и Basic-авторизацией магазина на все запросы.
+    Создание платежа идёт с ключом идемпотентности и при 202/5xx/обрыве повторяется
+    с тем же ключом — двойного платежа не будет.
+    """
+
+    def __init__(self, shop_id: str, secret_key: str, base_url: str = "https://api.yookassa.ru/v3", *,
+                 limit: int = 20, timeout: float = 30, max_attempts: int = 3,
+                 latency: Optional[Histogram] = None):
+        self.shop_id = shop_id
+        self.secret_key = secret_key
+        self.base_url = base_url.rstrip("/")
+        self.limit = limit
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_attempts = max(1, max_attempts)
+        self.latency = latency
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self):
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.limit, ttl_dns_cache=300, keepalive_timeout=60),
+            auth=aiohttp.BasicAuth(self.shop_id, self.secret_key),
+            timeout=self.timeout,
+        )
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            raise RuntimeError("YooKassaClient не запущен: вызовите start()")
+        return self._session
+
+    async def _request(self, op: str, method: str, path: str, **kwargs) -> dict:
+        """
+        Запрос с повторами: 202 (YooKassa ещё обрабатывает, ждём retry_after),
+        5xx и сетевые ошибки. Повторять безопасно: GET без побочных эффектов,
+        POST — с тем же Idempotence-Key.
+        """
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            for attempt in range(1, self.max_attempts + 1):
+                delay = 1.0
+                try:
+                    async with self.session.request(method, f"{self.base_url}{path}", **kwargs) as r:
+                        status = r.status
+                        try:
+                            body = await r.json(content_type=None)
+                        except ValueError:
+                            body = None
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    if attempt == self.max_attempts:
+                        raise
+                else:
+                    body = body if isinstance(body, dict) else {}
+                    if status == 200:
+                        outcome = "ok"
+                        return body
+                    if status == 202:
+                        delay = float(body.get("retry_after") or 1000) / 1000
+                    if (status < 500 and status != 202) or attempt == self.max_attempts:
+                        raise YooKassaError(status, body.get("code"), body.get("description"))
+                await asyncio.sleep(delay)
+        finally:
+            if self.latency is not None:
+                self.latency.observe(time.perf_counter() - start, op, outcome)
+
+    async def create_payment(self, params: dict, idempotence_key: Optional[str] = None) -> YooKassaPayment:
+        key = idempotence_key or str(uuid.uuid4())
+        body = await self._request("create", "POST", "/payments", json=params,
+                                   headers={"Idempotence-Key": key})
+        return YooKassaPayment.from_json(body)
+
+    async def get_payment(self, payment_id: str) -> YooKassaPayment:
+        return YooKassaPayment.from_json(await self._request("get", "GET", f"/payments/{payment_id}"))
+
+    async def list_payments(self, status: str, created_gte: Optional[datetime] = None,
+                            page_size: int = 100) -> List[YooKassaPayment]:
+        """Все платежи в статусе status (созданные не раньше created_gte), по страницам"""
+        params = {"status": status, "limit": str(page_size)}
+        if created_gte is not None:
+            params["created_at.gte"] = created_gte.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+        payments: List[YooKassaPayment] = []
+        while True:
+            body = await self._request("list", "GET", "/payments", params=params)
+            payments.extend(YooKassaPayment.from_json(p) for p in body.get("items") or ())
+            cursor = body.get("next_cursor")
+            if not cursor:
+                return payments
+            params["cursor"] = cursor